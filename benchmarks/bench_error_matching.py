@@ -0,0 +1,61 @@
+"""Compare ``--only-rerun`` / ``--rerun-except`` matching with the old approach.
+
+The old approach rendered the error message once per pattern list and searched
+it with every (uncompiled) pattern in turn.
+
+Run with ``python benchmarks/bench_error_matching.py``.
+"""
+
+import re
+import timeit
+from types import SimpleNamespace
+
+from pytest_rerunfailures import _get_error_matcher
+
+ONLY_RERUN = ("ConnectionError", "TimeoutError", "OSError: .*reset", "BrokenPipe")
+RERUN_EXCEPT = ("AssertionError: assert 1 == 2", "KeyError", "Deterministic")
+
+
+def _try_match_error(rerun_errors, excinfo):
+    if excinfo:
+        err = f"{excinfo.type.__name__}: {excinfo.value}"
+        for rerun_error in rerun_errors:
+            if isinstance(rerun_error, type) and issubclass(rerun_error, BaseException):
+                if issubclass(excinfo.type, rerun_error):
+                    return True
+            elif re.search(rerun_error, err):
+                return True
+    return False
+
+
+def old_should_hard_fail(excinfo):
+    matches_rerun_only = _try_match_error(ONLY_RERUN, excinfo)
+    matches_rerun_except = _try_match_error(RERUN_EXCEPT, excinfo)
+    return (not matches_rerun_only) or matches_rerun_except
+
+
+def new_should_hard_fail(excinfo, max_chars=None):
+    matcher = _get_error_matcher(ONLY_RERUN, RERUN_EXCEPT)
+    return matcher.should_hard_fail(excinfo, max_chars)
+
+
+def main():
+    for size in (100, 10_000, 1_000_000, 5_000_000):
+        message = "assert {'a': 1, ...} == {'a': 2, ...}\n" + "- x\n" * (size // 4)
+        excinfo = SimpleNamespace(type=AssertionError, value=AssertionError(message))
+        if old_should_hard_fail(excinfo) != new_should_hard_fail(excinfo):
+            raise RuntimeError("old and new matching disagree")
+
+        number = max(1, 200_000 // size)
+        cases = [
+            ("old", lambda: old_should_hard_fail(excinfo)),
+            ("new", lambda: new_should_hard_fail(excinfo)),
+            ("new, 4096 chars", lambda: new_should_hard_fail(excinfo, 4096)),
+        ]
+        for name, func in cases:
+            seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+            print(f"{size:>9} chars  {name:<16} {seconds * 1e6:12.1f} us/report")
+
+
+if __name__ == "__main__":
+    main()
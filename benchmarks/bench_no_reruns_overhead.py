@@ -0,0 +1,55 @@
+"""Measure the per-test overhead of the plugin when no reruns are configured.
+
+Runs a generated suite of trivial tests with the plugin enabled (but neither
+``--reruns`` nor ``@pytest.mark.flaky`` used) and with ``-p no:rerunfailures``,
+and prints the difference per test.
+
+Run with ``python benchmarks/bench_no_reruns_overhead.py [number of tests]``.
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPEAT = 5
+
+
+def make_suite(directory, count):
+    per_module = 500
+    for module in range(0, count, per_module):
+        tests = "".join(
+            f"def test_{i}():\n    pass\n\n\n"
+            for i in range(min(per_module, count - module))
+        )
+        (directory / f"test_m{module}.py").write_text(tests)
+
+
+def run(directory, *args):
+    cmd = [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", *args]
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=directory, check=True, stdout=subprocess.DEVNULL)  # noqa: S603
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        make_suite(directory, count)
+        without_plugin = run(directory, "-p", "no:rerunfailures")
+        with_plugin = run(directory)
+
+    overhead = (with_plugin - without_plugin) / count
+    print(f"{count} tests, best of {REPEAT} runs")
+    print(f"  -p no:rerunfailures  {without_plugin:8.3f} s")
+    print(f"  plugin enabled       {with_plugin:8.3f} s")
+    print(f"  overhead per test    {overhead * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compare the socket and the shared-memory StatusDB backends.
+
+Starts a number of worker processes on this host, each checking the suite
+rerun budget with ``try_increment_suite_reruns`` and reading the rerun count
+of a test, as a worker does for every rerun, and prints the operations per
+second for both backends.
+
+Run with ``python benchmarks/bench_statusdb_backends.py``.
+"""
+
+import multiprocessing
+import time
+
+from pytest_rerunfailures import ClientStatusDB, ServerStatusDB, SharedStatusDB
+
+OPS_PER_WORKER = 2_000
+WORKER_COUNTS = (1, 4, 16)
+
+
+def worker(open_db, start_event, done_queue):
+    db = open_db()
+    db.get_suite_reruns()  # connect
+    start_event.wait()
+    for i in range(OPS_PER_WORKER // 2):
+        db.try_increment_suite_reruns(10**9)
+        db.get_test_reruns(i)
+    done_queue.put(None)
+
+
+def measure(open_db, workers):
+    ctx = multiprocessing.get_context("fork")
+    start_event = ctx.Event()
+    done_queue = ctx.Queue()
+    processes = [
+        ctx.Process(target=worker, args=(open_db, start_event, done_queue))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)  # let all workers connect
+    start = time.perf_counter()
+    start_event.set()
+    for _ in processes:
+        done_queue.get()
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return workers * OPS_PER_WORKER / elapsed
+
+
+def main():
+    print(f"{'workers':>8} {'socket ops/s':>13} {'shared ops/s':>13} {'speedup':>8}")
+    for workers in WORKER_COUNTS:
+        server = ServerStatusDB()
+        sockets = measure(lambda: ClientStatusDB(server.sock_port), workers)
+        shared_db = SharedStatusDB()
+        shared = measure(lambda: SharedStatusDB(shared_db.path), workers)
+        shared_db.close()
+        print(
+            f"{workers:>8} {sockets:>13,.0f} {shared:>13,.0f} {shared / sockets:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
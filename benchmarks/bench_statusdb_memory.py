@@ -0,0 +1,85 @@
+"""Measure the memory used to track the reruns and failures of every test.
+
+Compares the integer test IDs and array-backed counter columns with the
+previous structure, in which every worker kept the SHA-1 digest of every node
+ID in a dict and the controller kept a dict of counters per digest. Both sides
+are counted: the test IDs kept on the worker items, and the counters of the
+controller, with one rerun count per test and a few failures.
+
+Run with ``python benchmarks/bench_statusdb_memory.py``.
+"""
+
+import hashlib
+import tracemalloc
+from array import array
+
+import pytest
+
+from pytest_rerunfailures import (
+    COLUMN_TYPECODE,
+    ServerStatusDB,
+    _column_from_bytes,
+    _column_to_bytes,
+    _rerun_policy_key,
+    _test_id_key,
+)
+
+TEST_COUNTS = (100_000, 1_000_000)
+FAILURES = 100
+
+
+def legacy(nodeids, stashes, server):
+    # worker: StatusDB.hmap
+    hmap = {}
+    for nodeid in nodeids:
+        hmap[nodeid] = hashlib.sha1(nodeid.encode()).hexdigest()[:10]  # noqa: S324
+    # controller: ServerStatusDB.rerunfailures_db, keyed by the received digest
+    rerunfailures_db = {}
+    for digest in hmap.values():
+        rerunfailures_db.setdefault(digest.encode().decode(), {})["r"] = 2
+    for digest in list(rerunfailures_db)[:FAILURES]:
+        rerunfailures_db[digest]["f"] = 1
+    return hmap, rerunfailures_db
+
+
+def current(nodeids, stashes, server):
+    # worker: the test ID of every item and the uploaded rerun counts
+    reruns = array(COLUMN_TYPECODE)
+    for test_id, stash in enumerate(stashes):
+        stash[_test_id_key] = test_id
+        reruns.append(2)
+    # controller: the counter columns, as received from the worker
+    server.columns["r"] = _column_from_bytes(_column_to_bytes(reruns))
+    for test_id in range(FAILURES):
+        server._store(test_id, "f", 1)
+    return reruns
+
+
+def measure(structure, count):
+    nodeids = [
+        f"tests/package_{i // 1000}/test_module_{i // 50}.py::TestClass::test_{i}"
+        for i in range(count)
+    ]
+    # the items already hold their rerun policy in the stash
+    stashes = [pytest.Stash() for _ in range(count)]
+    for stash in stashes:
+        stash[_rerun_policy_key] = None
+    server = ServerStatusDB()
+    tracemalloc.start()
+    result = structure(nodeids, stashes, server)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    print(f"{'tests':>10} {'legacy MiB':>11} {'current MiB':>12} {'ratio':>7}")
+    for count in TEST_COUNTS:
+        before = measure(legacy, count) / 2**20
+        after = measure(current, count) / 2**20
+        print(f"{count:>10,} {before:>11.1f} {after:>12.1f} {before / after:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Measure the throughput of the StatusDB socket protocol.
+
+Starts a controller-side server in this process and a number of worker
+processes, each issuing ``get_test_reruns``/``set_test_reruns`` pairs, that is
+one request with and one without a reply, as ``pytest_runtest_protocol`` used
+to do for every test. Prints the operations per second for the current
+protocol and for the previous newline-delimited text protocol, which read the
+socket one byte at a time and identified tests by a hash of their node ID.
+
+Run with ``python benchmarks/bench_statusdb_protocol.py``.
+"""
+
+import hashlib
+import multiprocessing
+import socket
+import threading
+import time
+from contextlib import suppress
+
+from pytest_rerunfailures import ClientStatusDB, ServerStatusDB, StatusDB
+
+OPS_PER_WORKER = 1_000
+WORKER_COUNTS = (1, 4, 16, 64)
+
+
+class LegacySocketDB(StatusDB):
+    def __init__(self):
+        super().__init__()
+        self.delim = b"\n"
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(1)
+        self.hmap = {}
+
+    def _hash(self, crashitem):
+        if crashitem not in self.hmap:
+            self.hmap[crashitem] = hashlib.sha1(crashitem.encode()).hexdigest()[:10]  # noqa: S324
+        return self.hmap[crashitem]
+
+    def set_test_reruns(self, crashitem, reruns):
+        self._set(self._hash(crashitem), "r", reruns)
+
+    def get_test_reruns(self, crashitem):
+        return self._get(self._hash(crashitem), "r")
+
+    def _sock_recv(self, conn) -> str:
+        buf = b""
+        while True:
+            b = conn.recv(1)
+            if not b:
+                # not in the original, which spun forever on closed connections
+                raise ConnectionError
+            if b == self.delim:
+                break
+            buf += b
+
+        return buf.decode()
+
+    def _sock_send(self, conn, msg: str):
+        conn.send(msg.encode() + self.delim)
+
+
+class LegacyServerStatusDB(LegacySocketDB):
+    def __init__(self):
+        super().__init__()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.rerunfailures_db = {}
+        threading.Thread(target=self.run_server, daemon=True).start()
+
+    @property
+    def sock_port(self):
+        return self.sock.getsockname()[1]
+
+    def run_server(self):
+        while True:
+            conn, _ = self.sock.accept()
+            t = threading.Thread(target=self.run_connection, args=(conn,), daemon=True)
+            t.start()
+
+    def run_connection(self, conn):
+        with suppress(ConnectionError, ValueError):
+            while True:
+                op, i, k, v = self._sock_recv(conn).split("|")
+                if op == "set":
+                    self._set(i, k, int(v))
+                elif op == "get":
+                    self._sock_send(conn, str(self._get(i, k)))
+
+    def _set(self, i, k, v):
+        self.rerunfailures_db.setdefault(i, {})[k] = v
+
+    def _get(self, i, k):
+        try:
+            return self.rerunfailures_db[i][k]
+        except KeyError:
+            return 0
+
+
+class LegacyClientStatusDB(LegacySocketDB):
+    def __init__(self, sock_port):
+        super().__init__()
+        self.sock.connect(("127.0.0.1", sock_port))
+
+    def _set(self, i, k, v):
+        self._sock_send(self.sock, "|".join(("set", i, k, str(v))))
+
+    def _get(self, i, k):
+        self._sock_send(self.sock, "|".join(("get", i, k, "")))
+        return int(self._sock_recv(self.sock))
+
+
+def worker(client_cls, port, index, start_event, done_queue):
+    db = client_cls(port)
+    if client_cls is LegacyClientStatusDB:
+        tests = [
+            f"tests/test_module_{index}.py::test_{i}"
+            for i in range(OPS_PER_WORKER // 2)
+        ]
+    else:
+        tests = range(
+            index * OPS_PER_WORKER, index * OPS_PER_WORKER + OPS_PER_WORKER // 2
+        )
+    db.get_test_reruns(tests[0])  # connect
+    start_event.wait()
+    for test in tests:
+        db.get_test_reruns(test)
+        db.set_test_reruns(test, 2)
+    # make sure the last (unanswered) message has been processed
+    db.get_test_reruns(tests[-1])
+    done_queue.put(index)
+
+
+def measure(server_cls, client_cls, workers):
+    server = server_cls()
+    ctx = multiprocessing.get_context("fork")
+    start_event = ctx.Event()
+    done_queue = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=worker,
+            args=(client_cls, server.sock_port, i, start_event, done_queue),
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)  # let all workers connect
+    start = time.perf_counter()
+    start_event.set()
+    for _ in processes:
+        done_queue.get()
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return workers * (OPS_PER_WORKER + 1) / elapsed
+
+
+def main():
+    print(f"{'workers':>8} {'legacy ops/s':>14} {'framed ops/s':>14} {'speedup':>8}")
+    for workers in WORKER_COUNTS:
+        legacy = measure(LegacyServerStatusDB, LegacyClientStatusDB, workers)
+        framed = measure(ServerStatusDB, ClientStatusDB, workers)
+        print(
+            f"{workers:>8} {legacy:>14,.0f} {framed:>14,.0f} {framed / legacy:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
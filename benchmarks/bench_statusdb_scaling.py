@@ -0,0 +1,98 @@
+"""Measure how the StatusDB server scales with the number of worker connections.
+
+Compares the single-threaded, selector-based server with the previous design,
+which served every connection from a thread of its own. The clients are
+simulated by a few processes, each owning an equal share of the connections
+and issuing ``get_test_reruns`` requests on them in turn.
+
+Run with ``python benchmarks/bench_statusdb_scaling.py``.
+"""
+
+import multiprocessing
+import socket
+import threading
+import time
+from contextlib import suppress
+
+from pytest_rerunfailures import ClientStatusDB, ServerStatusDB, _FrameReader
+
+CLIENT_COUNTS = (8, 32, 128, 512)
+PROCESSES = 8
+REQUESTS_PER_CLIENT = 200
+
+
+class ThreadedServerStatusDB(ServerStatusDB):
+    """The previous design: one thread per worker connection."""
+
+    def run_server(self):
+        self.sock.setblocking(True)
+        while True:
+            conn, _ = self.sock.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = threading.Thread(target=self.run_connection, args=(conn,), daemon=True)
+            t.start()
+
+    def run_connection(self, conn):
+        reader = _FrameReader(conn)
+        with suppress(ConnectionError):
+            while True:
+                op, payload = reader.read_frame()
+                reply = self._handle_message(op, payload)
+                if reply is not None:
+                    self._sock_send(conn, *reply)
+
+
+def clients_process(port, count, start_event, done_queue):
+    clients = [ClientStatusDB(port) for _ in range(count)]
+    for client in clients:
+        client.get_suite_reruns()  # connect
+    start_event.wait()
+    for i in range(REQUESTS_PER_CLIENT):
+        for client in clients:
+            client.get_test_reruns(i)
+    done_queue.put(count)
+
+
+def measure(server_cls, clients):
+    threads_before = threading.active_count()
+    server = server_cls()
+    ctx = multiprocessing.get_context("fork")
+    start_event = ctx.Event()
+    done_queue = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=clients_process,
+            args=(server.sock_port, clients // PROCESSES, start_event, done_queue),
+        )
+        for _ in range(PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    time.sleep(2)  # let all clients connect
+    threads = threading.active_count() - threads_before
+    start = time.perf_counter()
+    start_event.set()
+    for _ in processes:
+        done_queue.get()
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return clients * REQUESTS_PER_CLIENT / elapsed, threads
+
+
+def main():
+    print(
+        f"{'clients':>8} {'threaded ops/s':>15} {'threads':>8}"
+        f" {'selector ops/s':>15} {'threads':>8}"
+    )
+    for clients in CLIENT_COUNTS:
+        threaded, threaded_threads = measure(ThreadedServerStatusDB, clients)
+        selector, selector_threads = measure(ServerStatusDB, clients)
+        print(
+            f"{clients:>8} {threaded:>15,.0f} {threaded_threads:>8}"
+            f" {selector:>15,.0f} {selector_threads:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
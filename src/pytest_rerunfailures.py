@@ -1,20 +1,35 @@
-import hashlib
+import copy
+import functools
+import heapq
 import importlib.metadata
+import itertools
+import mmap
 import os
+import pickle
 import platform
 import re
+import select
+import selectors
+import signal
 import socket
+import sqlite3
+import struct
 import sys
+import tempfile
 import threading
 import time
 import traceback
+import uuid
 import warnings
-from contextlib import suppress
+from array import array
+from collections import ChainMap, deque
+from contextlib import contextmanager, suppress
 from typing import Any
 
 import pytest
-from _pytest.outcomes import fail
-from _pytest.runner import runtestprotocol
+from _pytest.outcomes import TEST_OUTCOME, fail
+from _pytest.runner import call_and_report, runtestprotocol, show_test_item
+from _pytest.warnings import catch_warnings_for_item
 from packaging.version import parse as parse_version
 
 failed_subtests_key: Any
@@ -32,6 +47,11 @@ except ImportError:
 failed_subtests_key = _failed_subtests_key
 SubtestReport = _SubtestReport
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None  # type: ignore[assignment]
+
 try:
     from xdist.newhooks import pytest_handlecrashitem
 
@@ -65,6 +85,32 @@ RERUNS_DELAY_BACKOFF_FACTOR_DESC = (
     "exponential backoff (delay * factor ** (attempt - 1)). defaults to 1.0, "
     "i.e. a constant delay."
 )
+RERUNS_MAX_ATTEMPT_SECONDS_DESC = (
+    "do not rerun a test whose failed attempt (setup, call and teardown) took "
+    "longer than this many seconds."
+)
+RERUNS_DEADLINE_DESC = (
+    "do not rerun a test once the time (seconds) spent on its attempts and "
+    "rerun delays, including the delay before the next rerun, would exceed "
+    "this deadline."
+)
+RERUNS_FIXTURE_BUDGET_DESC = (
+    "number of times a failed fixture of a higher scope than function is set "
+    "up again for the reruns of the tests using it, per instance of its scope. "
+    "Once spent, the remaining tests using it fail with its cached error "
+    "without a rerun."
+)
+
+
+# the circuit breaker window is kept as a bitset of a fixed size
+MAX_BREAKER_WINDOW = 4096
+# the runs of a test its adaptive rerun count is derived from
+ADAPTIVE_HISTORY_SIZE = 10
+RESCHEDULE_POLICIES = ("any", "other")
+# the --dist modes whose scheduler can take a test back to run it again
+RESCHEDULE_DIST_MODES = ("load", "worksteal")
+# the fixture scopes whose failed tests --reruns-scope reruns as a group
+RERUN_SCOPES = ("module", "class")
 
 
 # command line options
@@ -111,6 +157,111 @@ def pytest_addoption(parser):
         type=float,
         help=RERUNS_DELAY_BACKOFF_FACTOR_DESC,
     )
+    group._addoption(
+        "--reruns-max-attempt-seconds",
+        action="store",
+        dest="reruns_max_attempt_seconds",
+        type=float,
+        help=RERUNS_MAX_ATTEMPT_SECONDS_DESC,
+    )
+    group._addoption(
+        "--reruns-deadline",
+        action="store",
+        dest="reruns_deadline",
+        type=float,
+        help=RERUNS_DEADLINE_DESC,
+    )
+    group._addoption(
+        "--reruns-fixture-budget",
+        action="store",
+        dest="reruns_fixture_budget",
+        type=int,
+        help=RERUNS_FIXTURE_BUDGET_DESC,
+    )
+    group._addoption(
+        "--reruns-delay-nonblocking",
+        action="store_true",
+        dest="reruns_delay_nonblocking",
+        help="Instead of sleeping for the rerun delay, park the failed test "
+        "and run the following tests in the meantime. The rerun starts once "
+        "its delay has elapsed.",
+    )
+    group._addoption(
+        "--reruns-defer",
+        action="store_true",
+        dest="reruns_defer",
+        help="Rerun the failed tests after all other tests have run, in the "
+        "order they failed, instead of right after the failed attempt.",
+    )
+    group._addoption(
+        "--reruns-scope",
+        action="store",
+        dest="reruns_scope",
+        choices=RERUN_SCOPES,
+        default=None,
+        help="Rerun the failed tests of a module or class as a group right "
+        "after its last test, instead of right after the failed attempt. The "
+        "fixtures of the scope are set up once for all reruns of the group.",
+    )
+    group._addoption(
+        "--reruns-reschedule",
+        action="store",
+        dest="reruns_reschedule",
+        choices=RESCHEDULE_POLICIES,
+        default=None,
+        help="With pytest-xdist and --dist load or worksteal, send the rerun of "
+        "a failed test back to the scheduler instead of retrying it on the "
+        "same worker right away: 'any' runs it on the next worker asking for "
+        "tests, 'other' on the least busy worker other than the one it failed "
+        "on. A test failing once its worker is shutting down is retried in "
+        "place.",
+    )
+    group._addoption(
+        "--rerun-snapshot",
+        action="store",
+        dest="rerun_snapshot",
+        choices=("fork",),
+        default=None,
+        help="Run the call phase of the tests which may be rerun in a forked "
+        "child process, so a rerun forks again from the state after the setup "
+        "instead of setting up the test again. The test is torn down once "
+        "after its last attempt. Needs os.fork, i.e. not on Windows.",
+    )
+    group._addoption(
+        "--rerun-fresh-process",
+        action="store_true",
+        dest="rerun_fresh_process",
+        help="Run the reruns in a fresh process, forked from a template process "
+        "taken right after the collection, so state an earlier test left "
+        "behind in the session process cannot fail them again. Needs os.fork, "
+        "i.e. not on Windows.",
+    )
+    group._addoption(
+        "--rerun-isolate",
+        action="store_true",
+        dest="rerun_isolate",
+        help="Run every attempt of the tests which may be rerun in a forked "
+        "child process, so a crash, e.g. a segfault, fails the attempt "
+        "instead of the session. The flaky marker selects the tests with "
+        "isolate=True instead. Needs os.fork, i.e. not on Windows.",
+    )
+    group._addoption(
+        "--reruns-adaptive",
+        action="store_true",
+        dest="reruns_adaptive",
+        help="Adjust the rerun count of every test to its outcomes in the last "
+        f"{ADAPTIVE_HISTORY_SIZE} runs, kept in the pytest cache: tests which "
+        "passed on a rerun get the reruns they needed plus one, tests which "
+        "never failed or only failed after all reruns are not rerun.",
+    )
+    group._addoption(
+        "--reruns-adaptive-max",
+        action="store",
+        dest="reruns_adaptive_max",
+        type=int,
+        default=5,
+        help="The maximum rerun count of --reruns-adaptive. defaults to 5.",
+    )
     group._addoption(
         "--rerun-except",
         action="append",
@@ -121,6 +272,77 @@ def pytest_addoption(parser):
         "regex provided. Pass this flag multiple times to accumulate a list "
         "of regexes to match",
     )
+    group._addoption(
+        "--rerun-match-max-chars",
+        action="store",
+        dest="rerun_match_max_chars",
+        type=int,
+        default=None,
+        help="Only match the first N characters of the error message against "
+        "the --only-rerun and --rerun-except patterns. Bounds the cost of "
+        "matching very long messages, e.g. large assertion diffs.",
+    )
+    group._addoption(
+        "--rerun-stop-on-identical",
+        action="store",
+        dest="rerun_stop_on_identical",
+        type=int,
+        default=None,
+        help="Stop rerunning a test once this many consecutive attempts failed "
+        "with the same exception type, crash location and message, ignoring "
+        "the numbers and addresses in the message.",
+    )
+    group._addoption(
+        "--rerun-circuit-breaker",
+        action="store",
+        dest="rerun_circuit_breaker",
+        type=float,
+        default=None,
+        help="Stop granting reruns while the fraction of failed attempts among "
+        "the last --rerun-circuit-breaker-window attempts of the session is at "
+        "least this value (between 0 and 1).",
+    )
+    group._addoption(
+        "--rerun-circuit-breaker-window",
+        action="store",
+        dest="rerun_circuit_breaker_window",
+        type=int,
+        default=100,
+        help="The number of recent attempts the --rerun-circuit-breaker failure "
+        f"rate is computed over, at most {MAX_BREAKER_WINDOW}. defaults to 100.",
+    )
+    group._addoption(
+        "--rerun-history",
+        action="store_true",
+        dest="rerun_history",
+        help="Record the outcome and duration of every test attempt into a "
+        "SQLite database, by default in the pytest cache directory.",
+    )
+    group._addoption(
+        "--rerun-history-path",
+        action="store",
+        dest="rerun_history_path",
+        type=str,
+        default=None,
+        help="The SQLite database --rerun-history records into and "
+        "--rerun-history-report reads from.",
+    )
+    group._addoption(
+        "--rerun-history-report",
+        action="store_true",
+        dest="rerun_history_report",
+        help="Show the tests with the highest flake rate and the most time "
+        "spent on failed attempts which were rerun, according to the history.",
+    )
+    group._addoption(
+        "--rerun-flaky-first",
+        action="store_true",
+        dest="rerun_flaky_first",
+        help="Run the tests with the highest expected rerun time first, i.e. "
+        "their average attempt duration times the share of runs in which they "
+        "were rerun according to the --rerun-history database, so their "
+        "reruns overlap with the other tests.",
+    )
     group._addoption(
         "--rerun-exclude-path",
         action="append",
@@ -167,6 +389,17 @@ def pytest_addoption(parser):
         help="Maximum total number of reruns across the entire test suite. "
         "Once this limit is reached, no further reruns will occur.",
     )
+    group.addoption(
+        "--max-suite-rerun-seconds",
+        action="store",
+        dest="max_suite_rerun_seconds",
+        type=float,
+        default=None,
+        help="Maximum total time (seconds) spent on reruns across the entire "
+        "test suite. A rerun is charged the duration of the failed attempt "
+        "plus its delay. Once this budget is spent, no further reruns will "
+        "occur.",
+    )
 
     arg_type = "string"
     parser.addini("reruns", RERUNS_DESC, type=arg_type)
@@ -176,6 +409,11 @@ def pytest_addoption(parser):
         RERUNS_DELAY_BACKOFF_FACTOR_DESC,
         type=arg_type,
     )
+    parser.addini(
+        "reruns_max_attempt_seconds", RERUNS_MAX_ATTEMPT_SECONDS_DESC, type=arg_type
+    )
+    parser.addini("reruns_deadline", RERUNS_DEADLINE_DESC, type=arg_type)
+    parser.addini("reruns_fixture_budget", RERUNS_FIXTURE_BUDGET_DESC, type=arg_type)
 
 
 def _get_global_reruns(config):
@@ -196,6 +434,58 @@ def check_options(config):
         and config.option.max_suite_reruns < 0
     ):
         raise pytest.UsageError("--max-suite-reruns must be >= 0")
+    if (
+        config.option.max_suite_rerun_seconds is not None
+        and config.option.max_suite_rerun_seconds < 0
+    ):
+        raise pytest.UsageError("--max-suite-rerun-seconds must be >= 0")
+    if (
+        config.option.rerun_match_max_chars is not None
+        and config.option.rerun_match_max_chars < 0
+    ):
+        raise pytest.UsageError("--rerun-match-max-chars must be >= 0")
+    if (
+        config.option.rerun_stop_on_identical is not None
+        and config.option.rerun_stop_on_identical < 2
+    ):
+        raise pytest.UsageError("--rerun-stop-on-identical must be >= 2")
+    if config.option.reruns_adaptive_max < 0:
+        raise pytest.UsageError("--reruns-adaptive-max must be >= 0")
+    threshold = config.option.rerun_circuit_breaker
+    if threshold is not None and not 0 < threshold <= 1:
+        raise pytest.UsageError("--rerun-circuit-breaker must be between 0 and 1")
+    if not 1 <= config.option.rerun_circuit_breaker_window <= MAX_BREAKER_WINDOW:
+        raise pytest.UsageError(
+            f"--rerun-circuit-breaker-window must be between 1 and {MAX_BREAKER_WINDOW}"
+        )
+    for name in (
+        "reruns_max_attempt_seconds",
+        "reruns_deadline",
+        "reruns_fixture_budget",
+    ):
+        value = config.getoption(name)
+        if value is not None and value < 0:
+            option = "--" + name.replace("_", "-")
+            raise pytest.UsageError(f"{option} must be >= 0")
+    for name in ("rerun_isolate", "rerun_fresh_process"):
+        if config.getoption(name) and not hasattr(os, "fork"):
+            option = "--" + name.replace("_", "-")
+            raise pytest.UsageError(f"{option} needs os.fork")
+    if config.option.reruns_scope is not None and config.option.reruns_defer:
+        raise pytest.UsageError("--reruns-scope incompatible with --reruns-defer")
+    if config.option.rerun_snapshot is not None:
+        if not hasattr(os, "fork"):
+            raise pytest.UsageError("--rerun-snapshot needs os.fork")
+        for name in (
+            "reruns_delay_nonblocking",
+            "reruns_defer",
+            "reruns_scope",
+            "reruns_reschedule",
+            "rerun_fresh_process",
+        ):
+            if config.getoption(name):
+                option = "--" + name.replace("_", "-")
+                raise pytest.UsageError(f"--rerun-snapshot incompatible with {option}")
     reruns = config.getoption("force_reruns") or _get_global_reruns(config)
     if not config.getoption("collectonly") and reruns:
         if config.option.usepdb:  # a core option
@@ -206,123 +496,446 @@ def _get_marker(item):
     return item.get_closest_marker("flaky")
 
 
-def get_reruns_count(item):
-    reruns = item.session.config.getoption("force_reruns")
-    if reruns is not None:
-        return reruns
+class RerunPolicy:
+    """The rerun settings of a test item.
 
-    rerun_marker = _get_marker(item)
-    # use the marker as a priority over the global setting.
-    if rerun_marker is not None:
-        if "reruns" in rerun_marker.kwargs:
-            # check for keyword arguments
-            marker_reruns = rerun_marker.kwargs["reruns"]
-        elif len(rerun_marker.args) > 0:
-            # check for arguments
-            marker_reruns = rerun_marker.args[0]
-        else:
-            marker_reruns = 1
+    Policies are resolved once per item at collection time from the ``flaky``
+    marker and the global options, and are shared between all items with the
+    same settings. They are immutable, as any number of items may refer to the
+    same instance.
+    """
 
-        if item.session.config.getoption("reruns_mode") == "append":
-            global_reruns = _get_global_reruns(item.session.config)
-            if global_reruns is not None:
-                return marker_reruns + global_reruns
-        return marker_reruns
+    __slots__ = (
+        "condition",
+        "deadline",
+        "delay",
+        "delay_backoff_factor",
+        "excluded",
+        "isolate",
+        "max_attempt_seconds",
+        "only_rerun",
+        "pure_condition",
+        "rerun_except",
+        "reruns",
+    )
 
-    return _get_global_reruns(item.session.config)
+    def __init__(
+        self,
+        reruns,
+        delay=0,
+        delay_backoff_factor=1.0,
+        condition=True,
+        only_rerun=None,
+        rerun_except=None,
+        excluded=False,
+        pure_condition=False,
+        max_attempt_seconds=None,
+        deadline=None,
+        isolate=False,
+    ):
+        set_ = object.__setattr__
+        set_(self, "reruns", reruns)
+        set_(self, "delay", delay)
+        set_(self, "delay_backoff_factor", delay_backoff_factor)
+        set_(self, "condition", condition)
+        set_(self, "only_rerun", only_rerun)
+        set_(self, "rerun_except", rerun_except)
+        set_(self, "excluded", excluded)
+        set_(self, "pure_condition", pure_condition)
+        set_(self, "max_attempt_seconds", max_attempt_seconds)
+        set_(self, "deadline", deadline)
+        set_(self, "isolate", isolate)
+
+    def replace(self, **changes):
+        """Return a copy of the policy with some settings changed."""
+        settings = {name: getattr(self, name) for name in self.__slots__}
+        settings.update(changes)
+        return type(self)(**settings)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+_rerun_policy_key = pytest.StashKey[RerunPolicy]()
+_policy_cache_key = pytest.StashKey[dict[Any, RerunPolicy]]()
+_excluded_paths_cache_key = pytest.StashKey[dict[Any, bool]]()
+_test_id_key = pytest.StashKey[int]()
+_adapted_reruns_key = pytest.StashKey[list[tuple[str, int, int]]]()
+_history_cutoff_key = pytest.StashKey[float]()
+# the failed setups of every higher-scoped fixture in the current instance of
+# its scope, as fixture definition -> (scope node, failures)
+_fixture_failures_key = pytest.StashKey[dict[Any, tuple[Any, int]]]()
+
+
+def _freeze(value):
+    """Return a hashable stand-in for a marker argument.
+
+    The type is part of the key, so that e.g. ``reruns=True`` and ``reruns=1``
+    are validated separately.
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return type(value), tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return dict, tuple((k, _freeze(v)) for k, v in value.items())
+    return type(value), value
 
 
-def get_reruns_delay(item):
-    rerun_marker = _get_marker(item)
-
-    if rerun_marker is not None:
-        if "reruns_delay" in rerun_marker.kwargs:
-            delay = rerun_marker.kwargs["reruns_delay"]
-        elif len(rerun_marker.args) > 1:
-            # check for arguments
-            delay = rerun_marker.args[1]
-        else:
-            delay = 0
-    else:
-        delay = item.session.config.getoption("reruns_delay")
-        if delay is None:
-            try:
-                delay = float(item.session.config.getini("reruns_delay"))
-            except (TypeError, ValueError):
-                delay = 0
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
-    if delay < 0:
-        delay = 0
+
+def _warn_invalid(name, value, expected, default):
+    warnings.warn(
+        f"Invalid {name} {value!r} in flaky marker, expected {expected}. "
+        f"Using default value: {default}"
+    )
+
+
+def _normalize_rerun_filter(name, value):
+    if value is None or isinstance(value, str):
+        return None if value is None else (value,)
+    if isinstance(value, type) and issubclass(value, BaseException):
+        return (value,)
+    try:
+        entries = tuple(value)
+    except TypeError:
+        entries = None
+    if entries is None or not all(
+        isinstance(entry, str)
+        or (isinstance(entry, type) and issubclass(entry, BaseException))
+        for entry in entries
+    ):
         warnings.warn(
-            "Delay time between re-runs cannot be < 0. Using default value: 0"
+            f"Invalid {name} {value!r} in flaky marker, expected a regex string, "
+            "an exception class or a list of those. Ignoring it."
         )
+        return None
+    return entries
 
-    return delay
 
+def _get_global_float(config, name, default):
+    value = config.getoption(name)
+    if value is None:
+        try:
+            value = float(config.getini(name))
+        except (TypeError, ValueError):
+            value = default
+    return value
+
+
+def _get_time_limit(config, kwargs, name, option_name):
+    """Return a per-test time limit in seconds, or None for no limit."""
+    if name in kwargs:
+        value = kwargs[name]
+        if value is not None and (not _is_number(value) or value < 0):
+            _warn_invalid(name, value, "a number >= 0", None)
+            value = None
+        return value
+    value = config.getoption(option_name)
+    if value is None:
+        with suppress(TypeError, ValueError):
+            value = float(config.getini(option_name))
+    return value
+
+
+def _build_policy(config, marker, excluded):
+    """Resolve and validate the rerun settings of one marker/exclusion pair."""
+    only_rerun = config.getoption("only_rerun")
+    rerun_except = config.getoption("rerun_except")
+    kwargs = {} if marker is None else marker.kwargs
+    max_attempt_seconds = _get_time_limit(
+        config, kwargs, "max_attempt_seconds", "reruns_max_attempt_seconds"
+    )
+    deadline = _get_time_limit(config, kwargs, "deadline", "reruns_deadline")
+    # without os.fork, the tests selected with the marker run in process
+    isolate = bool(kwargs.get("isolate", config.option.rerun_isolate))
+    isolate = isolate and hasattr(os, "fork")
+    condition = True
+    pure_condition = False
 
-def get_reruns_delay_backoff_factor(item):
-    rerun_marker = _get_marker(item)
-
-    if rerun_marker is not None:
-        if "reruns_delay_backoff_factor" in rerun_marker.kwargs:
-            factor = rerun_marker.kwargs["reruns_delay_backoff_factor"]
-        elif len(rerun_marker.args) > 2:
-            # check for arguments
-            factor = rerun_marker.args[2]
+    if marker is None:
+        reruns = _get_global_reruns(config)
+        delay = _get_global_float(config, "reruns_delay", 0)
+        factor = _get_global_float(config, "reruns_delay_backoff_factor", 1.0)
+    else:
+        kwargs = marker.kwargs
+        if "reruns" in kwargs:
+            reruns = kwargs["reruns"]
+        elif len(marker.args) > 0:
+            reruns = marker.args[0]
+        else:
+            reruns = 1
+        if not isinstance(reruns, int) or isinstance(reruns, bool):
+            _warn_invalid("reruns", reruns, "an integer", 1)
+            reruns = 1
+        if config.getoption("reruns_mode") == "append":
+            global_reruns = _get_global_reruns(config)
+            if global_reruns is not None:
+                reruns += global_reruns
+
+        if "reruns_delay" in kwargs:
+            delay = kwargs["reruns_delay"]
+        elif len(marker.args) > 1:
+            delay = marker.args[1]
+        else:
+            delay = 0
+        if not _is_number(delay):
+            _warn_invalid("reruns_delay", delay, "a number", 0)
+            delay = 0
+
+        if "reruns_delay_backoff_factor" in kwargs:
+            factor = kwargs["reruns_delay_backoff_factor"]
+        elif len(marker.args) > 2:
+            factor = marker.args[2]
         else:
             factor = 1.0
-    else:
-        factor = item.session.config.getoption("reruns_delay_backoff_factor")
-        if factor is None:
-            try:
-                factor = float(
-                    item.session.config.getini("reruns_delay_backoff_factor")
-                )
-            except (TypeError, ValueError):
-                factor = 1.0
+        if not _is_number(factor):
+            _warn_invalid("reruns_delay_backoff_factor", factor, "a number", 1.0)
+            factor = 1.0
+
+        if "condition" in kwargs:
+            condition = kwargs["condition"]
+        pure_condition = bool(kwargs.get("pure_condition", False))
+        if "only_rerun" in kwargs:
+            only_rerun = _normalize_rerun_filter("only_rerun", kwargs["only_rerun"])
+        if "rerun_except" in kwargs:
+            rerun_except = _normalize_rerun_filter(
+                "rerun_except", kwargs["rerun_except"]
+            )
+
+    force_reruns = config.getoption("force_reruns")
+    if force_reruns is not None:
+        reruns = force_reruns
 
+    if delay < 0:
+        delay = 0
+        warnings.warn(
+            "Delay time between re-runs cannot be < 0. Using default value: 0"
+        )
     if factor < 0:
         factor = 1.0
         warnings.warn(
             "Rerun delay backoff factor cannot be < 0. Using default value: 1.0"
         )
 
-    return factor
+    return RerunPolicy(
+        reruns=reruns,
+        delay=delay,
+        delay_backoff_factor=factor,
+        condition=condition,
+        only_rerun=tuple(only_rerun) if only_rerun else None,
+        rerun_except=tuple(rerun_except) if rerun_except else None,
+        excluded=excluded,
+        pure_condition=pure_condition,
+        max_attempt_seconds=max_attempt_seconds,
+        deadline=deadline,
+        isolate=isolate,
+    )
+
+
+def _is_rerun_path_excluded(item):
+    excluded_paths = item.config.getoption("rerun_exclude_path")
+    if not excluded_paths:
+        return False
+
+    cache = item.config.stash.setdefault(_excluded_paths_cache_key, {})
+    try:
+        return cache[item.path]
+    except KeyError:
+        pass
+    excluded = cache[item.path] = any(
+        item.path.is_relative_to(item.config.rootpath / excluded_path)
+        for excluded_path in excluded_paths
+    )
+    return excluded
+
+
+def _resolve_policy(item):
+    """Return the policy for ``item``, sharing instances with equal settings."""
+    config = item.config
+    marker = _get_marker(item)
+    excluded = _is_rerun_path_excluded(item)
+    if marker is None:
+        key = (None, excluded)
+    else:
+        key = (_freeze(marker.args), _freeze(marker.kwargs), excluded)
+    cache = config.stash.setdefault(_policy_cache_key, {})
+    try:
+        return cache[key]
+    except KeyError:
+        policy = _build_policy(config, marker, excluded)
+        cache[key] = policy
+    except TypeError:
+        # marker arguments which cannot be hashed, the policy is not shared
+        policy = _build_policy(config, marker, excluded)
+    return policy
+
+
+ADAPTIVE_CACHE_KEY = "rerunfailures/adaptive"
+# a test passing at the first attempt in that many recent runs is not rerun
+ADAPTIVE_MIN_CLEAN_RUNS = 3
+# recorded instead of the number of reruns a test needed to pass
+ADAPTIVE_FAILED_AFTER_RERUNS = -1
+ADAPTIVE_FAILED_WITHOUT_RERUNS = -2
+
+
+def _get_adaptive_reruns(history, configured, maximum):
+    """Return the rerun count of a test from the outcomes of its recent runs.
+
+    A run is recorded as the number of reruns the test needed to pass, or as
+    one of the ``ADAPTIVE_FAILED_*`` values.
+    """
+    needed = [reruns for reruns in history if reruns > 0]
+    exhausted = ADAPTIVE_FAILED_AFTER_RERUNS in history
+    if needed:
+        # the test is flaky, if it also failed after all reruns it may need
+        # more than it ever got
+        return maximum if exhausted else min(max(needed) + 1, maximum)
+    clean = [index for index, reruns in enumerate(history) if reruns == 0]
+    since_clean = history[clean[-1] + 1 :] if clean else []
+    if (
+        ADAPTIVE_FAILED_WITHOUT_RERUNS in since_clean
+        and ADAPTIVE_FAILED_AFTER_RERUNS not in since_clean
+    ):
+        # a test classified as stable failed without reruns since its last
+        # clean run, it gets reruns again to find out whether it turned flaky
+        return configured
+    if exhausted or history.count(0) >= ADAPTIVE_MIN_CLEAN_RUNS:
+        # reruns do not pay off for deterministic failures or stable tests
+        return 0
+    return configured
+
+
+def _adapt_policy(config, policy, history):
+    """Return the policy with the rerun count derived from ``history``."""
+    reruns = _get_adaptive_reruns(
+        history, policy.reruns, config.option.reruns_adaptive_max
+    )
+    if reruns == policy.reruns:
+        return policy
+    cache = config.stash.setdefault(_policy_cache_key, {})
+    key = ("adaptive", policy, reruns)
+    try:
+        return cache[key]
+    except KeyError:
+        adapted = cache[key] = policy.replace(reruns=reruns)
+        return adapted
+
+
+def _get_policy(item):
+    """Return the rerun policy of ``item``.
+
+    Normally resolved in ``pytest_collection_modifyitems``; items which did not
+    go through collection get their policy resolved on first use.
+    """
+    try:
+        return item.stash[_rerun_policy_key]
+    except KeyError:
+        policy = item.stash[_rerun_policy_key] = _resolve_policy(item)
+        return policy
+
+
+def get_reruns_count(item):
+    return _get_policy(item).reruns
+
+
+def get_reruns_delay(item):
+    return _get_policy(item).delay
+
+
+def get_reruns_delay_backoff_factor(item):
+    return _get_policy(item).delay_backoff_factor
 
 
 def get_reruns_condition(item):
-    rerun_marker = _get_marker(item)
+    policy = _get_policy(item)
+    condition = policy.condition
+    if condition is True:
+        return condition
 
-    condition = True
-    if rerun_marker is not None and "condition" in rerun_marker.kwargs:
-        condition = evaluate_condition(
-            item, rerun_marker, rerun_marker.kwargs["condition"]
-        )
+    if policy.pure_condition:
+        try:
+            return item.stash[_condition_result_key]
+        except KeyError:
+            pass
+    result = _evaluate_condition(item, "flaky", condition)
+    if policy.pure_condition:
+        item.stash[_condition_result_key] = result
+    return result
 
-    return condition
 
+_condition_result_key = pytest.StashKey[Any]()
+_condition_namespace_key = pytest.StashKey[dict[str, Any]]()
 
-def evaluate_condition(item, mark, condition: object) -> bool:
-    # copy from python3.8 _pytest.skipping.py
 
-    result = False
-    # String condition.
-    if isinstance(condition, str):
-        globals_ = {
+@functools.lru_cache(maxsize=256)
+def _compile_condition(condition, filename):
+    """Compile a string condition.
+
+    Returns the code object and whether it contains nested scopes (lambdas,
+    comprehensions), which look names up in the globals only.
+    """
+    code = compile(condition, filename, "eval")
+    nested = any(isinstance(const, type(code)) for const in code.co_consts)
+    return code, nested
+
+
+def _get_condition_namespace(config):
+    try:
+        return config.stash[_condition_namespace_key]
+    except KeyError:
+        namespace = config.stash[_condition_namespace_key] = {
             "os": os,
             "sys": sys,
             "platform": platform,
-            "config": item.config,
+            "config": config,
         }
-        if hasattr(item, "obj"):
-            globals_.update(item.obj.__globals__)  # type: ignore[attr-defined]
+        return namespace
+
+
+def _eval_condition_code(item, code, nested):
+    namespace = _get_condition_namespace(item.config)
+    if not hasattr(item, "obj"):
+        return eval(code, dict(namespace))  # noqa: S307
+
+    module_globals = item.obj.__globals__  # type: ignore[attr-defined]
+    if nested:
+        # nested scopes only see the globals, which therefore have to hold
+        # the whole namespace
+        globals_ = dict(namespace)
+        globals_.update(module_globals)
+        return eval(code, globals_)  # noqa: S307
+    # Top-level names are looked up in the locals first, so the module is
+    # searched without copying it; the empty dict takes assignment expressions.
+    locals_ = ChainMap({}, module_globals, namespace)
+    return eval(code, module_globals, locals_)  # noqa: S307
+
+
+def evaluate_condition(item, mark, condition: object) -> bool:
+    return _evaluate_condition(item, mark.name, condition)
+
+
+def _evaluate_condition(item, name: str, condition: object) -> bool:
+    # copy from python3.8 _pytest.skipping.py, given the name of the marker
+    # instead of the marker, which is not looked up for every evaluation
+
+    result = False
+    # String condition.
+    if isinstance(condition, str):
         try:
-            filename = f"<{mark.name} condition>"
-            condition_code = compile(condition, filename, "eval")
-            result = eval(condition_code, globals_)  # noqa: S307
+            filename = f"<{name} condition>"
+            condition_code, nested = _compile_condition(condition, filename)
+            result = _eval_condition_code(item, condition_code, nested)
         except SyntaxError as exc:
             msglines = [
-                f"Error evaluating {mark.name!r} condition",
+                f"Error evaluating {name!r} condition",
                 "    " + condition,
                 "    " + " " * (exc.offset or 0) + "^",
                 "SyntaxError: invalid syntax",
@@ -330,19 +943,30 @@ def evaluate_condition(item, mark, condition: object) -> bool:
             fail("\n".join(msglines), pytrace=False)
         except Exception as exc:
             msglines = [
-                f"Error evaluating {mark.name!r} condition",
+                f"Error evaluating {name!r} condition",
                 "    " + condition,
                 *traceback.format_exception_only(type(exc), exc),
             ]
             fail("\n".join(msglines), pytrace=False)
 
+    # Callable condition.
+    elif callable(condition):
+        try:
+            result = bool(condition())
+        except Exception as exc:
+            msglines = [
+                f"Error evaluating {name!r} condition",
+                *traceback.format_exception_only(type(exc), exc),
+            ]
+            fail("\n".join(msglines), pytrace=False)
+
     # Boolean condition.
     else:
         try:
             result = bool(condition)
         except Exception as exc:
             msglines = [
-                f"Error evaluating {mark.name!r} condition as a boolean",
+                f"Error evaluating {name!r} condition as a boolean",
                 *traceback.format_exception_only(type(exc), exc),
             ]
             fail("\n".join(msglines), pytrace=False)
@@ -486,134 +1110,542 @@ def _get_num_failed_subtests(item, report):
 
 
 def _get_rerun_filter_regex(item, regex_name):
-    rerun_marker = _get_marker(item)
+    return getattr(_get_policy(item), regex_name)
 
-    if rerun_marker is not None and regex_name in rerun_marker.kwargs:
-        regex = rerun_marker.kwargs[regex_name]
-        if isinstance(regex, str):
-            regex = [regex]
-    else:
-        regex = getattr(item.session.config.option, regex_name)
 
-    return regex
+class _ErrorPatterns:
+    """The compiled entries of an ``only_rerun`` or ``rerun_except`` list.
+
+    Note: the patterns are deliberately not merged into a single alternation,
+    as that disables the literal prefix scan of the ``re`` module and is
+    slower on long messages than searching with each pattern in turn.
+    """
+
+    __slots__ = ("classes", "regexes")
 
+    def __init__(self, entries):
+        classes = set()
+        regexes = []
+        for entry in entries:
+            if isinstance(entry, type) and issubclass(entry, BaseException):
+                classes.add(entry)
+            else:
+                regexes.append(re.compile(entry))
+        self.classes = tuple(classes)
+        self.regexes = tuple(regexes)
+
+    def matches_type(self, exc_type):
+        return bool(self.classes) and _is_subclass(exc_type, self.classes)
+
+
+@functools.lru_cache(maxsize=256)
+def _is_subclass(exc_type, classes):
+    # issubclass honours the virtual subclasses of the ABCs, which are not in
+    # the MRO; the result is cached as the same errors are raised repeatedly
+    return issubclass(exc_type, classes)
 
-def _matches_any_rerun_error(rerun_errors, excinfo):
-    return _try_match_error(rerun_errors, excinfo)
 
+class _ErrorMatcher:
+    """Decide whether a failure is excluded from reruns by the error filters."""
 
-def _matches_any_rerun_except_error(rerun_except_errors, excinfo):
-    return _try_match_error(rerun_except_errors, excinfo)
+    __slots__ = ("only_rerun", "rerun_except")
 
+    def __init__(self, only_rerun, rerun_except):
+        self.only_rerun = _ErrorPatterns(only_rerun) if only_rerun else None
+        self.rerun_except = _ErrorPatterns(rerun_except) if rerun_except else None
 
-def _try_match_error(rerun_errors, excinfo):
-    if excinfo:
-        err = f"{excinfo.type.__name__}: {excinfo.value}"
-        for rerun_error in rerun_errors:
-            if isinstance(rerun_error, type) and issubclass(rerun_error, BaseException):
-                if issubclass(excinfo.type, rerun_error):
-                    return True
-            elif re.search(rerun_error, err):
+    def should_hard_fail(self, excinfo, max_chars=None):
+        error = None
+
+        def matches(patterns):
+            nonlocal error
+            if not excinfo:
+                return False
+            if patterns.matches_type(excinfo.type):
                 return True
-    return False
+            if not patterns.regexes:
+                return False
+            if error is None:
+                # rendered at most once, even if both lists have to be searched
+                error = f"{excinfo.type.__name__}: {excinfo.value}"
+                if max_chars is not None:
+                    error = error[:max_chars]
+            return any(regex.search(error) for regex in patterns.regexes)
+
+        if self.only_rerun is None:
+            # Using --rerun-except but not --only-rerun
+            return matches(self.rerun_except)
+        elif self.rerun_except is None:
+            # Using --only-rerun but not --rerun-except
+            return not matches(self.only_rerun)
+        else:
+            # Using both --only-rerun and --rerun-except
+            return not matches(self.only_rerun) or matches(self.rerun_except)
+
+
+@functools.lru_cache(maxsize=128)
+def _get_error_matcher(only_rerun, rerun_except):
+    return _ErrorMatcher(only_rerun, rerun_except)
 
 
 def _should_hard_fail_on_error(item, report, excinfo):
     if report.outcome != "failed":
         return False
 
-    rerun_errors = _get_rerun_filter_regex(item, "only_rerun")
-    rerun_except_errors = _get_rerun_filter_regex(item, "rerun_except")
-
-    if (not rerun_errors) and (not rerun_except_errors):
+    policy = _get_policy(item)
+    if not policy.only_rerun and not policy.rerun_except:
         # Using neither --only-rerun nor --rerun-except
         return False
 
-    elif rerun_errors and (not rerun_except_errors):
-        # Using --only-rerun but not --rerun-except
-        return not _matches_any_rerun_error(rerun_errors, excinfo)
+    matcher = _get_error_matcher(policy.only_rerun, policy.rerun_except)
+    return matcher.should_hard_fail(
+        excinfo, item.config.getoption("rerun_match_max_chars")
+    )
 
-    elif (not rerun_errors) and rerun_except_errors:
-        # Using --rerun-except but not --only-rerun
-        return _matches_any_rerun_except_error(rerun_except_errors, excinfo)
 
-    else:
-        # Using both --only-rerun and --rerun-except
-        matches_rerun_only = _matches_any_rerun_error(rerun_errors, excinfo)
-        matches_rerun_except = _matches_any_rerun_except_error(
-            rerun_except_errors, excinfo
-        )
-        return (not matches_rerun_only) or matches_rerun_except
+# numbers and hexadecimal addresses, which differ between attempts failing
+# for the same reason, e.g. timings, ports and object reprs
+_VOLATILE_PATTERN = re.compile(r"0x[0-9a-fA-F]+|\d+")
 
 
-def _should_not_rerun(item, report, reruns):
-    xfail = hasattr(report, "wasxfail")
-    is_terminal_error = any(item._terminal_errors.values())
-    condition = get_reruns_condition(item)
-    has_failed_subtests = (
-        report.when == "call" and _get_num_failed_subtests(item, report) > 0
-    )
+def _get_crash_signature(report):
+    """Return the crash location and masked message of a report, or None."""
+    crash = getattr(report.longrepr, "reprcrash", None)
+    if crash is None:
+        return None
+    return crash.path, crash.lineno, _VOLATILE_PATTERN.sub("#", crash.message)
 
-    return (
-        item.execution_count > reruns
-        or (not report.failed and not has_failed_subtests)
-        or xfail
-        or is_terminal_error
-        or not condition
-    )
 
+def _get_failure_signature(excinfo, report):
+    """Return what identifies the failure of an attempt, or None."""
+    crash = _get_crash_signature(report)
+    if excinfo is None or crash is None:
+        return None
+    exc_type = excinfo.type
+    return (f"{exc_type.__module__}.{exc_type.__qualname__}", *crash)
 
-def is_master(config):
-    return not (hasattr(config, "workerinput") or hasattr(config, "slaveinput"))
 
+def _get_fixture_budget(config):
+    """Return how often a failed higher-scoped fixture is set up again, or None."""
+    budget = config.getoption("reruns_fixture_budget")
+    if budget is None:
+        with suppress(TypeError, ValueError):
+            budget = int(config.getini("reruns_fixture_budget"))
+    return budget
 
-def pytest_configure(config):
+
+def _get_spent_fixture(item):
+    """Return the failed fixture of the item whose retry budget is spent.
+
+    Returns (fixture definition, failures) or None. The failures are counted
+    by ``RerunHooks.pytest_fixture_setup``.
+    """
+    budget = _get_fixture_budget(item.config)
+    failures = item.config.stash.get(_fixture_failures_key, None)
+    if budget is None or not failures:
+        return None
+    fixture_info = getattr(item, "_fixtureinfo", None)
+    for fixture_defs in getattr(fixture_info, "name2fixturedefs", {}).values():
+        for fixture_def in fixture_defs:
+            cached_result = getattr(fixture_def, "cached_result", None)
+            if cached_result is None or not cached_result[2]:
+                continue
+            # a cached error is the one of the last failure, which was in the
+            # current instance of the scope
+            _, count = failures.get(fixture_def, (None, 0))
+            if count > budget:
+                return fixture_def, count
+    return None
+
+
+def _repeats_failure(item):
+    """Return whether the last attempts failed the same way often enough."""
+    limit = item.config.option.rerun_stop_on_identical
+    return limit is not None and item._identical_failures >= limit
+
+
+def _get_rerun_stop_reason(item):
+    """Return why a rerun the policy allows is not started, or None."""
+    if _repeats_failure(item):
+        return f"same failure on {item._identical_failures} consecutive attempts"
+    spent = getattr(item, "_spent_fixture", None)
+    if spent is not None:
+        fixture_def, count = spent
+        times = "once" if count == 1 else f"{count} times"
+        return (
+            f"fixture {fixture_def.argname!r} failed {times} "
+            f"for this {fixture_def.scope}"
+        )
+    if _session_aborts(item.session):
+        return "the session is stopping"
+    return _get_open_circuit_reason(item.config)
+
+
+def _record_attempt(item, report):
+    """Feed the outcome of an attempt to the circuit breaker once it ended."""
+    if report.when == "setup":
+        item._attempt_failed = report.failed
+    else:
+        item._attempt_failed = item._attempt_failed or report.failed
+    if report.when == "teardown":
+        item.config.failures_db.record_test_outcome(
+            item._attempt_failed, item.config.option.rerun_circuit_breaker_window
+        )
+
+
+def _get_open_circuit_reason(config):
+    """Return why the circuit breaker stops reruns, or None if it does not."""
+    threshold = config.option.rerun_circuit_breaker
+    if threshold is None:
+        return None
+    window = config.option.rerun_circuit_breaker_window
+    failures, attempts = config.failures_db.get_window_failures()
+    # the rate is only meaningful once the window is full
+    if attempts < window or failures < threshold * window:
+        return None
+    return f"circuit breaker open, {failures} of the last {attempts} attempts failed"
+
+
+def _session_aborts(session):
+    """Return whether the session stops after the current item, e.g. --maxfail."""
+    return bool(session.shouldfail or session.shouldstop)
+
+
+def _get_rerun_scope_node(item):
+    """Return the node whose failed tests --reruns-scope reruns as a group."""
+    node = None
+    if item.config.option.reruns_scope == "class":
+        node = item.getparent(pytest.Class)
+    # tests outside of a class are grouped by their module
+    return node or item.getparent(pytest.Module) or item.parent
+
+
+def _ends_rerun_scope(item, nextitem):
+    """Return whether the next item is outside of the --reruns-scope of the item."""
+    return _get_rerun_scope_node(nextitem) is not _get_rerun_scope_node(item)
+
+
+def _teardown_rerun_scope(item):
+    """Tear down the --reruns-scope node of the last item of the session.
+
+    The item kept it for the reruns of its group, which share a fresh setup
+    of it as after the other scopes. Only a failed teardown is logged.
+    """
+    scope = _get_rerun_scope_node(item)
+    # keeps the collectors the scope descends from, e.g. the session
+    call = pytest.CallInfo.from_call(
+        lambda: item.session._setupstate.teardown_exact(scope.parent), "teardown"
+    )
+    if call.excinfo is not None:
+        report = item.ihook.pytest_runtest_makereport(item=item, call=call)
+        report.rerun = getattr(item, "execution_count", 1) - 1
+        item.ihook.pytest_runtest_logstart(nodeid=item.nodeid, location=item.location)
+        item.ihook.pytest_runtest_logreport(report=report)
+        item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
+
+
+def _exceeds_time_limits(item, policy):
+    """Return whether rerunning the item would exceed its time limits.
+
+    The duration of the current attempt is the sum of its reports so far,
+    see ``RerunHooks.pytest_runtest_makereport``.
+    """
+    attempt = item._attempt_duration
+    if policy.max_attempt_seconds is not None and attempt > policy.max_attempt_seconds:
+        return True
+    if policy.deadline is not None:
+        elapsed = item._rerun_elapsed + attempt + _get_rerun_delay(item, policy)
+        return elapsed > policy.deadline
+    return False
+
+
+def _should_not_rerun(item, report, reruns):
+    xfail = hasattr(report, "wasxfail")
+    is_terminal_error = any(item._terminal_errors.values())
+    condition = get_reruns_condition(item)
+    has_failed_subtests = (
+        report.when == "call" and _get_num_failed_subtests(item, report) > 0
+    )
+
+    return (
+        item.execution_count > reruns
+        or (not report.failed and not has_failed_subtests)
+        or xfail
+        or is_terminal_error
+        or not condition
+        or _exceeds_time_limits(item, _get_policy(item))
+    )
+
+
+def is_master(config):
+    return not (hasattr(config, "workerinput") or hasattr(config, "slaveinput"))
+
+
+def pytest_configure(config):
     # add flaky marker
     config.addinivalue_line(
         "markers",
-        "flaky(reruns=1, reruns_delay=0, reruns_delay_backoff_factor=1.0): mark "
-        "test to re-run up to 'reruns' times. Add a delay of 'reruns_delay' "
-        "seconds between re-runs, multiplied by 'reruns_delay_backoff_factor' "
-        "after each attempt for an exponential backoff.",
+        "flaky(reruns=1, reruns_delay=0, reruns_delay_backoff_factor=1.0, "
+        "max_attempt_seconds=None, deadline=None, isolate=False): mark test to "
+        "re-run up to 'reruns' times. Add a delay of 'reruns_delay' seconds "
+        "between re-runs, multiplied by 'reruns_delay_backoff_factor' after each "
+        "attempt for an exponential backoff. Do not re-run after an attempt "
+        "slower than 'max_attempt_seconds', or once the attempts and delays "
+        "would exceed 'deadline' seconds. Run the attempts in a forked child "
+        "process with 'isolate'.",
     )
     check_options(config)
 
     if config.pluginmanager.hasplugin("xdist") and HAS_PYTEST_HANDLECRASHITEM:
         config.pluginmanager.register(XDistHooks())
         if is_master(config):
-            config.failures_db = ServerStatusDB()
+            # replaced once xdist spawns workers, runs without workers do not
+            # need to share the counters
+            config.failures_db = StatusDB()
+        elif "status_db_path" in config.workerinput:
+            config.failures_db = SharedStatusDB(config.workerinput["status_db_path"])
         else:
             config.failures_db = ClientStatusDB(config.workerinput["sock_port"])
     else:
         config.failures_db = StatusDB()  # no-op db
 
+    if config.option.reruns_adaptive and is_master(config):
+        if getattr(config, "cache", None) is None:
+            raise pytest.UsageError("--reruns-adaptive needs the cacheprovider plugin")
+        if not config.option.collectonly:
+            config.pluginmanager.register(AdaptiveReruns(), ADAPTIVE_RERUNS_NAME)
+
+    if config.option.rerun_flaky_first:
+        _get_history_path(config)  # fail early without the cache
+        workerinput = getattr(config, "workerinput", {})
+        config.stash[_history_cutoff_key] = workerinput.get(
+            "rerun_history_cutoff", time.time()
+        )
+
+    if config.option.rerun_history and not config.option.collectonly:
+        config.pluginmanager.register(
+            RerunHistory(_get_history_path(config), _get_run_id(config)),
+            RERUN_HISTORY_NAME,
+        )
+
+
+# the pytest-xdist releases whose controller internals _XDistController uses
+XDIST_CONTROLLER_VERSIONS = (parse_version("3.0"), parse_version("4.0"))
+
+
+class _XDistController:
+    """The private internals of the pytest-xdist controller the held reruns use.
+
+    ``DSession.loop_once`` calls the ``worker_<name>`` method of the session
+    for an event ``(name, kwargs)`` taken from its queue, and the session
+    shuts a node down with ``WorkerController.shutdown`` once its scheduler
+    has no tests left for it.
+    """
+
+    # the event queued once a held rerun is due
+    due_event = "rerun_due"
+
+    def __init__(self, dsession):
+        self.dsession = dsession
+
+    @classmethod
+    def get(cls, config):
+        """Return the controller of the session, or None if it differs."""
+        try:
+            version = parse_version(importlib.metadata.version("pytest-xdist"))
+        except importlib.metadata.PackageNotFoundError:
+            return None
+        low, high = XDIST_CONTROLLER_VERSIONS
+        if not low <= version < high:
+            return None
+        dsession = config.pluginmanager.getplugin("dsession")
+        if not all(
+            hasattr(dsession, name)
+            for name in ("loop_once", "queue", "sched", "shuttingdown")
+        ):
+            return None
+        return cls(dsession)
+
+    @property
+    def sched(self):
+        return self.dsession.sched
+
+    @property
+    def shouldstop(self):
+        # set once the session starts
+        return getattr(self.dsession, "shouldstop", False)
+
+    @property
+    def shuttingdown(self):
+        return self.dsession.shuttingdown
+
+    def on_due(self, callback):
+        """Call ``callback`` in the loop of the session for the due events."""
+        setattr(self.dsession, f"worker_{self.due_event}", callback)
+
+    def queue_due(self, delay):
+        """Queue a due event for the loop of the session after ``delay``."""
+        timer = threading.Timer(delay, self.dsession.queue.put, ((self.due_event, {}),))
+        timer.daemon = True
+        timer.start()
+
+    def send_test(self, nodes, index):
+        """Send a test to the least busy of ``nodes``; return False if it cannot.
+
+        The scheduler only hands its pending tests to the next node asking
+        for tests, so the test is added to the tests of the node as
+        ``LoadScheduling`` does, and the node completing it finds it there.
+        """
+        node2pending = getattr(self.sched, "node2pending", None)
+        if node2pending is None or index is None:
+            return False
+        node = min(nodes, key=lambda node: len(node2pending[node]))
+        node2pending[node].append(index)
+        node.send_runtest_some([index])
+        return True
+
+    @staticmethod
+    def hold_shutdown(node, shutdown_node):
+        """Call ``shutdown_node(node, shutdown)`` instead of shutting a node down."""
+        node.shutdown = functools.partial(shutdown_node, node, node.shutdown)
+
 
 class XDistHooks:
+    def __init__(self):
+        # the rescheduled reruns the controller holds back until their delay
+        # elapsed, as a heap of (due time, sequence number, report)
+        self.held: list[tuple[float, int, Any]] = []
+        self._held_count = itertools.count()
+        # None if the installed pytest-xdist cannot hold reruns back, which
+        # are then rerun by their worker right away
+        self.controller = None
+
+    def pytest_xdist_setupnodes(self, config, specs):
+        """Create the StatusDB shared with the workers about to be spawned."""
+        self.controller = _XDistController.get(config)
+        if _are_local_specs(specs):
+            # the workers map the counters into their memory
+            config.failures_db = SharedStatusDB()
+        else:
+            config.failures_db = ServerStatusDB()
+
     def pytest_configure_node(self, node):
         """Configure xdist hook for node sock_port."""
-        node.workerinput["sock_port"] = node.config.failures_db.sock_port
+        config = node.config
+        if type(config.failures_db) is StatusDB:
+            config.failures_db = ServerStatusDB()
+        db = config.failures_db
+        if isinstance(db, SharedStatusDB):
+            node.workerinput["status_db_path"] = db.path
+        else:
+            node.workerinput["sock_port"] = db.sock_port
+        if _history_cutoff_key in config.stash:
+            # all workers have to order the tests the same way
+            node.workerinput["rerun_history_cutoff"] = config.stash[_history_cutoff_key]
+        reschedule = _get_reschedule_mode(config)
+        if reschedule is not None:
+            node.workerinput["rerun_reschedule"] = reschedule
+            if self.controller is not None:
+                node.workerinput["rerun_hold"] = True
+                # the node is kept up for the held reruns, see _release_held
+                self.controller.hold_shutdown(node, self._shutdown_node)
+
+    def pytest_unconfigure(self, config):
+        config.failures_db.close()
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_logreport(self, report):
+        """Send the rerun of a test back to the scheduler, see --reruns-reschedule."""
+        node = getattr(report, "node", None)
+        if node is None or not getattr(report, "rerun_rescheduled", False):
+            return
+        config = node.config
+        sched = config.pluginmanager.getplugin("dsession").sched
+        db = config.failures_db
+        # record the failure before rescheduling, so the new failure count is
+        # pushed to the workers ahead of the rescheduled test
+        db.add_test_failure(_get_crashitem_id(sched, report.nodeid))
+        delay = getattr(report, "rerun_delay", 0)
+        if delay > 0 and self.controller is not None and _has_live_node(sched):
+            self._hold_rerun(config, report, delay)
+        elif not _reschedule_test(sched, report.nodeid, node, config, self.controller):
+            _release_reserved_cost(config, report)
+            # changed before the other plugins see the report
+            report.outcome = "failed"
+            report.rerun_stopped = "no worker left to rerun it"
+
+    def _hold_rerun(self, config, report, delay):
+        """Reschedule the rerun of a test once its delay elapsed."""
+        self.controller.on_due(functools.partial(self._release_held, config))
+        due = time.monotonic() + delay
+        heapq.heappush(self.held, (due, next(self._held_count), report))
+        self.controller.queue_due(delay)
+
+    def _release_held(self, config):
+        """Reschedule the held reruns which are due, or cancel them."""
+        controller = self.controller
+        while self.held and (
+            controller.shouldstop or self.held[0][0] <= time.monotonic()
+        ):
+            _, _, report = heapq.heappop(self.held)
+            if controller.shouldstop:
+                reason = "the session is stopping"
+            elif _reschedule_test(
+                controller.sched, report.nodeid, report.node, config, controller
+            ):
+                continue
+            else:
+                reason = "no worker left to rerun it"
+            _release_reserved_cost(config, report)
+            failed = copy.copy(report)
+            failed.outcome = "failed"
+            failed.rerun_rescheduled = False
+            failed.rerun_stopped = reason
+            config.hook.pytest_runtest_logreport(report=failed)
+        if not self.held and controller.shuttingdown:
+            # the shutdown was held back, see _shutdown_node
+            for node in controller.sched.nodes:
+                node.shutdown()
+
+    def _shutdown_node(self, node, shutdown):
+        """Shut a node down unless reruns are held back for the workers."""
+        if self.held:
+            self._release_held(node.config)
+        if not self.held:
+            shutdown()
 
     def pytest_handlecrashitem(self, crashitem, report, sched):
         """Return the crashitem from pending and collection."""
+        test_id = _get_crashitem_id(sched, crashitem)
+        if test_id is None:
+            return
         db = sched.config.failures_db
-        reruns = db.get_test_reruns(crashitem)
+        reruns = db.get_test_reruns(test_id)
+        failures = db.get_test_failures(test_id)
         reserved_suite_rerun = False
-        if db.get_test_failures(crashitem) < reruns:
-            max_suite_reruns = sched.config.option.max_suite_reruns
-            if max_suite_reruns is None:
+        if failures < reruns:
+            max_suite_reruns, max_cost = _get_suite_budget(sched.config)
+            if max_suite_reruns is None and max_cost is None:
                 cap_available = True
             else:
-                reserved_suite_rerun = db.try_increment_suite_reruns(max_suite_reruns)
+                # the crashed attempt is the only estimate of the rerun time
+                cost = _to_milliseconds(getattr(report, "duration", 0))
+                reserved_suite_rerun = db.try_increment_suite_reruns(
+                    max_suite_reruns, cost, max_cost
+                )
                 cap_available = reserved_suite_rerun
         else:
             cap_available = False
+        # record the failure before rescheduling, so the new failure count is
+        # pushed to the workers ahead of the rescheduled test
+        db.add_test_failure(test_id)
         if cap_available:
             try:
                 sched.mark_test_pending(crashitem)
                 report.outcome = "rerun"
             except NotImplementedError:
                 if reserved_suite_rerun:
-                    db.decrement_suite_reruns()
+                    db.decrement_suite_reruns(cost)
                 # Some schedulers (like LoadScopeScheduling) don't implement
                 # mark_test_pending
                 # In this case, we can't reschedule the crashed test for rerun
@@ -625,22 +1657,171 @@ class XDistHooks:
                         f" The scheduler '{sched.__class__.__name__}' does not support"
                         " rescheduling crashed tests"
                         " (mark_test_pending not implemented)."
-                        f" Remaining reruns: {reruns - db.get_test_failures(crashitem)}"
+                        f" Remaining reruns: {reruns - failures}"
                     )
                     report.longrepr = error_msg
 
-        db.add_test_failure(crashitem)
+
+def _has_live_node(sched):
+    """Return whether a node of the scheduler still accepts tests."""
+    return any(not node.shutting_down for node in sched.nodes)
+
+
+def _release_reserved_cost(config, report):
+    """Give back the suite budget reserved for a rerun which does not run."""
+    cost = getattr(report, "rerun_reserved_cost", None)
+    if cost is not None:
+        config.failures_db.decrement_suite_reruns(cost)
+
+
+def _reschedule_test(sched, nodeid, failed_node, config, controller=None):
+    """Make the scheduler run a failed test again; return False if it cannot.
+
+    A node which is shutting down runs no more tests, so a test rescheduled
+    once all nodes are shutting down would never run. Without the
+    controller, a test for another worker goes to any worker.
+    """
+    nodes = [node for node in sched.nodes if not node.shutting_down]
+    if not nodes:
+        return False
+    others = [node for node in nodes if node is not failed_node]
+    if (
+        config.option.reruns_reschedule == "other"
+        and others
+        and controller is not None
+        and controller.send_test(others, _get_crashitem_id(sched, nodeid))
+    ):
+        return True
+    sched.mark_test_pending(nodeid)
+    return True
+
+
+def _get_worker_queue(config):
+    """Return the queue of the tests sent to this xdist worker, or None."""
+    for plugin in config.pluginmanager.get_plugins():
+        torun = getattr(plugin, "torun", None)
+        if hasattr(torun, "lock"):
+            return torun
+    return None
+
+
+def _get_reschedule_mode(config):
+    """Return which reruns the workers hand to the scheduler, or None.
+
+    These are all reruns with --reruns-reschedule, and the delayed ones with
+    --reruns-delay-nonblocking, which the controller holds back until they are
+    due, so any worker can take them.
+    """
+    if config.option.dist not in RESCHEDULE_DIST_MODES:
+        return None
+    if config.option.reruns_reschedule is not None:
+        return "always"
+    if (
+        config.option.reruns_delay_nonblocking
+        and not config.option.reruns_defer
+        and not config.option.reruns_scope
+    ):
+        return "delayed"
+    return None
+
+
+def _can_reschedule_rerun(item, nextitem):
+    """Return whether the rerun of an item is left to the xdist scheduler."""
+    if nextitem is None:
+        # the worker is shutting down, the item is its last one
+        return False
+    workerinput = getattr(item.config, "workerinput", {})
+    mode = workerinput.get("rerun_reschedule")
+    if mode is None or not works_with_current_xdist():
+        return False
+    if _get_rerun_delay(item, _get_policy(item)) > 0:
+        if not workerinput.get("rerun_hold", False):
+            # the controller cannot hold the rerun back until it is due
+            return False
+    elif mode == "delayed":
+        # a rerun without a delay follows right away
+        return False
+    queue = _get_worker_queue(item.config)
+    if queue is None:
+        return False
+    with queue.lock() as entries:
+        # the shutdown marker is the only entry which is not a test index
+        return all(isinstance(entry, int) for entry in entries)
+
+
+def _get_suite_budget(config):
+    """Return the suite rerun cap and the rerun time budget in milliseconds."""
+    seconds = config.option.max_suite_rerun_seconds
+    max_cost = None if seconds is None else _to_milliseconds(seconds)
+    return config.option.max_suite_reruns, max_cost
+
+
+def _to_milliseconds(seconds):
+    return int(seconds * 1000)
+
+
+def _is_suite_budget_spent(config):
+    """Return whether the suite rerun cap or the rerun time budget is reached."""
+    max_suite_reruns, max_cost = _get_suite_budget(config)
+    db = config.failures_db
+    return (
+        max_suite_reruns is not None and db.get_suite_reruns() >= max_suite_reruns
+    ) or (max_cost is not None and db.get_suite_rerun_cost() >= max_cost)
+
+
+def _within_suite_budget(count, cost, max_cap, max_cost):
+    return (max_cap is None or count < max_cap) and (
+        max_cost is None or cost < max_cost
+    )
+
+
+def _are_local_specs(specs):
+    """Return whether all xdist workers are spawned on this host."""
+    if fcntl is None:
+        return False
+    return all(spec.popen and not spec.via for spec in specs)
+
+
+# the collection of the scheduler and the test IDs by node ID it was last
+# indexed into, see _get_crashitem_id
+_test_ids_cache: list[Any] = [None, {}]
+
+
+def _get_crashitem_id(sched, crashitem):
+    """Return the test ID of a crashed test, or None if it is unknown.
+
+    The ID of a test is its index in the collection of the workers, which
+    the scheduler keeps as well.
+    """
+    collection = getattr(sched, "collection", None)
+    if collection is None:
+        # EachScheduling keeps the collection of every worker instead
+        node2collection = getattr(sched, "node2collection", None) or {}
+        collection = next(iter(node2collection.values()), None)
+    if collection is None:
+        return None
+    indexed, test_ids = _test_ids_cache
+    if indexed is not collection:
+        # the scheduler keeps its collection once all workers collected it
+        test_ids = {}
+        for index, nodeid in enumerate(collection):
+            test_ids.setdefault(nodeid, index)
+        _test_ids_cache[:] = [collection, test_ids]
+    return test_ids.get(crashitem)
 
 
 # An in-memory db residing in the master that records
-# the number of reruns (set before test setup)
+# the number of reruns (set after collection)
 # and failures (set after each failure or crash)
 # accessible from both the master and worker
 class StatusDB:
     def __init__(self) -> None:
-        self.delim: bytes = b"\n"
-        self.hmap: dict[str, str] = {}
         self._suite_rerun_count: int = 0
+        # the time charged to the reruns, in milliseconds
+        self._suite_rerun_cost: int = 0
+        # the outcomes of the last attempts, True for failures
+        self._window: deque[bool] = deque()
+        self._window_failures: int = 0
         self._suite_lock = threading.Lock()
 
     def increment_suite_reruns(self) -> int:
@@ -649,19 +1830,29 @@ class StatusDB:
             self._suite_rerun_count += 1
             return self._suite_rerun_count
 
-    def try_increment_suite_reruns(self, max_cap: int) -> bool:
-        """Increment the suite counter when it is below the configured cap."""
+    def try_increment_suite_reruns(
+        self, max_cap: int | None, cost: int = 0, max_cost: int | None = None
+    ) -> bool:
+        """Increment the suite counter when it is below the configured cap.
+
+        ``cost`` milliseconds are charged to the rerun time at the same time,
+        provided the time already charged is below ``max_cost``.
+        """
         with self._suite_lock:
-            if self._suite_rerun_count < max_cap:
+            if _within_suite_budget(
+                self._suite_rerun_count, self._suite_rerun_cost, max_cap, max_cost
+            ):
                 self._suite_rerun_count += 1
+                self._suite_rerun_cost += cost
                 return True
             return False
 
-    def decrement_suite_reruns(self) -> None:
+    def decrement_suite_reruns(self, cost: int = 0) -> None:
         """Release a suite slot when a scheduled rerun cannot be started."""
         with self._suite_lock:
             if self._suite_rerun_count > 0:
                 self._suite_rerun_count -= 1
+                self._suite_rerun_cost = max(self._suite_rerun_cost - cost, 0)
 
     def get_suite_reruns(self) -> int:
         """Return the current suite-wide rerun count.
@@ -671,180 +1862,713 @@ class StatusDB:
         with self._suite_lock:
             return self._suite_rerun_count
 
-    def _hash(self, crashitem: str) -> str:
-        if crashitem not in self.hmap:
-            self.hmap[crashitem] = hashlib.sha1(crashitem.encode()).hexdigest()[:10]  # noqa: S324
+    def get_suite_rerun_cost(self) -> int:
+        """Return the time charged to the reruns, in milliseconds."""
+        with self._suite_lock:
+            return self._suite_rerun_cost
+
+    def record_test_outcome(self, failed: bool, window: int) -> None:
+        """Add the outcome of an attempt to the last ``window`` outcomes."""
+        with self._suite_lock:
+            if len(self._window) >= window:
+                self._window_failures -= self._window.popleft()
+            self._window.append(failed)
+            self._window_failures += failed
 
-        return self.hmap[crashitem]
+    def get_window_failures(self) -> tuple[int, int]:
+        """Return the number of failures and of attempts in the window."""
+        with self._suite_lock:
+            return self._window_failures, len(self._window)
 
-    def add_test_failure(self, crashitem):
-        hash = self._hash(crashitem)
-        failures = self._get(hash, "f")
+    def add_test_failure(self, test_id: int):
+        failures = self._get(test_id, "f")
         failures += 1
-        self._set(hash, "f", failures)
+        self._set(test_id, "f", failures)
+
+    def get_test_failures(self, test_id: int):
+        return self._get(test_id, "f")
 
-    def get_test_failures(self, crashitem):
-        hash = self._hash(crashitem)
-        return self._get(hash, "f")
+    def set_test_reruns(self, test_id: int, reruns):
+        self._set(test_id, "r", reruns)
 
-    def set_test_reruns(self, crashitem, reruns):
-        hash = self._hash(crashitem)
-        self._set(hash, "r", reruns)
+    def get_test_reruns(self, test_id: int):
+        return self._get(test_id, "r")
 
-    def get_test_reruns(self, crashitem):
-        hash = self._hash(crashitem)
-        return self._get(hash, "r")
+    def set_test_reruns_many(self, reruns: array):
+        """Record the rerun counts of all tests, indexed by test ID."""
+        for test_id, count in enumerate(reruns):
+            self.set_test_reruns(test_id, count)
 
-    # i is a hash of the test name, t_f.py::test_t
+    # i is the test ID, the index of the test in the collection
     # k is f for failures or r for reruns
     # v is the number of failures or reruns (an int)
-    def _set(self, i: str, k: str, v: int):
+    def _set(self, i: int, k: str, v: int):
         pass
 
-    def _get(self, i: str, k: str) -> int:
+    def _get(self, i: int, k: str) -> int:
         return 0
 
+    def close(self):
+        pass
+
+
+# Opcodes of the StatusDB wire protocol. Every message is framed as a header
+# holding the payload length and the opcode, followed by the payload.
+OP_SET = 1  # payload: field (1 byte), test ID, value (int64) -> no reply
+OP_GET = 2  # payload: field (1 byte), test ID -> reply with the value
+OP_INC = 3  # no payload -> reply with the new suite rerun count
+OP_TRY_INC = 4  # payload: cap, cost, max cost (int64) -> reply with 1 or 0
+OP_DEC = 5  # payload: cost (int64) -> reply with 1
+OP_SET_MANY = 6  # payload: field (1 byte), column -> reply with its length
+OP_GET_ALL = 7  # payload: field (1 byte) -> reply with the nonzero items
+OP_GET_SUITE = 8  # no payload -> reply with the suite rerun count
+OP_LEN = 9  # payload: field (1 byte) -> reply with the column length
+OP_GET_SUITE_COST = 10  # no payload -> reply with the suite rerun time
+OP_RECORD = 11  # payload: failed (1 byte), window (uint32) -> no reply
+OP_GET_WINDOW = 12  # no payload -> reply with the window failures, attempts
+OP_REPLY = 0x80  # payload: value (int64)
+OP_REPLY_ITEMS = 0x81  # payload: items
+OP_NOTIFY = 0x82  # pushed by the server, payload: field (1 byte), one item
+# the requests a client may send again when their reply was lost, as applying
+# them twice has the same effect as once
+IDEMPOTENT_OPS = frozenset({
+    OP_SET,
+    OP_GET,
+    OP_SET_MANY,
+    OP_GET_ALL,
+    OP_GET_SUITE,
+    OP_LEN,
+    OP_GET_SUITE_COST,
+    OP_GET_WINDOW,
+})
+
+FRAME_HEADER = struct.Struct("!IB")
+INT64 = struct.Struct("!q")
+FIELD_ID = struct.Struct("!cI")
+FIELD_ID_INT64 = struct.Struct("!cIq")
+# a cap of -1 stands for no cap
+TRY_INC = struct.Struct("!qqq")
+RECORD = struct.Struct("!?I")
+WINDOW = struct.Struct("!qq")
+# an item is a test ID and its value
+ITEM = struct.Struct("!Iq")
+# columns hold one int32 per test ID and are sent in network byte order
+COLUMN_TYPECODE = "i"
+COLUMN_MAX = 2**31 - 1
+
+
+def _pack_items(items) -> bytes:
+    """Serialize test ID and value pairs."""
+    return b"".join(ITEM.pack(i, v) for i, v in items)
+
+
+def _unpack_items(payload: bytes, offset: int = 0):
+    """Yield the test ID and value pairs serialized by ``_pack_items``."""
+    return ITEM.iter_unpack(memoryview(payload)[offset:])
+
+
+def _column_to_bytes(column: array) -> bytes:
+    if sys.byteorder == "little":
+        column = array(COLUMN_TYPECODE, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _column_from_bytes(data: bytes) -> array:
+    column = array(COLUMN_TYPECODE)
+    column.frombytes(data)
+    if sys.byteorder == "little":
+        column.byteswap()
+    return column
+
+
+class _FrameReader:
+    """Read length-framed messages from a socket through a buffer."""
+
+    chunk_size = 65536
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buf = bytearray()
+
+    def fill(self):
+        """Receive whatever is available into the buffer."""
+        data = self.conn.recv(self.chunk_size)
+        if not data:
+            raise ConnectionError("connection closed by peer")
+        self.buf += data
+
+    def pop_frame(self):
+        """Return the next buffered message, or None if it is incomplete."""
+        header_size = FRAME_HEADER.size
+        if len(self.buf) < header_size:
+            return None
+        length, op = FRAME_HEADER.unpack_from(self.buf)
+        if len(self.buf) < header_size + length:
+            return None
+        payload = bytes(self.buf[header_size : header_size + length])
+        del self.buf[: header_size + length]
+        return op, payload
+
+    def read_frame(self):
+        """Return the opcode and payload of the next message."""
+        frame = self.pop_frame()
+        while frame is None:
+            self.fill()
+            frame = self.pop_frame()
+        return frame
+
 
 class SocketDB(StatusDB):
-    def __init__(self):
-        super().__init__()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setblocking(1)
+    @staticmethod
+    def _make_socket():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
 
-    def _sock_recv(self, conn) -> str:
-        buf = b""
-        while True:
-            b = conn.recv(1)
-            if b == self.delim:
-                break
-            buf += b
+    def _sock_send(self, conn, op: int, payload: bytes = b""):
+        conn.sendall(FRAME_HEADER.pack(len(payload), op) + payload)
+
+
+class _Connection:
+    """The buffers of a worker connection to the server."""
 
-        return buf.decode()
+    __slots__ = ("events", "outbuf", "reader")
 
-    def _sock_send(self, conn, msg: str):
-        conn.send(msg.encode() + self.delim)
+    def __init__(self, conn):
+        self.reader = _FrameReader(conn)
+        self.outbuf = bytearray()
+        self.events = selectors.EVENT_READ
 
 
 class ServerStatusDB(SocketDB):
     def __init__(self) -> None:
         super().__init__()
+        self.sock = self._make_socket()
         self.sock.bind(("127.0.0.1", 0))
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.listen()
 
-        self.rerunfailures_db: dict[str, dict[str, int]] = {}
-        t = threading.Thread(target=self.run_server, daemon=True)
-        t.start()
+        # the counters of the tests, indexed by test ID
+        self.columns: dict[str, array] = {
+            "f": array(COLUMN_TYPECODE),
+            "r": array(COLUMN_TYPECODE),
+        }
+        # all worker connections are served from a single I/O thread; the
+        # lock guards the output buffers, which the controller thread fills
+        # as well when it pushes failure counts to the workers
+        self._connections: dict[socket.socket, _Connection] = {}
+        self._lock = threading.RLock()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.sock, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._closing = False
+        self._thread = threading.Thread(target=self.run_server, daemon=True)
+        self._thread.start()
 
     @property
     def sock_port(self):
         return self.sock.getsockname()[1]
 
     def run_server(self):
-        self.sock.listen()
-        while True:
+        while not self._closing:
+            for key, events in self._selector.select():
+                if key.fileobj is self.sock:
+                    self._accept()
+                elif key.fileobj is self._wakeup_recv:
+                    self._wakeup()
+                else:
+                    self._serve(key.fileobj, key.data, events)
+
+    def close(self):
+        """Stop the I/O thread and close the sockets."""
+        self._closing = True
+        with suppress(OSError):
+            self._wakeup_send.send(b"\0")
+        self._thread.join()
+        with self._lock:
+            connections, self._connections = list(self._connections), {}
+        for conn in connections:
+            conn.close()
+        self._selector.close()
+        for sock in (self.sock, self._wakeup_recv, self._wakeup_send):
+            sock.close()
+
+    def _accept(self):
+        try:
             conn, _ = self.sock.accept()
-            t = threading.Thread(target=self.run_connection, args=(conn,), daemon=True)
-            t.start()
-
-    def run_connection(self, conn):
-        with suppress(ConnectionError):
-            while True:
-                op, i, k, v = self._sock_recv(conn).split("|")
-                if op == "set":
-                    self._set(i, k, int(v))
-                elif op == "get":
-                    self._sock_send(conn, str(self._get(i, k)))
-                elif op == "inc":
-                    with self._suite_lock:
-                        new_v = self._get(i, k) + 1
-                        self._set(i, k, new_v)
-                    self._sock_send(conn, str(new_v))
-                elif op == "try_inc":
-                    with self._suite_lock:
-                        current = self._get(i, k)
-                        if current < int(v):
-                            self._set(i, k, current + 1)
-                            self._sock_send(conn, "1")
-                        else:
-                            self._sock_send(conn, "0")
-                elif op == "dec":
-                    with self._suite_lock:
-                        current = self._get(i, k)
-                        if current > 0:
-                            self._set(i, k, current - 1)
-                    self._sock_send(conn, "1")
-
-    def _set(self, i: str, k: str, v: int):
-        if i not in self.rerunfailures_db:
-            self.rerunfailures_db[i] = {}
-        self.rerunfailures_db[i][k] = v
-
-    def _get(self, i: str, k: str) -> int:
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = _Connection(conn)
+        with self._lock:
+            self._connections[conn] = connection
+        self._selector.register(conn, selectors.EVENT_READ, connection)
+
+    def _wakeup(self):
+        """Watch for writability of the connections with pending output."""
+        with suppress(BlockingIOError):
+            self._wakeup_recv.recv(4096)
+        with self._lock:
+            connections = list(self._connections.items())
+        for conn, connection in connections:
+            self._update_events(conn, connection)
+
+    def _serve(self, conn, connection, events):
         try:
-            return self.rerunfailures_db[i][k]
-        except KeyError:
-            return 0
+            with self._lock:
+                if events & selectors.EVENT_READ:
+                    connection.reader.fill()
+                    frame = connection.reader.pop_frame()
+                    while frame is not None:
+                        reply = self._handle_message(*frame)
+                        if reply is not None:
+                            op, payload = reply
+                            connection.outbuf += FRAME_HEADER.pack(len(payload), op)
+                            connection.outbuf += payload
+                        frame = connection.reader.pop_frame()
+                if connection.outbuf:
+                    sent = conn.send(connection.outbuf)
+                    del connection.outbuf[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            with self._lock:
+                del self._connections[conn]
+            self._selector.unregister(conn)
+            conn.close()
+            return
+        self._update_events(conn, connection)
+
+    def _update_events(self, conn, connection):
+        wanted = selectors.EVENT_READ
+        if connection.outbuf:
+            wanted |= selectors.EVENT_WRITE
+        if wanted != connection.events:
+            connection.events = wanted
+            with suppress(KeyError, ValueError):
+                self._selector.modify(conn, wanted, connection)
+
+    def _handle_message(self, op: int, payload: bytes):
+        """Apply a client message; return the opcode and payload to reply with."""
+        if op == OP_SET:
+            k, i, v = FIELD_ID_INT64.unpack(payload)
+            self._set(i, k.decode(), v)
+            return None
+        elif op == OP_SET_MANY:
+            column = self.columns[payload[:1].decode()] = _column_from_bytes(
+                payload[1:]
+            )
+            value = len(column)
+        elif op == OP_GET:
+            k, i = FIELD_ID.unpack(payload)
+            value = self._get(i, k.decode())
+        elif op == OP_GET_ALL:
+            column = self.columns[payload.decode()]
+            items = [(i, v) for i, v in enumerate(column) if v]
+            return OP_REPLY_ITEMS, _pack_items(items)
+        elif op == OP_GET_SUITE:
+            value = self.get_suite_reruns()
+        elif op == OP_GET_SUITE_COST:
+            value = self.get_suite_rerun_cost()
+        elif op == OP_RECORD:
+            self.record_test_outcome(*RECORD.unpack(payload))
+            return None
+        elif op == OP_GET_WINDOW:
+            return OP_REPLY, WINDOW.pack(*self.get_window_failures())
+        elif op == OP_LEN:
+            value = len(self.columns[payload.decode()])
+        elif op == OP_INC:
+            value = self.increment_suite_reruns()
+        elif op == OP_TRY_INC:
+            max_cap, cost, max_cost = TRY_INC.unpack(payload)
+            value = int(
+                self.try_increment_suite_reruns(
+                    None if max_cap < 0 else max_cap,
+                    cost,
+                    None if max_cost < 0 else max_cost,
+                )
+            )
+        elif op == OP_DEC:
+            (cost,) = INT64.unpack(payload)
+            self.decrement_suite_reruns(cost)
+            value = 1
+        else:
+            raise ConnectionError(f"unknown opcode {op}")
+        return OP_REPLY, INT64.pack(value)
+
+    def _set(self, i: int, k: str, v: int):
+        if k != "f":
+            self._store(i, k, v)
+            return
+        # failure counts are cached by the workers, push every change
+        with self._lock:
+            self._store(i, k, v)
+            self._broadcast(OP_NOTIFY, k.encode() + _pack_items([(i, v)]))
+
+    def _store(self, i: int, k: str, v: int):
+        column = self.columns[k]
+        if i >= len(column):
+            column.frombytes(bytes(column.itemsize * (i + 1 - len(column))))
+        column[i] = min(v, COLUMN_MAX)
+
+    def _broadcast(self, op: int, payload: bytes):
+        """Queue a message to every connection and send what fits."""
+        frame = FRAME_HEADER.pack(len(payload), op) + payload
+        pending = False
+        for conn, connection in self._connections.items():
+            connection.outbuf += frame
+            with suppress(OSError):
+                sent = conn.send(connection.outbuf)
+                del connection.outbuf[:sent]
+            pending = pending or bool(connection.outbuf)
+        if pending:
+            # let the I/O thread send the rest
+            with suppress(OSError):
+                self._wakeup_send.send(b"\0")
+
+    def _get(self, i: int, k: str) -> int:
+        column = self.columns[k]
+        return column[i] if i < len(column) else 0
+
+
+class ClientStatusDB(SocketDB):
+    # seconds to wait for the controller before reconnecting, so a hung
+    # controller cannot block a worker forever
+    timeout = 60.0
+
+    def __init__(self, sock_port):
+        super().__init__()
+        self.sock_port = sock_port
+        # connected on first use, workers without reruns never connect
+        self.sock = None
+
+    def _connect(self):
+        self.sock = self._make_socket()
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(("127.0.0.1", self.sock_port))
+        self._reader = _FrameReader(self.sock)
+        # The failure counts are cached: they are fetched once here and the
+        # server pushes every later change, so looking them up before each
+        # test needs no round trip.
+        self._failures: dict[int, int] = {}
+        self._sock_send(self.sock, OP_GET_ALL, b"f")
+        self._failures = dict(_unpack_items(self._read_reply()))
+
+    def _disconnect(self):
+        with suppress(OSError):
+            self.sock.close()
+        self.sock = None
+
+    def _reconnect(self):
+        self._disconnect()
+        self._connect()
+
+    def close(self):
+        if self.sock is not None:
+            self._disconnect()
+
+    def _read_reply(self) -> bytes:
+        """Return the payload of the next reply, applying pushed messages."""
+        while True:
+            op, payload = self._reader.read_frame()
+            if op != OP_NOTIFY:
+                return payload
+            self._apply_notification(payload)
+
+    def _apply_notification(self, payload: bytes):
+        for i, v in _unpack_items(payload, 1):
+            self._failures[i] = v
+
+    def _poll_notifications(self):
+        """Apply the failure counts pushed since the last call."""
+        if self.sock is None:
+            self._connect()
+            return
+        try:
+            while select.select([self.sock], [], [], 0)[0]:
+                self._reader.fill()
+        except OSError:
+            self._reconnect()
+            return
+        frame = self._reader.pop_frame()
+        while frame is not None:
+            self._apply_notification(frame[1])
+            frame = self._reader.pop_frame()
+
+    def _request(self, op: int, payload: bytes = b"", reply: bool = True):
+        """Send a message and return the reply; reconnect once on errors.
+
+        A message which could not be sent is sent again. A lost reply is only
+        requested again for the ``IDEMPOTENT_OPS``, as the server may have
+        applied the message already, and a reply timeout is raised.
+        """
+        if self.sock is None:
+            self._connect()
+        for attempt in range(2):
+            try:
+                self._sock_send(self.sock, op, payload)
+            except OSError:
+                if attempt:
+                    raise
+                self._reconnect()
+                continue
+            if not reply:
+                return None
+            try:
+                return self._read_reply()
+            except OSError as exc:
+                # a late reply must not be taken for the one of the next
+                # request, so the next request uses a new connection
+                self._disconnect()
+                if attempt or isinstance(exc, TimeoutError) or op not in IDEMPOTENT_OPS:
+                    raise
+                self._connect()
+
+    def _request_value(self, op: int, payload: bytes = b"") -> int:
+        return INT64.unpack(self._request(op, payload))[0]
+
+    def _set(self, i: int, k: str, v: int):
+        self._request(OP_SET, FIELD_ID_INT64.pack(k.encode(), i, v), False)
+        if k == "f":
+            self._failures[i] = v
+
+    def _get(self, i: int, k: str) -> int:
+        if k == "f":
+            self._poll_notifications()
+            if not self._failures.get(i):
+                return 0
+            # The test crashed or was rescheduled before. The push of a later
+            # change travels apart from the test, so it may still be on its
+            # way: the count is read from the server.
+        value = self._request_value(OP_GET, FIELD_ID.pack(k.encode(), i))
+        if k == "f":
+            self._failures[i] = value
+        return value
+
+    def set_test_reruns_many(self, reruns: array):
+        """Record the rerun counts of all tests in a single message."""
+        if not any(reruns):
+            return
+        # all workers collect the same tests, so only the first one to get
+        # here has to send the column
+        if self._request_value(OP_LEN, b"r") == len(reruns):
+            return
+        # wait for the reply, a test crashing right away needs the counts
+        self._request(OP_SET_MANY, b"r" + _column_to_bytes(reruns))
 
     def increment_suite_reruns(self) -> int:
         """Atomically increment the suite-wide rerun counter; return new total."""
-        with self._suite_lock:
-            new_v = self._get("__suite__", "r") + 1
-            self._set("__suite__", "r", new_v)
-            return new_v
+        return self._request_value(OP_INC)
 
-    def try_increment_suite_reruns(self, max_cap: int) -> bool:
+    def try_increment_suite_reruns(
+        self, max_cap: int | None, cost: int = 0, max_cost: int | None = None
+    ) -> bool:
         """Increment the suite counter when it is below the configured cap."""
-        with self._suite_lock:
-            current = self._get("__suite__", "r")
-            if current < max_cap:
-                self._set("__suite__", "r", current + 1)
-                return True
-            return False
+        payload = TRY_INC.pack(
+            -1 if max_cap is None else max_cap,
+            cost,
+            -1 if max_cost is None else max_cost,
+        )
+        return self._request_value(OP_TRY_INC, payload) == 1
 
-    def decrement_suite_reruns(self) -> None:
+    def decrement_suite_reruns(self, cost: int = 0) -> None:
         """Release a suite slot when a scheduled rerun cannot be started."""
-        with self._suite_lock:
-            current = self._get("__suite__", "r")
-            if current > 0:
-                self._set("__suite__", "r", current - 1)
+        self._request(OP_DEC, INT64.pack(cost))
 
     def get_suite_reruns(self) -> int:
         """Return the current suite-wide rerun count."""
-        return self._get("__suite__", "r")
+        return self._request_value(OP_GET_SUITE)
 
+    def get_suite_rerun_cost(self) -> int:
+        """Return the time charged to the reruns, in milliseconds."""
+        return self._request_value(OP_GET_SUITE_COST)
 
-class ClientStatusDB(SocketDB):
-    def __init__(self, sock_port):
+    def record_test_outcome(self, failed: bool, window: int) -> None:
+        """Add the outcome of an attempt to the last ``window`` outcomes."""
+        self._request(OP_RECORD, RECORD.pack(failed, window), False)
+
+    def get_window_failures(self) -> tuple[int, int]:
+        """Return the number of failures and of attempts in the window."""
+        return WINDOW.unpack(self._request(OP_GET_WINDOW))
+
+
+class SharedStatusDB(StatusDB):
+    """A StatusDB in a memory-mapped file, shared by processes on one host.
+
+    The file starts with a header of int64 slots, the first of which hold the
+    suite rerun count and time, followed by the outcomes of the last attempts
+    as a bitset and by one record of two int32 counters per test ID. Reads
+    access the memory directly, writes hold an exclusive lock on the file.
+    The file only grows, processes map it again when a test ID lies beyond
+    their mapping.
+    """
+
+    # suite reruns, test count, suite rerun time, recorded attempts, failures
+    # in the window, window size, reserved slots
+    HEADER = struct.Struct("=8q")
+    SLOT = struct.Struct("=q")
+    RECORD = struct.Struct("=ii")  # failures, reruns
+    INT32 = struct.Struct("=i")
+    FIELD_OFFSETS = {"f": 0, "r": INT32.size}
+    SUITE_SLOT = 0
+    TESTS_SLOT = 1
+    COST_SLOT = 2
+    ATTEMPTS_SLOT = 3
+    WINDOW_FAILURES_SLOT = 4
+    WINDOW_SIZE_SLOT = 5
+    WINDOW_OFFSET = HEADER.size
+    RECORDS_OFFSET = WINDOW_OFFSET + MAX_BREAKER_WINDOW // 8
+
+    def __init__(self, path=None):
         super().__init__()
-        self.sock.connect(("127.0.0.1", sock_port))
+        # the process creating the file removes it on close
+        self.owner = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="pytest-rerunfailures-")
+            os.ftruncate(fd, self.RECORDS_OFFSET)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        self.path = path
+        self._fd = fd
+        self._map = mmap.mmap(fd, 0)
 
-    def _set(self, i: str, k: str, v: int):
-        self._sock_send(self.sock, "|".join(("set", i, k, str(v))))
+    @contextmanager
+    def _locked(self):
+        with self._suite_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _mapped(self, end: int, grow: bool = False) -> bool:
+        """Make sure the mapping reaches ``end``; return False if it cannot."""
+        if end <= len(self._map):
+            return True
+        size = os.fstat(self._fd).st_size
+        if size < end:
+            if not grow:
+                return False
+            # grow geometrically, so a growing collection is remapped rarely
+            os.ftruncate(self._fd, max(end, 2 * size))
+        self._map.close()
+        self._map = mmap.mmap(self._fd, 0)
+        return True
+
+    def _slot(self, slot: int) -> int:
+        return self.SLOT.unpack_from(self._map, slot * self.SLOT.size)[0]
+
+    def _set_slot(self, slot: int, v: int):
+        self.SLOT.pack_into(self._map, slot * self.SLOT.size, v)
+
+    def _offset(self, i: int, k: str) -> int:
+        return self.RECORDS_OFFSET + i * self.RECORD.size + self.FIELD_OFFSETS[k]
 
-    def _get(self, i: str, k: str) -> int:
-        self._sock_send(self.sock, "|".join(("get", i, k, "")))
-        return int(self._sock_recv(self.sock))
+    def _get(self, i: int, k: str) -> int:
+        offset = self._offset(i, k)
+        if not self._mapped(offset + self.INT32.size):
+            return 0
+        return self.INT32.unpack_from(self._map, offset)[0]
+
+    def _set(self, i: int, k: str, v: int):
+        offset = self._offset(i, k)
+        with self._locked():
+            self._mapped(offset + self.INT32.size, grow=True)
+            self.INT32.pack_into(self._map, offset, min(v, COLUMN_MAX))
+
+    def add_test_failure(self, test_id: int):
+        offset = self._offset(test_id, "f")
+        with self._locked():
+            self._mapped(offset + self.INT32.size, grow=True)
+            failures = self.INT32.unpack_from(self._map, offset)[0]
+            self.INT32.pack_into(self._map, offset, failures + 1)
+
+    def set_test_reruns_many(self, reruns: array):
+        """Record the rerun counts of all tests, indexed by test ID."""
+        with self._locked():
+            # all workers collect the same tests, the first one writes them
+            if self._slot(self.TESTS_SLOT) == len(reruns):
+                return
+            end = self.RECORDS_OFFSET + len(reruns) * self.RECORD.size
+            self._mapped(end, grow=True)
+            with memoryview(self._map) as view:
+                with view[self.RECORDS_OFFSET : end].cast("i") as records:
+                    records[1::2] = reruns
+            self._set_slot(self.TESTS_SLOT, len(reruns))
 
     def increment_suite_reruns(self) -> int:
         """Atomically increment the suite-wide rerun counter; return new total."""
-        self._sock_send(self.sock, "|".join(("inc", "__suite__", "r", "")))
-        return int(self._sock_recv(self.sock))
-
-    def try_increment_suite_reruns(self, max_cap: int) -> bool:
+        with self._locked():
+            count = self._slot(self.SUITE_SLOT) + 1
+            self._set_slot(self.SUITE_SLOT, count)
+            return count
+
+    def try_increment_suite_reruns(
+        self, max_cap: int | None, cost: int = 0, max_cost: int | None = None
+    ) -> bool:
         """Increment the suite counter when it is below the configured cap."""
-        self._sock_send(
-            self.sock, "|".join(("try_inc", "__suite__", "r", str(max_cap)))
-        )
-        return self._sock_recv(self.sock) == "1"
+        with self._locked():
+            count = self._slot(self.SUITE_SLOT)
+            spent = self._slot(self.COST_SLOT)
+            if _within_suite_budget(count, spent, max_cap, max_cost):
+                self._set_slot(self.SUITE_SLOT, count + 1)
+                self._set_slot(self.COST_SLOT, spent + cost)
+                return True
+            return False
 
-    def decrement_suite_reruns(self) -> None:
+    def decrement_suite_reruns(self, cost: int = 0) -> None:
         """Release a suite slot when a scheduled rerun cannot be started."""
-        self._sock_send(self.sock, "|".join(("dec", "__suite__", "r", "")))
-        self._sock_recv(self.sock)
+        with self._locked():
+            count = self._slot(self.SUITE_SLOT)
+            if count > 0:
+                self._set_slot(self.SUITE_SLOT, count - 1)
+                spent = self._slot(self.COST_SLOT)
+                self._set_slot(self.COST_SLOT, max(spent - cost, 0))
 
     def get_suite_reruns(self) -> int:
         """Return the current suite-wide rerun count."""
-        return self._get("__suite__", "r")
+        return self._slot(self.SUITE_SLOT)
+
+    def get_suite_rerun_cost(self) -> int:
+        """Return the time charged to the reruns, in milliseconds."""
+        return self._slot(self.COST_SLOT)
+
+    def record_test_outcome(self, failed: bool, window: int) -> None:
+        """Add the outcome of an attempt to the last ``window`` outcomes."""
+        with self._locked():
+            attempts = self._slot(self.ATTEMPTS_SLOT)
+            failures = self._slot(self.WINDOW_FAILURES_SLOT)
+            # the bitset is a ring buffer of the last ``window`` outcomes
+            byte, bit = divmod(attempts % window, 8)
+            offset = self.WINDOW_OFFSET + byte
+            bits = self._map[offset]
+            if attempts >= window:
+                failures -= (bits >> bit) & 1
+            self._map[offset] = bits | (1 << bit) if failed else bits & ~(1 << bit)
+            self._set_slot(self.WINDOW_FAILURES_SLOT, failures + failed)
+            self._set_slot(self.ATTEMPTS_SLOT, attempts + 1)
+            self._set_slot(self.WINDOW_SIZE_SLOT, window)
+
+    def get_window_failures(self) -> tuple[int, int]:
+        """Return the number of failures and of attempts in the window."""
+        with self._locked():
+            attempts = min(
+                self._slot(self.ATTEMPTS_SLOT), self._slot(self.WINDOW_SIZE_SLOT)
+            )
+            return self._slot(self.WINDOW_FAILURES_SLOT), attempts
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+        if self.owner:
+            with suppress(OSError):
+                os.unlink(self.path)
 
 
 suspended_finalizers: dict[Any, Any] = {}
@@ -856,153 +2580,1124 @@ def _restore_suspended_finalizers(item):
     suspended_finalizers.clear()
 
 
-def _is_rerun_path_excluded(item):
-    excluded_paths = item.config.getoption("rerun_exclude_path") or []
-    return any(
-        item.path.is_relative_to(item.config.rootpath / excluded_path)
-        for excluded_path in excluded_paths
-    )
-
+RERUN_HOOKS_NAME = "rerunfailures-runtest"
 
-def pytest_runtest_teardown(item, nextitem):
-    reruns = get_reruns_count(item)
-    if reruns is None:
-        # global setting is not specified, and this test is not marked with
-        # flaky
-        return
 
-    if not hasattr(item, "execution_count"):
-        # pytest_runtest_protocol hook of this plugin was not executed
-        # -> teardown needs to be skipped as well
-        return
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(session, config, items):
+    may_rerun = False
+    history = None
+    if config.option.reruns_adaptive:
+        history = config.cache.get(ADAPTIVE_CACHE_KEY, {})
+        adapted = config.stash[_adapted_reruns_key] = []
+    for item in items:
+        policy = _resolve_policy(item)
+        if policy.reruns is not None and not policy.excluded:
+            may_rerun = True
+            if history is not None:
+                configured = policy
+                policy = _adapt_policy(config, policy, history.get(item.nodeid, []))
+                if policy is not configured:
+                    adapted.append((item.nodeid, configured.reruns, policy.reruns))
+        item.stash[_rerun_policy_key] = policy
+
+    if config.option.rerun_flaky_first:
+        _order_flaky_first(config, items)
+
+    # The per-test hooks are only registered when at least one item can be
+    # rerun, so runs without any reruns configured do not pay for them.
+    if may_rerun and not config.pluginmanager.has_plugin(RERUN_HOOKS_NAME):
+        config.pluginmanager.register(RerunHooks(), RERUN_HOOKS_NAME)
+
+
+def pytest_report_collectionfinish(config, start_path, items):
+    if config.option.verbose <= 0 or _adapted_reruns_key not in config.stash:
+        return None
+    adapted = config.stash[_adapted_reruns_key]
+    lines = [f"adaptive reruns: {len(adapted)} of {len(items)} tests adjusted"]
+    lines.extend(
+        f"  {nodeid}: {reruns} reruns (configured {configured})"
+        for nodeid, configured, reruns in adapted
+    )
+    return lines
 
-    _test_failed_statuses = getattr(item, "_test_failed_statuses", {})
 
-    max_suite_reruns = item.session.config.option.max_suite_reruns
+def pytest_collection_finish(session):
+    config = session.config
     if (
-        max_suite_reruns is not None
-        and item.session.config.failures_db.get_suite_reruns() >= max_suite_reruns
+        config.option.rerun_fresh_process
+        and session.items
+        and not config.option.collectonly
+        and config.pluginmanager.has_plugin(RERUN_HOOKS_NAME)
     ):
-        _restore_suspended_finalizers(item)
+        # before any test changed the state of the process
+        config.stash[_fresh_template_key] = FreshProcessTemplate(session)
+    if is_master(config):
         return
+    # A test is identified by its index in the collection, which is the same
+    # on all workers and in the scheduler of the controller. The rerun counts
+    # needed to handle crashes are uploaded in one message.
+    reruns = array(COLUMN_TYPECODE)
+    for test_id, item in enumerate(session.items):
+        item.stash[_test_id_key] = test_id
+        policy = _get_policy(item)
+        if policy.reruns is None or policy.excluded:
+            reruns.append(0)
+        else:
+            reruns.append(min(policy.reruns, COLUMN_MAX))
+    session.config.failures_db.set_test_reruns_many(reruns)
 
-    # Only remove non-function level actions from the stack if the test is to be re-run
-    # Exceeding re-run limits, being free of failue statuses, and encountering
-    # allowable exceptions indicate that the test is not to be re-ran.
-    if (
-        item.execution_count <= reruns
-        and any(_test_failed_statuses.values())
-        and not any(item._terminal_errors.values())
-    ):
-        # clean cached results from any level of setups
-        _remove_cached_results_from_failed_fixtures(item)
-
-        if item in item.session._setupstate.stack:
-            for key in list(item.session._setupstate.stack.keys()):
-                if key != item:
-                    # only the first finalizer contains the correct teardowns
-                    if key not in suspended_finalizers:
-                        suspended_finalizers[key] = item.session._setupstate.stack[key]
-                    del item.session._setupstate.stack[key]
-    else:
-        # restore suspended finalizers
-        _restore_suspended_finalizers(item)
-
-
-@pytest.hookimpl(hookwrapper=True)
-def pytest_runtest_makereport(item, call):
-    outcome = yield
-    result = outcome.get_result()
-    if result.when == "setup":
-        # clean failed statuses at the beginning of each test/rerun
-        setattr(item, "_test_failed_statuses", {})
-
-        # create a dict to store error-check results for each stage
-        setattr(item, "_terminal_errors", {})
-
-    _test_failed_statuses = getattr(item, "_test_failed_statuses", {})
-    _test_failed_statuses[result.when] = result.failed
-    item._test_failed_statuses = _test_failed_statuses
-    item._terminal_errors[result.when] = _should_hard_fail_on_error(
-        item, result, call.excinfo
+
+def _get_rerun_delay(item, policy):
+    """Return the delay before the rerun following the current attempt."""
+    return policy.delay * policy.delay_backoff_factor ** (item.execution_count - 1)
+
+
+def _sleep_until(due):
+    remaining = due - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def _cancel_rerun(item):
+    """Log the failure of an item as final, as its postponed rerun is cancelled."""
+    report = copy.copy(item._postponed_report)
+    report.outcome = "failed"
+    report.rerun_stopped = "the session is stopping"
+    item.ihook.pytest_runtest_logstart(nodeid=item.nodeid, location=item.location)
+    item.ihook.pytest_runtest_logreport(report=report)
+    item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
+
+
+def _run_test_protocol(item, nextitem):
+    """Run the test protocol of an item which is never rerun."""
+    item.ihook.pytest_runtest_logstart(nodeid=item.nodeid, location=item.location)
+    runtestprotocol(item, nextitem=nextitem)
+    item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
+
+
+# the attributes RerunHooks.pytest_runtest_makereport sets on the item, which
+# the child running the call phase of a --rerun-snapshot attempt sends back
+SNAPSHOT_STATE = (
+    "_test_failed_statuses",
+    "_terminal_errors",
+    "_attempt_duration",
+    "_attempt_signature",
+    "_last_signature",
+    "_identical_failures",
+    "_attempt_failed",
+)
+
+
+def _describe_wait_status(status):
+    code = os.waitstatus_to_exitcode(status)
+    if code < 0:
+        return f"was killed by signal {signal.Signals(-code).name}"
+    return f"exited with code {code}"
+
+
+def _dump_warnings(log):
+    """Return the warnings recorded in a child in a form it can send back."""
+    recorded = []
+    for message in log:
+        entry = (message.message, message.category, message.filename, message.lineno)
+        try:
+            pickle.dumps(entry)
+        except Exception:
+            # e.g. a warning class defined in a function, only its text is kept
+            entry = (str(message.message), UserWarning, *entry[2:])
+        recorded.append(entry)
+    return recorded
+
+
+def _dump_attempt(item, reports, log=()):
+    """Serialize the reports, the warnings and the rerun state of a child."""
+    data = [
+        item.config.hook.pytest_report_to_serializable(config=item.config, report=r)
+        for r in reports
+    ]
+    state = {
+        name: getattr(item, name) for name in SNAPSHOT_STATE if hasattr(item, name)
+    }
+    return pickle.dumps((data, _dump_warnings(log), state))
+
+
+def _load_attempt(item, payload):
+    """Apply the rerun state sent by a child and return the reports.
+
+    The warnings the child recorded are raised again, so the warnings plugin
+    records them for the item as if the attempt ran in this process.
+    """
+    # written by a child of this process, see _dump_attempt
+    data, recorded, state = pickle.loads(payload)  # noqa: S301
+    for name, value in state.items():
+        setattr(item, name, value)
+    for message, category, filename, lineno in recorded:
+        warnings.warn_explicit(message, category, filename, lineno)
+    return [
+        item.config.hook.pytest_report_from_serializable(config=item.config, data=d)
+        for d in data
+    ]
+
+
+def _fail_crashed_attempt(item, status, duration):
+    """Return the report of an attempt whose child exited without reports."""
+    item._test_failed_statuses["call"] = True
+    item._terminal_errors["call"] = False
+    item._attempt_duration += duration
+    item._attempt_signature = item._last_signature = None
+    item._identical_failures = 1
+    item._attempt_failed = True
+    return pytest.TestReport(
+        item.nodeid,
+        item.location,
+        {},
+        "failed",
+        f"the process running the test {_describe_wait_status(status)}",
+        "call",
+        [],
+        duration,
     )
 
 
-def pytest_runtest_protocol(item, nextitem):
+def _run_in_child(item, run):
+    """Run a part of the test protocol in a forked child; return its reports.
+
+    ``run`` returns the reports of the child, which sends them back with its
+    warnings and the rerun state of the item through a pipe. A child exiting
+    without sending them, e.g. after a segfault, fails the call phase. Other
+    data collected in the child, e.g. by a coverage plugin, is lost.
     """
-    Run the test protocol.
+    read_fd, write_fd = os.pipe()
+    start = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            # the connection of the parent to the counters must not be used
+            item.config.failures_db = StatusDB()
+            # the filters are the ones the parent applies to the item
+            with warnings.catch_warnings(record=True) as log:
+                reports = run()
+            payload = _dump_attempt(item, reports, log)
+            with os.fdopen(write_fd, "wb") as pipe:
+                pipe.write(payload)
+        finally:
+            # skip the cleanup of the parent state the child inherited
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as pipe:
+        payload = pipe.read()
+    _, status = os.waitpid(pid, 0)
+    if not payload:
+        return [_fail_crashed_attempt(item, status, time.monotonic() - start)]
+    return _load_attempt(item, payload)
+
+
+def _reset_attempt_state(item, statuses):
+    """Reset the rerun state of an attempt which starts without a setup report."""
+    item._test_failed_statuses = dict(statuses)
+    item._terminal_errors = dict.fromkeys(statuses, False)
+    item._attempt_duration = 0.0
+    item._attempt_signature = None
+    item._attempt_failed = any(statuses.values())
+
+
+def _release_request(item):
+    """Drop the fixture values of an item, as runtestprotocol does."""
+    if hasattr(item, "_request"):
+        item._request = False
+        item.funcargs = None
+
+
+def _run_call_phase(item):
+    return [call_and_report(item, "call", log=False)]
+
+
+def _run_snapshot_attempt(item, nextitem):
+    """Run an attempt of an item with --rerun-snapshot; return its reports.
+
+    Once the setup passed, the item stays set up for the next attempts and is
+    only torn down by ``_teardown_snapshot``.
+    """
+    if item._snapshot:
+        # the previous attempt only ran the call phase
+        _reset_attempt_state(item, {"setup": False})
+        return _run_in_child(item, functools.partial(_run_call_phase, item))
+
+    if hasattr(item, "_request") and not item._request:
+        item._initrequest()
+    reports = [call_and_report(item, "setup", log=False)]
+    if reports[0].passed:
+        if item.config.getoption("setupshow", False):
+            show_test_item(item)
+        if not item.config.getoption("setuponly", False):
+            item._snapshot = True
+            reports.extend(
+                _run_in_child(item, functools.partial(_run_call_phase, item))
+            )
+            return reports
+    if _session_aborts(item.session):
+        nextitem = None
+    reports.append(call_and_report(item, "teardown", log=False, nextitem=nextitem))
+    _release_request(item)
+    return reports
+
+
+def _teardown_snapshot(item, nextitem):
+    """Tear down an item kept set up for --rerun-snapshot and log the report."""
+    if _session_aborts(item.session):
+        nextitem = None
+    report = call_and_report(item, "teardown", log=False, nextitem=nextitem)
+    item._snapshot = False
+    report.rerun = item.execution_count - 1
+    item.ihook.pytest_runtest_logreport(report=report)
+    _release_request(item)
+
+
+def _run_isolated_protocol(item):
+    """Run the test protocol in the child of an isolated attempt."""
+    # the higher-scoped fixtures set up before are left to the parent, see
+    # RerunHooks.pytest_runtest_teardown
+    item._inherited_setup = list(item.session._setupstate.stack)
+    return runtestprotocol(item, nextitem=None, log=False)
+
+
+def _record_child_attempt(item, reports):
+    """Feed an attempt run in a child to the circuit breaker."""
+    if item.config.option.rerun_circuit_breaker is not None:
+        # recorded by the parent, whose counters the child does not use
+        item.config.failures_db.record_test_outcome(
+            any(report.failed for report in reports),
+            item.config.option.rerun_circuit_breaker_window,
+        )
+
+
+def _setup_higher_scopes(item):
+    """Set up the collectors and the higher-scoped fixtures of an item.
 
-    Note: when teardown fails, two reports are generated for the case, one for
-    the test case and the other for the teardown error.
+    The children of the isolated attempts inherit them, so consecutive items
+    share them as without isolation. A failure is left to the child, which
+    raises the error cached by the collector or the fixture in its setup.
     """
-    if _is_rerun_path_excluded(item):
-        return
+    setupstate = item.session._setupstate
+    if not item._request:
+        item._initrequest()
+    with suppress(*TEST_OUTCOME):
+        # as SetupState.setup does, without the item itself
+        for col in item.listchain()[len(setupstate.stack) : -1]:
+            setupstate.stack[col] = ([col.teardown], None)
+            try:
+                col.setup()
+            except TEST_OUTCOME as exc:
+                setupstate.stack[col] = (setupstate.stack[col][0], exc)
+                raise
+        for name in item.fixturenames:
+            fixture_defs = item._fixtureinfo.name2fixturedefs.get(name)
+            if fixture_defs and fixture_defs[-1].scope != "function":
+                item._request.getfixturevalue(name)
+
+
+def _run_isolated_attempt(item):
+    """Run an attempt of an item in a forked child; return its reports."""
+    _reset_attempt_state(item, {})
+    _setup_higher_scopes(item)
+    reports = _run_in_child(item, functools.partial(_run_isolated_protocol, item))
+    _record_child_attempt(item, reports)
+    return reports
+
+
+def _teardown_isolated(item, nextitem):
+    """Tear down what the next item does not need after an isolated item.
+
+    These are the higher-scoped fixtures set up by ``_setup_higher_scopes``,
+    the item itself is torn down in the child. Only a failed teardown is
+    logged.
+    """
+    if _session_aborts(item.session):
+        nextitem = None
+    # the teardown hooks of the plugins expect the item to be set up
+    call = pytest.CallInfo.from_call(
+        lambda: item.session._setupstate.teardown_exact(nextitem), "teardown"
+    )
+    if call.excinfo is not None:
+        report = item.ihook.pytest_runtest_makereport(item=item, call=call)
+        report.rerun = item.execution_count - 1
+        item.ihook.pytest_runtest_logreport(report=report)
+    _release_request(item)
 
-    reruns = get_reruns_count(item)
-    if reruns is None:
-        # global setting is not specified, and this test is not marked with
-        # flaky
-        return
 
-    if reruns and item.session.config.option.usepdb:
-        # the global options are already rejected in check_options(); this
-        # catches reruns requested via the flaky marker, which are only
-        # known once the item is available
-        raise pytest.UsageError("--reruns incompatible with --pdb")
+# Messages exchanged with the --rerun-fresh-process template, framed as the
+# messages of the StatusDB wire protocol.
+FRESH_RUN = 1  # payload: pickled item index and rerun state
+FRESH_REPORTS = 2  # sent by the child, payload: see _dump_attempt
+FRESH_STATUS = 3  # payload: wait status of the child (int64)
 
-    delay = get_reruns_delay(item)
-    delay_backoff_factor = get_reruns_delay_backoff_factor(item)
-    parallel = not is_master(item.config)
-    db = item.session.config.failures_db
-    item.execution_count = db.get_test_failures(item.nodeid)
-    db.set_test_reruns(item.nodeid, reruns)
+# the rerun state the child of the template continues from
+FRESH_STATE = (*SNAPSHOT_STATE, "execution_count")
 
-    if item.execution_count > reruns:
-        return True
 
-    need_to_run = True
-    while need_to_run:
-        item.execution_count += 1
-        item.ihook.pytest_runtest_logstart(nodeid=item.nodeid, location=item.location)
-        reports = runtestprotocol(item, nextitem=nextitem, log=False)
-
-        rerun_triggered = False
-        for report in reports:  # 3 reports: setup, call, teardown
-            report.rerun = item.execution_count - 1
-            if rerun_triggered or _should_not_rerun(item, report, reruns):
-                # no rerun needed or one already triggered, log normally
-                item.ihook.pytest_runtest_logreport(report=report)
+class FreshProcessTemplate:
+    """A process forked right after the collection for --rerun-fresh-process.
+
+    The template forks a child for every rerun, which starts with the modules
+    imported and the tests collected, but none of the state the tests which
+    ran before left behind.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.indices = {id(item): index for index, item in enumerate(session.items)}
+        self.sock, template_sock = socket.socketpair()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                self.sock.close()
+                self._serve(template_sock)
+            finally:
+                os._exit(0)
+        template_sock.close()
+        self.reader = _FrameReader(self.sock)
+
+    @staticmethod
+    def _send(sock, op: int, payload: bytes):
+        sock.sendall(FRAME_HEADER.pack(len(payload), op) + payload)
+
+    def _serve(self, sock):
+        """Fork a child for every rerun until the session closes the socket."""
+        reader = _FrameReader(sock)
+        while True:
+            try:
+                _, payload = reader.read_frame()
+            except ConnectionError:
+                return
+            # written by the session process, see run()
+            index, state = pickle.loads(payload)  # noqa: S301
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self._run_child(sock, self.session.items[index], state)
+                finally:
+                    os._exit(0)
+            _, status = os.waitpid(pid, 0)
+            self._send(sock, FRESH_STATUS, INT64.pack(status))
+
+    def _run_child(self, sock, item, state):
+        item.config.failures_db = StatusDB()
+        for name, value in state.items():
+            setattr(item, name, value)
+        # nothing is set up in the template, so the child tears down all it
+        # set up, see RerunHooks.pytest_runtest_teardown
+        item._inherited_setup = []
+        # the template was forked outside of the item, so the filters of the
+        # item are applied here, as the warnings plugin does in the session
+        with (
+            catch_warnings_for_item(item.config, item.ihook, "runtest", item),
+            warnings.catch_warnings(record=True) as log,
+        ):
+            reports = runtestprotocol(item, nextitem=None, log=False)
+        self._send(sock, FRESH_REPORTS, _dump_attempt(item, reports, log))
+
+    def run(self, item):
+        """Run an attempt of an item in a fresh child; return its reports."""
+        _reset_attempt_state(item, {})
+        state = {
+            name: getattr(item, name) for name in FRESH_STATE if hasattr(item, name)
+        }
+        start = time.monotonic()
+        self._send(self.sock, FRESH_RUN, pickle.dumps((self.indices[id(item)], state)))
+        reports = None
+        op, payload = self.reader.read_frame()
+        if op == FRESH_REPORTS:
+            reports = _load_attempt(item, payload)
+            op, payload = self.reader.read_frame()
+        if reports is None:
+            (status,) = INT64.unpack(payload)
+            reports = [_fail_crashed_attempt(item, status, time.monotonic() - start)]
+        _record_child_attempt(item, reports)
+        return reports
+
+    def close(self):
+        self.sock.close()
+        os.waitpid(self.pid, 0)
+
+
+_fresh_template_key = pytest.StashKey[FreshProcessTemplate]()
+
+
+class RerunHooks:
+    """The per-test hooks driving the reruns."""
+
+    def __init__(self):
+        # the items waiting for their rerun delay to elapse, as a heap of
+        # (due time, sequence number, item)
+        self.parked: list[tuple[float, int, Any]] = []
+        self._parked_count = itertools.count()
+        # the items rerun after the last item with --reruns-defer, or after
+        # the last item of their scope with --reruns-scope, in the order they
+        # failed, as (due time, item)
+        self.deferred: list[tuple[float, Any]] = []
+        self.running_deferred = False
+
+    def _postpones_rerun(self, item, delay):
+        """Return whether the rerun does not follow the failed attempt."""
+        if item.config.option.reruns_defer or item.config.option.reruns_scope:
+            return not self.running_deferred
+        return delay > 0 and item.config.option.reruns_delay_nonblocking
+
+    def pytest_runtest_teardown(self, item, nextitem):
+        reruns = _get_policy(item).reruns
+        if reruns is None:
+            # global setting is not specified, and this test is not marked with
+            # flaky
+            return
+
+        if not hasattr(item, "execution_count"):
+            # pytest_runtest_protocol hook of this plugin was not executed
+            # -> teardown needs to be skipped as well
+            return
+
+        inherited = getattr(item, "_inherited_setup", None)
+        if inherited is not None:
+            # in the child of an isolated attempt, only what the child set up
+            # is torn down
+            for key in inherited:
+                item.session._setupstate.stack.pop(key, None)
+            return
+
+        # decided before the teardown, which may tear down the scope of the
+        # fixture and thereby reset its failures
+        item._spent_fixture = _get_spent_fixture(item)
+
+        if item._snapshot or item._isolated:
+            # the item is torn down after its last attempt, see
+            # _teardown_snapshot and _teardown_isolated
+            _restore_suspended_finalizers(item)
+            return
+
+        _test_failed_statuses = getattr(item, "_test_failed_statuses", {})
+        # decided before the teardown, which keeps the fixtures of a rerun
+        # following right away
+        item._reschedule_rerun = _can_reschedule_rerun(item, nextitem)
+
+        policy = _get_policy(item)
+
+        # Only remove non-function level actions from the stack if the test is
+        # to be re-run. Exceeding re-run limits, being free of failue statuses,
+        # and encountering allowable exceptions indicate that the test is not
+        # to be re-ran.
+        if (
+            item.execution_count <= reruns
+            and any(_test_failed_statuses.values())
+            and not any(item._terminal_errors.values())
+            and not _exceeds_time_limits(item, policy)
+            and not _repeats_failure(item)
+            and item._spent_fixture is None
+            # a round trip to the controller with pytest-xdist, so checked
+            # last, only for failed tests
+            and not _is_suite_budget_spent(item.session.config)
+        ):
+            # clean cached results from any level of setups
+            _remove_cached_results_from_failed_fixtures(item)
+
+            if (
+                item._reschedule_rerun
+                or _fresh_template_key in item.config.stash
+                or self._postpones_rerun(item, _get_rerun_delay(item, policy))
+            ):
+                # the rerun does not follow in this process, so the
+                # higher-scoped fixtures are torn down for the next item as usual
+                _restore_suspended_finalizers(item)
+            elif item in item.session._setupstate.stack:
+                for key in list(item.session._setupstate.stack.keys()):
+                    if key != item:
+                        # only the first finalizer contains the correct teardowns
+                        if key not in suspended_finalizers:
+                            suspended_finalizers[key] = item.session._setupstate.stack[
+                                key
+                            ]
+                        del item.session._setupstate.stack[key]
+        else:
+            # restore suspended finalizers
+            _restore_suspended_finalizers(item)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_fixture_setup(self, fixturedef, request):
+        outcome = yield
+        if (
+            outcome.excinfo is None
+            or fixturedef.scope == "function"
+            or _get_fixture_budget(request.config) is None
+        ):
+            return
+        failures = request.config.stash.setdefault(_fixture_failures_key, {})
+        node, count = failures.get(fixturedef, (None, 0))
+        if node is not request.node:
+            # the first failure in this instance of the scope
+            count = 0
+        failures[fixturedef] = (request.node, count + 1)
+
+    def pytest_fixture_post_finalizer(self, fixturedef, request):
+        # the scope is torn down, so its next instance gets a new budget
+        failures = request.config.stash.get(_fixture_failures_key, None)
+        if failures and failures.get(fixturedef, (None,))[0] is request.node:
+            del failures[fixturedef]
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        result = outcome.get_result()
+        if item.config.option.rerun_circuit_breaker is not None and not getattr(
+            item, "_isolated", False
+        ):
+            _record_attempt(item, result)
+
+        policy = _get_policy(item)
+        if policy.reruns is None or policy.excluded:
+            # the item is never rerun, so its errors need not be classified
+            return
+
+        if result.when == "setup":
+            # clean failed statuses at the beginning of each test/rerun
+            setattr(item, "_test_failed_statuses", {})
+
+            # create a dict to store error-check results for each stage
+            setattr(item, "_terminal_errors", {})
+            item._attempt_duration = 0.0
+            item._attempt_signature = None
+
+        item._attempt_duration += result.duration
+        if (
+            result.failed
+            and item._attempt_signature is None
+            and item.config.option.rerun_stop_on_identical is not None
+        ):
+            # the first failure of an attempt is compared with the one of the
+            # previous attempt
+            signature = _get_failure_signature(call.excinfo, result)
+            item._attempt_signature = signature
+            if signature is not None and signature == item._last_signature:
+                item._identical_failures += 1
+            else:
+                item._identical_failures = 1
+            item._last_signature = signature
+
+        _test_failed_statuses = getattr(item, "_test_failed_statuses", {})
+        _test_failed_statuses[result.when] = result.failed
+        item._test_failed_statuses = _test_failed_statuses
+        item._terminal_errors[result.when] = _should_hard_fail_on_error(
+            item, result, call.excinfo
+        )
+
+    def pytest_runtest_protocol(self, item, nextitem):
+        """
+        Run the test protocol.
+
+        Note: when teardown fails, two reports are generated for the case, one for
+        the test case and the other for the teardown error.
+        """
+        following = nextitem
+        if self.parked:
+            self._run_with_due_parked(item, nextitem)
+            result = True
+        else:
+            if nextitem is None and self.deferred:
+                # keep the fixtures the first deferred rerun shares with the
+                # last item, a --reruns-scope node is torn down after it
+                following = self.deferred[0][1]
+            ends_group = self._ends_rerun_group(item, nextitem)
+            result = self._run(item, following)
+            if result is None and (following is not nextitem or ends_group):
+                # the deferred reruns follow the item, so it is not left to the
+                # default protocol
+                _run_test_protocol(item, following)
+                result = True
+        if nextitem is None or _session_aborts(item.session):
+            if (
+                following is not nextitem
+                and item.config.option.reruns_scope
+                and not _session_aborts(item.session)
+            ):
+                _teardown_rerun_scope(item)
+            # the pending reruns are cancelled if the session stops here
+            self._flush_parked()
+            self._run_deferred()
+        elif self._ends_rerun_group(item, nextitem):
+            # the item was torn down for the next one, so the reruns of the
+            # group share a fresh setup of the fixtures of the scope
+            self._run_deferred(nextitem)
+        return result
+
+    def _ends_rerun_group(self, item, nextitem):
+        """Return whether the --reruns-scope group of the item reruns after it."""
+        return bool(
+            self.deferred
+            and item.config.option.reruns_scope
+            and nextitem is not None
+            and _ends_rerun_scope(item, nextitem)
+        )
+
+    def _run_with_due_parked(self, item, nextitem):
+        """Run an item followed by the parked items which are due."""
+        # Each item is torn down for the following one, so the fixtures they
+        # share are kept.
+        items = [item]
+        while self.parked and self.parked[0][0] <= time.monotonic():
+            items.append(heapq.heappop(self.parked)[2])
+        for index, current in enumerate(items):
+            if index and _session_aborts(item.session):
+                # the pending reruns are cancelled
+                _cancel_rerun(current)
+                continue
+            following = items[index + 1] if index + 1 < len(items) else nextitem
+            if self._run(current, following, resumed=index > 0) is None:
+                _run_test_protocol(current, following)
+
+    def _flush_parked(self):
+        """Run the parked items after the last one, waiting until they are due."""
+        while self.parked:
+            due, _, item = heapq.heappop(self.parked)
+            if _session_aborts(item.session):
+                _cancel_rerun(item)
+                continue
+            _sleep_until(due)
+            self._run(item, None, resumed=True)
+
+    def _run_deferred(self, nextitem=None):
+        """Run the deferred reruns, followed by nextitem."""
+        deferred, self.deferred = self.deferred, []
+        # the reruns of this phase follow their failed attempt right away and
+        # keep the higher-scoped fixtures meanwhile
+        self.running_deferred = True
+        try:
+            for index, (due, item) in enumerate(deferred):
+                if _session_aborts(item.session):
+                    _cancel_rerun(item)
+                    continue
+                following = (
+                    deferred[index + 1][1] if index + 1 < len(deferred) else nextitem
+                )
+                _sleep_until(due)
+                self._run(item, following, resumed=True)
+        finally:
+            self.running_deferred = False
+
+    def _run(self, item, nextitem, resumed=False):
+        """Run the attempts of an item; return None if it is never rerun."""
+        policy = _get_policy(item)
+        if policy.excluded:
+            return
+
+        reruns = policy.reruns
+        if reruns is None:
+            # global setting is not specified, and this test is not marked with
+            # flaky
+            return
+
+        if reruns and item.session.config.option.usepdb:
+            # the global options are already rejected in check_options(); this
+            # catches reruns requested via the flaky marker, which are only
+            # known once the item is available
+            raise pytest.UsageError("--reruns incompatible with --pdb")
+
+        parallel = not is_master(item.config)
+        db = item.session.config.failures_db
+        if not resumed:
+            if parallel:
+                # served from a cache on the workers, see ClientStatusDB
+                item.execution_count = db.get_test_failures(item.stash[_test_id_key])
             else:
-                # failure detected and reruns not exhausted, since i < reruns
-                max_suite_reruns = item.session.config.option.max_suite_reruns
-                if max_suite_reruns is not None:
-                    if not db.try_increment_suite_reruns(max_suite_reruns):
-                        # Suite-wide limit exhausted -- log as final failure.
+                item.execution_count = 0
+            # the time spent on the attempts and delays before the current one
+            item._rerun_elapsed = 0.0
+            item._last_signature = None
+            item._identical_failures = 0
+            item._reschedule_rerun = False
+            item._spent_fixture = None
+            # whether the item is kept set up for the next attempt
+            item._snapshot = False
+            item._isolated = policy.isolate
+
+            if item.execution_count > reruns:
+                return True
+
+        # the first attempt may pass, so it is run in a child as well
+        snapshot = (
+            item.config.option.rerun_snapshot is not None
+            and reruns > 0
+            and not item._isolated
+        )
+        # the reruns run in a child of the template
+        fresh_template = item.config.stash.get(_fresh_template_key, None)
+        park_until = None
+        need_to_run = True
+        while need_to_run:
+            item.execution_count += 1
+            item.ihook.pytest_runtest_logstart(
+                nodeid=item.nodeid, location=item.location
+            )
+            if fresh_template is not None and item.execution_count > 1:
+                reports = fresh_template.run(item)
+            elif item._isolated:
+                reports = _run_isolated_attempt(item)
+            elif snapshot:
+                reports = _run_snapshot_attempt(item, nextitem)
+            else:
+                reports = runtestprotocol(item, nextitem=nextitem, log=False)
+
+            rerun_triggered = False
+            for report in reports:  # 3 reports: setup, call, teardown
+                report.rerun = item.execution_count - 1
+                if rerun_triggered or _should_not_rerun(item, report, reruns):
+                    # no rerun needed or one already triggered, log normally
+                    item.ihook.pytest_runtest_logreport(report=report)
+                else:
+                    # failure detected and reruns not exhausted, since i < reruns
+                    stop_reason = _get_rerun_stop_reason(item)
+                    if stop_reason is not None:
+                        # e.g. a deterministic failure, another attempt would
+                        # fail the same way
+                        report.rerun_stopped = stop_reason
                         _restore_suspended_finalizers(item)
                         item.ihook.pytest_runtest_logreport(report=report)
                         continue
 
-                report.outcome = "rerun"
-                time.sleep(delay * delay_backoff_factor ** (item.execution_count - 1))
+                    delay = _get_rerun_delay(item, policy)
+                    reserved_cost = None
+                    max_suite_reruns, max_cost = _get_suite_budget(item.config)
+                    if max_suite_reruns is not None or max_cost is not None:
+                        # the rerun is charged the time of the failed attempt
+                        # and the delay before it
+                        cost = _to_milliseconds(
+                            sum(r.duration for r in reports) + delay
+                        )
+                        if not db.try_increment_suite_reruns(
+                            max_suite_reruns, cost, max_cost
+                        ):
+                            # Suite-wide limit exhausted -- log as final failure.
+                            _restore_suspended_finalizers(item)
+                            item.ihook.pytest_runtest_logreport(report=report)
+                            continue
+                        reserved_cost = cost
+
+                    report.outcome = "rerun"
+                    item._rerun_elapsed += item._attempt_duration + delay
+                    if item._reschedule_rerun:
+                        # the controller hands the rerun to a worker, see
+                        # XDistHooks.pytest_runtest_logreport
+                        report.rerun_rescheduled = True
+                        if reserved_cost is not None:
+                            report.rerun_reserved_cost = reserved_cost
+                        # the controller holds the rerun back, so the worker
+                        # runs other tests meanwhile
+                        report.rerun_delay = delay
+                    elif self._postpones_rerun(item, delay):
+                        park_until = time.monotonic() + delay
+                        # logged as the final outcome if the rerun is cancelled
+                        item._postponed_report = report
+                    else:
+                        time.sleep(delay)
+
+                    if not parallel or works_with_current_xdist():
+                        # will rerun test, log intermediate result
+                        item.ihook.pytest_runtest_logreport(report=report)
 
-                if not parallel or works_with_current_xdist():
-                    # will rerun test, log intermediate result
-                    item.ihook.pytest_runtest_logreport(report=report)
+                    if item._snapshot:
+                        if item.config.option.rerun_circuit_breaker is not None:
+                            # the attempt ends without a teardown report
+                            item.config.failures_db.record_test_outcome(
+                                True, item.config.option.rerun_circuit_breaker_window
+                            )
+                    else:
+                        # cleanin item's cashed results from any level of setups
+                        _remove_cached_results_from_failed_fixtures(item)
+                        _remove_failed_setup_state_from_session(item)
+                        _discard_test_class_instance(item)
+                    _remove_failed_subtests_from_report(item, report)
+                    _remove_failed_subtest_reports_from_stats(item)
+
+                    rerun_triggered = True
+
+            need_to_run = rerun_triggered and not item._reschedule_rerun
+            if item._isolated and (not need_to_run or park_until is not None):
+                _teardown_isolated(item, nextitem)
+            if not rerun_triggered:
+                if item._snapshot:
+                    _teardown_snapshot(item, nextitem)
+                # the teardown hook decides before the teardown duration is
+                # known, so it may have kept the fixtures for a rerun which
+                # exceeds the time limits
+                _restore_suspended_finalizers(item)
+
+            item.ihook.pytest_runtest_logfinish(
+                nodeid=item.nodeid, location=item.location
+            )
+
+            if need_to_run and park_until is not None:
+                if item.config.option.reruns_defer or item.config.option.reruns_scope:
+                    self.deferred.append((park_until, item))
+                else:
+                    entry = (park_until, next(self._parked_count), item)
+                    heapq.heappush(self.parked, entry)
+                return True
 
-                # cleanin item's cashed results from any level of setups
-                _remove_cached_results_from_failed_fixtures(item)
-                _remove_failed_setup_state_from_session(item)
-                _discard_test_class_instance(item)
-                _remove_failed_subtests_from_report(item, report)
-                _remove_failed_subtest_reports_from_stats(item)
+        return True
 
-                rerun_triggered = True
 
-        need_to_run = rerun_triggered
+ADAPTIVE_RERUNS_NAME = "rerunfailures-adaptive"
 
-        item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
 
-    return True
+class AdaptiveReruns:
+    """Record the outcome of every test for --reruns-adaptive.
+
+    Runs in the process reporting the results, i.e. the xdist controller, and
+    keeps the last ``ADAPTIVE_HISTORY_SIZE`` runs of every test in the cache.
+    """
+
+    def __init__(self):
+        self.reruns: dict[str, int] = {}
+        self.failed: set[str] = set()
+        self.passed: set[str] = set()
+
+    def pytest_runtest_logreport(self, report):
+        if report.outcome == "rerun":
+            self.reruns[report.nodeid] = self.reruns.get(report.nodeid, 0) + 1
+        elif report.failed:
+            self.failed.add(report.nodeid)
+        elif report.when == "call" and report.passed:
+            self.passed.add(report.nodeid)
+
+    def pytest_sessionfinish(self, session):
+        cache = session.config.cache
+        history = cache.get(ADAPTIVE_CACHE_KEY, {})
+        for nodeid in self.passed | self.failed:
+            reruns = self.reruns.get(nodeid, 0)
+            if nodeid not in self.failed:
+                outcome = reruns
+            elif reruns:
+                outcome = ADAPTIVE_FAILED_AFTER_RERUNS
+            else:
+                outcome = ADAPTIVE_FAILED_WITHOUT_RERUNS
+            runs = history.get(nodeid, []) + [outcome]
+            history[nodeid] = runs[-ADAPTIVE_HISTORY_SIZE:]
+        cache.set(ADAPTIVE_CACHE_KEY, history)
+
+
+RERUN_HISTORY_NAME = "rerunfailures-history"
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS attempts (
+    run TEXT NOT NULL,
+    nodeid TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    outcome TEXT NOT NULL,
+    duration REAL NOT NULL,
+    signature TEXT,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_nodeid ON attempts (nodeid, run);
+"""
+
+# per test: the runs, the runs in which it failed and then passed on a rerun,
+# and the time of the failed attempts which were rerun
+HISTORY_TESTS_QUERY = """
+SELECT nodeid,
+       COUNT(*) AS runs,
+       SUM(reruns > 0 AND failures = 0) AS flaky,
+       SUM(wasted) AS wasted
+FROM (
+    SELECT nodeid,
+           SUM(outcome = 'rerun') AS reruns,
+           SUM(outcome = 'failed') AS failures,
+           SUM(CASE WHEN outcome = 'rerun' THEN duration ELSE 0 END) AS wasted
+    FROM attempts
+    GROUP BY nodeid, run
+)
+GROUP BY nodeid
+"""
+
+HISTORY_REPORT_SIZE = 10
+
+# per test: the average attempt duration and the share of runs with reruns,
+# leaving out the attempts recorded after the session started
+HISTORY_RERUN_COST_QUERY = """
+SELECT nodeid, AVG(duration), AVG(reruns > 0)
+FROM (
+    SELECT nodeid,
+           AVG(duration) AS duration,
+           SUM(outcome = 'rerun') AS reruns
+    FROM attempts
+    WHERE run != ? AND timestamp < ?
+    GROUP BY nodeid, run
+)
+GROUP BY nodeid
+HAVING SUM(reruns > 0) > 0
+"""
+
+
+def _get_history_path(config):
+    path = config.option.rerun_history_path
+    if path is not None:
+        return path
+    cache = getattr(config, "cache", None)
+    if cache is None:
+        raise pytest.UsageError(
+            "--rerun-history needs the cacheprovider plugin or --rerun-history-path"
+        )
+    return str(cache.mkdir("rerunfailures") / "history.sqlite")
+
+
+def _get_run_id(config):
+    """Return an ID shared by the controller and the workers of a session."""
+    workerinput = getattr(config, "workerinput", None)
+    if workerinput is not None and "testrunuid" in workerinput:
+        return workerinput["testrunuid"]
+    return uuid.uuid4().hex
+
+
+def _connect_history(path):
+    # WAL lets the xdist workers and other sessions on this machine write
+    # concurrently, the timeout waits for their transactions
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(HISTORY_SCHEMA)
+    return connection
+
+
+def _get_attempt_outcome(reports):
+    outcomes = [report.outcome for report in reports]
+    for outcome in ("rerun", "failed", "skipped"):
+        if outcome in outcomes:
+            return outcome
+    return "passed"
+
+
+class RerunHistory:
+    """Record the attempts of the tests run by this process.
+
+    The rows are buffered and written in batches, with each process of a
+    session writing the attempts it ran.
+    """
+
+    # rows buffered before they are written
+    batch_size = 500
+
+    def __init__(self, path, run_id):
+        self.path = path
+        self.run_id = run_id
+        self.rows: list[tuple[Any, ...]] = []
+        # the reports of the attempts in progress, by node ID
+        self._attempts: dict[str, list[Any]] = {}
+
+    def pytest_runtest_logreport(self, report):
+        if getattr(report, "node", None) is not None:
+            # received from an xdist worker, which records it itself
+            return
+        self._attempts.setdefault(report.nodeid, []).append(report)
+
+    def pytest_runtest_logfinish(self, nodeid):
+        # an attempt may end without a teardown report, e.g. with
+        # --rerun-snapshot or after a crash of its process
+        reports = self._attempts.pop(nodeid, None)
+        if not reports:
+            return
+        signature = None
+        for attempt_report in reports:
+            if attempt_report.failed or attempt_report.outcome == "rerun":
+                crash = _get_crash_signature(attempt_report)
+                if crash is not None:
+                    signature = "{}:{}: {}".format(*crash)
+                break
+        self.rows.append((
+            self.run_id,
+            nodeid,
+            getattr(reports[-1], "rerun", 0) + 1,
+            _get_attempt_outcome(reports),
+            sum(attempt_report.duration for attempt_report in reports),
+            signature,
+            time.time(),
+        ))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows in one transaction."""
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        connection = _connect_history(self.path)
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT INTO attempts VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+                )
+        finally:
+            connection.close()
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_sessionfinish(self, session):
+        # before the terminal summary, which may report on the history
+        self.flush()
+
+
+def _query_history(path):
+    """Return the flakiest tests and the tests with the most time rerun."""
+    if not os.path.exists(path):
+        return [], []
+    connection = _connect_history(path)
+    try:
+        tests = connection.execute(HISTORY_TESTS_QUERY).fetchall()
+    finally:
+        connection.close()
+    flaky = sorted(
+        (row for row in tests if row[2]),
+        key=lambda row: (-row[2] / row[1], -row[2], row[0]),
+    )
+    wasted = sorted((row for row in tests if row[3]), key=lambda row: -row[3])
+    return flaky[:HISTORY_REPORT_SIZE], wasted[:HISTORY_REPORT_SIZE]
+
+
+def _get_rerun_costs(config):
+    """Return the expected rerun time of the tests rerun in the history."""
+    path = _get_history_path(config)
+    if not os.path.exists(path):
+        return {}
+    connection = _connect_history(path)
+    try:
+        rows = connection.execute(
+            HISTORY_RERUN_COST_QUERY,
+            (_get_run_id(config), config.stash[_history_cutoff_key]),
+        ).fetchall()
+    finally:
+        connection.close()
+    return {nodeid: duration * share for nodeid, duration, share in rows}
+
+
+def _order_flaky_first(config, items):
+    """Move the tests with the highest expected rerun time to the front."""
+    costs = _get_rerun_costs(config)
+    if not costs:
+        return
+    # the order is stable, the other tests keep their order
+    items.sort(key=lambda item: -costs.get(item.nodeid, 0))
+
+
+def show_rerun_history(terminalreporter):
+    path = _get_history_path(terminalreporter.config)
+    flaky, wasted = _query_history(path)
+    lines = ["flakiest tests (flaky runs / runs):"]
+    lines.extend(
+        f"{flaky_runs / runs:7.1%} {flaky_runs}/{runs} {nodeid}"
+        for nodeid, runs, flaky_runs, _ in flaky
+    )
+    if not flaky:
+        lines.append("no flaky tests recorded")
+    lines.append("most time spent on failed attempts which were rerun:")
+    lines.extend(f"{seconds:8.2f}s {nodeid}" for nodeid, _, _, seconds in wasted)
+    if not wasted:
+        lines.append("no reruns recorded")
+    return lines
 
 
 def pytest_report_teststatus(report):
@@ -1014,6 +3709,11 @@ def pytest_report_teststatus(report):
 def pytest_terminal_summary(terminalreporter):
     # Adapted from https://pytest.org/latest/_modules/_pytest/skipping.html
     tr = terminalreporter
+    if tr.config.getoption("rerun_history_report", False):
+        tr._tw.sep("=", "rerun history")
+        for line in show_rerun_history(terminalreporter):
+            tr._tw.line(line)
+
     show_tracebacks = tr.config.getoption("rerun_show_tracebacks", False)
     if not show_tracebacks and not any(c in "rR" for c in tr.reportchars):
         return
@@ -1031,11 +3731,20 @@ def show_rerun(terminalreporter, show_tracebacks=False):
         lines.append(f"RERUN {rep.nodeid}")
         if show_tracebacks and rep.longrepr:
             lines.extend(str(rep.longrepr).splitlines())
+    for key in ("failed", "error"):
+        for rep in terminalreporter.stats.get(key, []):
+            reason = getattr(rep, "rerun_stopped", None)
+            if reason:
+                lines.append(f"RERUN STOPPED {rep.nodeid} - {reason}")
     return lines
 
 
 @pytest.hookimpl(trylast=True)
 def pytest_sessionfinish(session, exitstatus):
+    template = session.config.stash.get(_fresh_template_key, None)
+    if template is not None:
+        template.close()
+
     if exitstatus != 0:
         return
 
@@ -1,5 +1,13 @@
+import abc
+import multiprocessing
+import os
+import queue
 import random
+import socket
+import sqlite3
+import threading
 import time
+from array import array
 from textwrap import indent
 from types import SimpleNamespace
 from unittest import mock
@@ -8,9 +16,20 @@ import pytest
 
 from pytest_rerunfailures import (
     HAS_PYTEST_HANDLECRASHITEM,
+    HISTORY_SCHEMA,
+    ClientStatusDB,
+    ServerStatusDB,
+    SharedStatusDB,
     StatusDB,
     SubtestReport,
     XDistHooks,
+    _are_local_specs,
+    _ErrorMatcher,
+    _get_adaptive_reruns,
+    _get_crashitem_id,
+    _get_marker,
+    _XDistController,
+    evaluate_condition,
 )
 
 pytest_plugins = "pytester"
@@ -119,6 +138,39 @@ def test_no_rerun_on_pass(testdir):
     assert_outcomes(result)
 
 
+@pytest.mark.parametrize(
+    "args, marker, registered",
+    [
+        ((), "", False),
+        (("--reruns", "1", "--rerun-exclude-path", "."), "", False),
+        (("--reruns", "1"), "", True),
+        ((), "@pytest.mark.flaky(reruns=1)", True),
+    ],
+)
+def test_runtest_hooks_registered_only_when_reruns_possible(
+    testdir, args, marker, registered
+):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        {marker}
+        def test_pass():
+            pass
+        """
+    )
+    testdir.makeconftest(
+        """
+        def pytest_sessionfinish(session):
+            hooks = session.config.pluginmanager.has_plugin("rerunfailures-runtest")
+            print(f"RUNTEST HOOKS: {hooks}")
+        """
+    )
+    result = testdir.runpytest("-s", *args)
+    result.stdout.fnmatch_lines(f"*RUNTEST HOOKS: {registered}")
+    assert_outcomes(result)
+
+
 def test_no_rerun_on_skipif_mark(testdir):
     reason = str(random.random())
     testdir.makepyfile(
@@ -344,6 +396,27 @@ def test_max_suite_reruns_caps_temporary_test_crash(testdir):
     check_outcome_field(result.parseoutcomes(), "rerun", 1)
 
 
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+@pytest.mark.parametrize(
+    "args, db_class",
+    [
+        ((), "StatusDB"),
+        (("-n", "0"), "StatusDB"),
+        (("-n", "1"), "SharedStatusDB" if os.name == "posix" else "ServerStatusDB"),
+    ],
+)
+def test_status_db_server_is_started_only_for_xdist_workers(testdir, args, db_class):
+    testdir.makeconftest(
+        """
+        def pytest_unconfigure(config):
+            print("failures_db:", type(config.failures_db).__name__)
+        """
+    )
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest("-p", "xdist", "-s", "--reruns", "1", *args)
+    result.stdout.fnmatch_lines([f"*failures_db: {db_class}"])
+
+
 def test_xdist_crash_rerun_releases_cap_when_scheduler_rejects():
     db = StatusDB()
     db.get_test_reruns = lambda _: 1
@@ -355,16 +428,289 @@ def test_xdist_crash_rerun_releases_cap_when_scheduler_rejects():
     sched = SimpleNamespace(
         config=SimpleNamespace(
             failures_db=db,
-            option=SimpleNamespace(max_suite_reruns=1),
+            option=SimpleNamespace(max_suite_reruns=1, max_suite_rerun_seconds=60),
         ),
+        collection=["test_pass", "test_crash"],
         mark_test_pending=mark_test_pending,
     )
-    report = SimpleNamespace(outcome="failed", longrepr=None)
+    report = SimpleNamespace(outcome="failed", longrepr=None, duration=2.5)
 
     XDistHooks().pytest_handlecrashitem("test_crash", report, sched)
 
     assert report.outcome == "failed"
     assert db.get_suite_reruns() == 0
+    assert db.get_suite_rerun_cost() == 0
+
+
+def test_crashitem_id_is_the_index_in_the_scheduler_collection():
+    load = SimpleNamespace(collection=["test_a", "test_b"])
+    each = SimpleNamespace(node2collection={"gw0": ["test_a", "test_b"]})
+
+    assert _get_crashitem_id(load, "test_b") == 1
+    assert _get_crashitem_id(each, "test_b") == 1
+    assert _get_crashitem_id(load, "test_c") is None
+    assert _get_crashitem_id(SimpleNamespace(), "test_a") is None
+
+
+def test_crashitem_id_indexes_the_collection_once():
+    class Collection(list):
+        index = mock.Mock(side_effect=AssertionError("searched the collection"))
+
+    sched = SimpleNamespace(collection=Collection(["test_a", "test_b", "test_a"]))
+
+    assert _get_crashitem_id(sched, "test_b") == 1
+    assert _get_crashitem_id(sched, "test_a") == 0
+    sched.collection.index.assert_not_called()
+
+
+def test_socket_status_db_round_trip():
+    server = ServerStatusDB()
+    client = ClientStatusDB(server.sock_port)
+
+    client.set_test_reruns(0, 3)
+    client.add_test_failure(0)
+    client.add_test_failure(0)
+
+    assert client.get_test_reruns(0) == 3
+    assert client.get_test_failures(0) == 2
+    assert client.get_test_failures(1) == 0
+    assert client.try_increment_suite_reruns(2)
+    assert client.increment_suite_reruns() == 2
+    assert not client.try_increment_suite_reruns(2)
+    client.decrement_suite_reruns()
+    assert client.get_suite_reruns() == 1
+    assert server.get_suite_reruns() == 1
+
+    client.close()
+    server.close()
+
+
+def test_server_status_db_serves_all_clients_from_one_thread():
+    server = ServerStatusDB()
+    threads_before = threading.active_count()
+    clients = [ClientStatusDB(server.sock_port) for _ in range(20)]
+
+    def use(index, client):
+        for _ in range(50):
+            client.add_test_failure(index)
+            client.try_increment_suite_reruns(10**6)
+
+    workers = [
+        threading.Thread(target=use, args=(i, client))
+        for i, client in enumerate(clients)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert threading.active_count() == threads_before
+    failures = [server.get_test_failures(i) for i in range(20)]
+    assert failures == [50] * 20
+    assert server.get_suite_reruns() == 1000
+
+    for client in clients:
+        client.close()
+    server.close()
+    assert not server._thread.is_alive()
+
+
+def test_client_status_db_reconnects_after_connection_loss():
+    server = ServerStatusDB()
+    client = ClientStatusDB(server.sock_port)
+    client.set_test_reruns(0, 2)
+
+    client.sock.shutdown(socket.SHUT_RDWR)
+
+    assert client.get_test_reruns(0) == 2
+
+    client.close()
+    server.close()
+
+
+def test_client_status_db_does_not_resend_after_a_lost_reply(monkeypatch):
+    server = ServerStatusDB()
+    client = ClientStatusDB(server.sock_port)
+    client.get_suite_reruns()  # connect
+    monkeypatch.setattr(client, "_read_reply", mock.Mock(side_effect=TimeoutError))
+
+    with pytest.raises(TimeoutError):
+        client.try_increment_suite_reruns(None, 100)
+
+    monkeypatch.undo()
+    # the server applied the request once, the next one uses a new connection
+    assert client.get_suite_reruns() == 1
+    assert client.get_suite_rerun_cost() == 100
+
+    client.close()
+    server.close()
+
+
+def test_client_status_db_does_not_block_forever_on_hung_controller(monkeypatch):
+    monkeypatch.setattr(ClientStatusDB, "timeout", 0.1)
+    listener = socket.create_server(("127.0.0.1", 0))
+    client = ClientStatusDB(listener.getsockname()[1])
+
+    with pytest.raises(TimeoutError):
+        client.get_test_reruns(0)
+    listener.close()
+    client.close()
+
+
+def test_client_status_db_caches_failures_pushed_by_server():
+    server = ServerStatusDB()
+    server.add_test_failure(0)
+    client = ClientStatusDB(server.sock_port)
+    client.set_test_reruns_many(array("i", [2, 3]))
+    assert client.get_test_failures(0) == 1
+
+    # the controller records crashes, the change reaches the cache unasked
+    server.add_test_failure(1)
+    pushed = threading.Event()
+    for _ in range(500):
+        if client.get_test_failures(1):
+            break
+        pushed.wait(0.01)
+    assert client.get_test_failures(1) == 1
+    assert client.get_test_reruns(0) == 2
+    assert client.get_test_reruns(1) == 3
+
+    client.close()
+    server.close()
+
+
+def test_client_status_db_reads_a_known_failure_count_from_the_server(monkeypatch):
+    server = ServerStatusDB()
+    server.add_test_failure(0)
+    client = ClientStatusDB(server.sock_port)
+    assert client.get_test_failures(0) == 1
+
+    # the push of the next change is delayed beyond the lookup
+    monkeypatch.setattr(server, "_broadcast", mock.Mock())
+    server.add_test_failure(0)
+
+    assert client.get_test_failures(0) == 2
+    # a test which never failed is read from the cache
+    assert client.get_test_failures(1) == 0
+
+    client.close()
+    server.close()
+
+
+posix_only = pytest.mark.skipif(os.name != "posix", reason="requires fcntl")
+
+
+@posix_only
+def test_shared_status_db_round_trip():
+    controller = SharedStatusDB()
+    worker = SharedStatusDB(controller.path)
+
+    worker.set_test_reruns_many(array("i", [3, 0, 2]))
+    worker.add_test_failure(2)
+    controller.add_test_failure(2)
+    # a test ID beyond the mapping of the other process
+    controller.add_test_failure(100_000)
+
+    assert controller.get_test_reruns(0) == 3
+    assert controller.get_test_reruns(2) == 2
+    assert worker.get_test_failures(2) == 2
+    assert worker.get_test_failures(100_000) == 1
+    assert worker.get_test_failures(200_000) == 0
+    assert worker.try_increment_suite_reruns(2)
+    assert controller.increment_suite_reruns() == 2
+    assert not worker.try_increment_suite_reruns(2)
+    controller.decrement_suite_reruns()
+    assert worker.get_suite_reruns() == 1
+
+    worker.close()
+    controller.close()
+    assert not os.path.exists(controller.path)
+
+
+def _open_status_dbs(backend):
+    if backend == "socket":
+        server = ServerStatusDB()
+        return server, ClientStatusDB(server.sock_port)
+    controller = SharedStatusDB()
+    return controller, SharedStatusDB(controller.path)
+
+
+@pytest.mark.parametrize(
+    "backend", ["socket", pytest.param("shared", marks=posix_only)]
+)
+def test_status_db_charges_rerun_time_to_the_suite_budget(backend):
+    controller, worker = _open_status_dbs(backend)
+
+    assert worker.try_increment_suite_reruns(None, 600, 1000)
+    assert worker.try_increment_suite_reruns(None, 600, 1000)
+    # the budget is spent, the count cap does not matter
+    assert not worker.try_increment_suite_reruns(None, 1, 1000)
+    assert not worker.try_increment_suite_reruns(10, 1, 1000)
+    assert controller.get_suite_rerun_cost() == 1200
+    worker.decrement_suite_reruns(600)
+    assert worker.get_suite_rerun_cost() == 600
+    assert worker.get_suite_reruns() == 1
+    assert not worker.try_increment_suite_reruns(1, 0, 1000)
+
+    worker.close()
+    controller.close()
+
+
+@pytest.mark.parametrize(
+    "backend", ["memory", "socket", pytest.param("shared", marks=posix_only)]
+)
+def test_status_db_keeps_a_sliding_window_of_outcomes(backend):
+    if backend == "memory":
+        controller = worker = StatusDB()
+    else:
+        controller, worker = _open_status_dbs(backend)
+
+    for failed in (True, True, False):
+        worker.record_test_outcome(failed, 4)
+    assert worker.get_window_failures() == (2, 3)
+    for failed in (False, True, False, False):
+        worker.record_test_outcome(failed, 4)
+    # the first four outcomes left the window
+    assert worker.get_window_failures() == (1, 4)
+    for _ in range(3):
+        worker.record_test_outcome(True, 4)
+    assert worker.get_window_failures() == (3, 4)
+
+    worker.close()
+    controller.close()
+
+
+def _increment_shared_suite_reruns(path, cap, count):
+    db = SharedStatusDB(path)
+    for _ in range(count):
+        db.try_increment_suite_reruns(cap)
+    db.close()
+
+
+@posix_only
+def test_shared_status_db_respects_cap_across_processes():
+    db = SharedStatusDB()
+    ctx = multiprocessing.get_context("fork")
+    processes = [
+        ctx.Process(target=_increment_shared_suite_reruns, args=(db.path, 500, 200))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert db.get_suite_reruns() == 500
+    db.close()
+
+
+@posix_only
+def test_shared_status_db_is_used_for_local_workers_only():
+    execnet = pytest.importorskip("execnet")
+
+    assert _are_local_specs([execnet.XSpec("popen"), execnet.XSpec("popen")])
+    assert not _are_local_specs([execnet.XSpec("popen"), execnet.XSpec("ssh=host")])
+    assert not _are_local_specs([execnet.XSpec("popen//via=gw0")])
 
 
 def test_rerun_passes_after_temporary_test_failure_with_flaky_mark(testdir):
@@ -649,1556 +995,3581 @@ def test_reruns_with_negative_delay_backoff_factor(testdir):
     assert_outcomes(result, passed=0, failed=1, rerun=2)
 
 
-def test_rerun_on_setup_class_with_error_with_reruns(testdir):
-    """
-    Case: setup_class throwing error on the first execution for parametrized test
-    """
+def test_reruns_delay_nonblocking_runs_other_tests_first(testdir):
     testdir.makepyfile(
+        test_one="""
+            import pytest
+
+            def log(message):
+                with open("log", "a") as f:
+                    f.write(message + "\\n")
+
+            @pytest.fixture(scope="module", autouse=True)
+            def module_one():
+                log("setup-one")
+                yield
+                log("teardown-one")
+
+            @pytest.mark.flaky(reruns=1, reruns_delay=0.2)
+            def test_flaky():
+                log("flaky")
+                if open("log").read().count("flaky") == 1:
+                    raise ValueError()
+        """,
+        test_two="""
+            import time
+
+            def log(message):
+                with open("log", "a") as f:
+                    f.write(message + "\\n")
+
+            def test_slow():
+                log("slow")
+                end = time.perf_counter() + 0.5
+                while time.perf_counter() < end:
+                    pass
+
+            def test_next():
+                log("next")
+
+            def test_last():
+                log("last")
+        """,
+    )
+    result = testdir.runpytest("--reruns-delay-nonblocking")
+
+    assert_outcomes(result, passed=4, rerun=1)
+    # the rerun is due when test_next starts and runs right after it
+    assert testdir.tmpdir.join("log").read().split() == [
+        "setup-one",
+        "flaky",
+        "teardown-one",
+        "slow",
+        "next",
+        "setup-one",
+        "flaky",
+        "teardown-one",
+        "last",
+    ]
+
+
+def test_reruns_defer_runs_reruns_after_all_tests(testdir):
+    testdir.makeconftest(
         """
         import pytest
 
-        pass_fixture = False
+        def log(message):
+            with open("log", "a") as f:
+                f.write(message + "\\n")
 
-        class TestFoo(object):
-            @classmethod
-            def setup_class(cls):
-                global pass_fixture
-                if not pass_fixture:
-                    pass_fixture = True
-                    assert False
-                assert True
-            @pytest.mark.parametrize('param', [1, 2, 3])
-            def test_pass(self, param):
-                assert param"""
-    )
-    result = testdir.runpytest("--reruns", "1")
-    assert_outcomes(result, passed=3, rerun=1)
+        def fails_once(name):
+            log(name)
+            if open("log").read().split().count(name) == 1:
+                raise ValueError()
 
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            log("setup-session")
+            yield
+            log("teardown-session")
 
-def test_rerun_on_class_scope_fixture_with_error_with_reruns(testdir):
-    """
-    Case: Class scope fixture throwing error on the first execution
-    for parametrized test
-    """
-    testdir.makepyfile(
+        @pytest.fixture(scope="module", autouse=True)
+        def module_fixture(request):
+            name = request.module.__name__[-1]
+            log(f"setup-{name}")
+            yield
+            log(f"teardown-{name}")
         """
-        import pytest
+    )
+    testdir.makepyfile(
+        test_a="""
+            from conftest import fails_once
 
-        pass_fixture = False
+            def test_a1():
+                fails_once("a1")
 
-        class TestFoo(object):
+            def test_a2():
+                fails_once("a2")
 
-            @pytest.fixture(scope="class")
-            def setup_fixture(self):
-                global pass_fixture
-                if not pass_fixture:
-                    pass_fixture = True
-                    assert False
-                assert True
-            @pytest.mark.parametrize('param', [1, 2, 3])
-            def test_pass(self, setup_fixture, param):
-                assert param"""
+            def test_a3():
+                pass
+        """,
+        test_b="""
+            from conftest import fails_once
+
+            def test_b1():
+                fails_once("b1")
+
+            def test_b2():
+                pass
+        """,
     )
-    result = testdir.runpytest("--reruns", "1")
-    assert_outcomes(result, passed=3, rerun=1)
+    result = testdir.runpytest("--reruns", "1", "--reruns-defer")
+
+    assert_outcomes(result, passed=5, rerun=3)
+    # the reruns of a module share one setup of its fixtures
+    assert testdir.tmpdir.join("log").read().split() == [
+        "setup-session",
+        "setup-a",
+        "a1",
+        "a2",
+        "teardown-a",
+        "setup-b",
+        "b1",
+        "teardown-b",
+        "setup-a",
+        "a1",
+        "a2",
+        "teardown-a",
+        "setup-b",
+        "b1",
+        "teardown-b",
+        "teardown-session",
+    ]
 
 
-def test_rerun_on_module_fixture_with_reruns(testdir):
-    """
-    Case: Module scope fixture is not re-executed when class scope fixture throwing
-    error on the first execution for parametrized test
-    """
-    testdir.makepyfile(
+def test_reruns_scope_module_reruns_failed_tests_after_their_module(testdir):
+    testdir.makeconftest(
         """
         import pytest
 
-        pass_fixture = False
+        def log(message):
+            with open("log", "a") as f:
+                f.write(message + "\\n")
 
-        @pytest.fixture(scope='module')
-        def module_fixture():
-            assert not pass_fixture
+        def fails_once(name):
+            log(name)
+            if open("log").read().split().count(name) == 1:
+                raise ValueError()
 
-        class TestFoo(object):
-            @pytest.fixture(scope="class")
-            def setup_fixture(self):
-                global pass_fixture
-                if not pass_fixture:
-                    pass_fixture = True
-                    assert False
-                assert True
-            def test_pass_1(self, module_fixture, setup_fixture):
-                assert True
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            log("setup-session")
+            yield
+            log("teardown-session")
 
-            def test_pass_2(self, module_fixture, setup_fixture):
-                assert True"""
+        @pytest.fixture(scope="module", autouse=True)
+        def module_fixture(request):
+            name = request.module.__name__[-1]
+            log(f"setup-{name}")
+            yield
+            log(f"teardown-{name}")
+        """
     )
-    result = testdir.runpytest("--reruns", "1")
-    assert_outcomes(result, passed=2, rerun=1)
-
-
-def test_rerun_on_session_fixture_with_reruns(testdir):
-    """
-    Case: Module scope fixture is not re-executed when class scope fixture
-    throwing error on the first execution for parametrized test
-    """
     testdir.makepyfile(
-        """
-        import pytest
+        test_a="""
+            from conftest import fails_once
 
-        pass_fixture = False
+            def test_a1():
+                fails_once("a1")
 
-        @pytest.fixture(scope='session')
-        def session_fixture():
-            assert not pass_fixture
+            def test_a2():
+                fails_once("a2")
 
-        class TestFoo(object):
-            @pytest.fixture(scope="class")
-            def setup_fixture(self):
-                global pass_fixture
-                if not pass_fixture:
-                    pass_fixture = True
-                    assert False
-                assert True
+            def test_a3():
+                pass
+        """,
+        test_b="""
+            from conftest import fails_once
 
-            def test_pass_1(self, session_fixture, setup_fixture):
-                assert True
-            def test_pass_2(self, session_fixture, setup_fixture):
-                assert True"""
+            def test_b1():
+                fails_once("b1")
+
+            def test_b2():
+                pass
+        """,
     )
-    result = testdir.runpytest("--reruns", "1")
-    assert_outcomes(result, passed=2, rerun=1)
+    result = testdir.runpytest("--reruns", "1", "--reruns-scope", "module")
+
+    assert_outcomes(result, passed=5, rerun=3)
+    # the reruns of a module share one fresh setup of its fixtures
+    assert testdir.tmpdir.join("log").read().split() == [
+        "setup-session",
+        "setup-a",
+        "a1",
+        "a2",
+        "teardown-a",
+        "setup-a",
+        "a1",
+        "a2",
+        "teardown-a",
+        "setup-b",
+        "b1",
+        "teardown-b",
+        "setup-b",
+        "b1",
+        "teardown-b",
+        "teardown-session",
+    ]
 
 
-def test_rerun_recreates_test_class_instance(testdir):
-    """
-    Case: state stored on ``self`` by a failed attempt must not leak into the
-    rerun, i.e. every attempt gets a fresh test class instance
-    """
-    testdir.makepyfile(
+def test_reruns_scope_runs_an_unmarked_last_test_before_the_group(testdir):
+    testdir.makeconftest(
         """
         import pytest
 
-        attempts = 0
-
-        class TestFoo(object):
-            @pytest.fixture(autouse=True)
-            def counting_fixture(self):
-                assert not hasattr(self, 'seen_by_fixture')
-                self.seen_by_fixture = True
+        def log(message):
+            with open("log", "a") as f:
+                f.write(message + "\\n")
 
-            @pytest.mark.flaky(reruns=2)
-            def test_fresh_instance(self):
-                global attempts
-                attempts += 1
-                assert not hasattr(self, 'seen_by_test')
-                self.seen_by_test = True
-                assert attempts == 3"""
+        @pytest.fixture(scope="module", autouse=True)
+        def module_fixture(request):
+            name = request.module.__name__[-1]
+            log(f"setup-{name}")
+            yield
+            log(f"teardown-{name}")
+        """
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=1, rerun=2)
+    for name in "ab":
+        testdir.makepyfile(**{
+            f"test_{name}": f"""
+                import pytest
+                from conftest import log
+
+                @pytest.mark.flaky(reruns=1)
+                def test_{name}1():
+                    log("{name}1")
+                    assert open("log").read().split().count("{name}1") > 1
+
+                def test_{name}2():
+                    log("{name}2")
+                """
+        })
+    result = testdir.runpytest("--reruns-scope", "module")
+
+    assert_outcomes(result, passed=4, rerun=2)
+    assert testdir.tmpdir.join("log").read().split() == [
+        "setup-a",
+        "a1",
+        "a2",
+        "teardown-a",
+        "setup-a",
+        "a1",
+        "teardown-a",
+        "setup-b",
+        "b1",
+        "b2",
+        "teardown-b",
+        "setup-b",
+        "b1",
+        "teardown-b",
+    ]
 
 
-def test_rerun_recreates_instance_without_re_executing_scoped_fixtures(testdir):
-    """
-    Case: recreating the test class instance for a rerun must not invalidate
-    fixtures cached at a higher scope than function
-    """
+def test_reruns_scope_sets_up_the_last_module_again_for_its_group(testdir):
     testdir.makepyfile(
         """
+        import itertools
+
         import pytest
 
-        attempts = 0
-        executions = {'session': 0, 'module': 0, 'class': 0}
+        instances = itertools.count(1)
+        seen = []
 
-        @pytest.fixture(scope='session')
-        def session_fixture():
-            executions['session'] += 1
+        @pytest.fixture(scope="module")
+        def resource():
+            return next(instances)
 
-        @pytest.fixture(scope='module')
-        def module_fixture():
-            executions['module'] += 1
+        def test_one(resource):
+            seen.append(resource)
+            assert len(seen) > 2
 
-        @pytest.fixture(scope='class')
-        def class_fixture():
-            executions['class'] += 1
+        def test_two(resource):
+            seen.append(resource)
+            assert len(seen) > 2
 
-        class TestFoo(object):
-            @pytest.mark.flaky(reruns=2)
-            def test_fresh_instance(
-                self, session_fixture, module_fixture, class_fixture
-            ):
-                global attempts
-                attempts += 1
-                assert executions == {'session': 1, 'module': 1, 'class': 1}
-                assert not hasattr(self, 'seen_by_test')
-                self.seen_by_test = True
-                assert attempts == 3"""
-    )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=1, rerun=2)
-
-
-def test_execution_count_exposed(testdir):
-    testdir.makepyfile("def test_pass(): assert True")
-    testdir.makeconftest(
-        """
-        def pytest_runtest_teardown(item):
-            assert item.execution_count == 3"""
-    )
-    result = testdir.runpytest("--reruns", "2")
-    assert_outcomes(result, passed=3, rerun=2)
-
-
-def test_rerun_report(testdir):
-    testdir.makepyfile("def test_pass(): assert False")
-    testdir.makeconftest(
-        """
-        def pytest_runtest_logreport(report):
-            assert hasattr(report, 'rerun')
-            assert isinstance(report.rerun, int)
-            assert report.rerun <= 2
+        def test_pass(resource):
+            pass
         """
     )
-    result = testdir.runpytest("--reruns", "2")
-    assert_outcomes(result, failed=1, rerun=2, passed=0)
-
-
-def test_rerun_report_includes_teardown_from_each_attempt(testdir):
-    testdir.makepyfile("def test_fail(): assert False")
     testdir.makeconftest(
         """
-        reports = []
-
-        def pytest_runtest_logreport(report):
-            reports.append((report.when, report.outcome, report.rerun))
-
-        def pytest_sessionfinish():
-            print(f"REPORTS: {reports!r}")
+        def pytest_sessionfinish(session):
+            module = session.items[0].module
+            with open("seen", "w") as f:
+                f.write(" ".join(map(str, module.seen)))
         """
     )
+    result = testdir.runpytest("--reruns", "1", "--reruns-scope", "module")
 
-    result = testdir.runpytest("--reruns", "1")
-
-    assert_outcomes(result, failed=1, rerun=1, passed=0)
-    expected_reports = (
-        "REPORTS: [('setup', 'passed', 0), ('call', 'rerun', 0), "
-        "('teardown', 'passed', 0), ('setup', 'passed', 1), "
-        "('call', 'failed', 1), ('teardown', 'passed', 1)]"
-    )
-    assert expected_reports in result.stdout.str()
+    assert_outcomes(result, passed=3, rerun=2)
+    # the reruns do not share the instance the failures used
+    assert testdir.tmpdir.join("seen").read().split() == ["1", "1", "2", "2"]
 
 
-def test_single_attempt_triggers_at_most_one_rerun(testdir):
-    testdir.makepyfile("def test_fail(failing_teardown): assert False")
-    testdir.makeconftest(
+def test_reruns_scope_class_reruns_failed_tests_after_their_class(testdir):
+    testdir.makepyfile(
         """
         import pytest
 
-        attempts = 0
-        first_attempt_reports = []
+        def log(message):
+            with open("log", "a") as f:
+                f.write(message + "\\n")
 
-        @pytest.fixture
-        def failing_teardown():
-            global attempts
-            attempts += 1
+        @pytest.fixture(scope="class")
+        def resource(request):
+            log("setup-" + request.cls.__name__)
             yield
-            raise RuntimeError("teardown failure")
+            log("teardown-" + request.cls.__name__)
 
-        def pytest_runtest_logreport(report):
-            if report.rerun == 0 and report.when in ("call", "teardown"):
-                first_attempt_reports.append((report.when, report.outcome))
+        @pytest.mark.usefixtures("resource")
+        class TestOne:
+            runs = 0
 
-        def pytest_sessionfinish():
-            print(f"ATTEMPTS: {attempts}")
-            print(f"FIRST ATTEMPT REPORTS: {first_attempt_reports!r}")
-        """
-    )
+            def test_fails_twice(self):
+                TestOne.runs += 1
+                log("one")
+                assert TestOne.runs > 2
 
-    result = testdir.runpytest("--reruns", "1")
+            def test_pass(self):
+                pass
 
-    stdout = result.stdout.str()
-    assert "ATTEMPTS: 2" in stdout
-    assert (
-        "FIRST ATTEMPT REPORTS: [('call', 'rerun'), ('teardown', 'failed')]" in stdout
+        @pytest.mark.usefixtures("resource")
+        class TestTwo:
+            def test_pass(self):
+                log("two")
+        """
     )
+    result = testdir.runpytest("--reruns", "2", "--reruns-scope", "class")
 
+    assert_outcomes(result, passed=3, rerun=2)
+    # further reruns of the group follow right away and keep the fixtures
+    assert testdir.tmpdir.join("log").read().split() == [
+        "setup-TestOne",
+        "one",
+        "teardown-TestOne",
+        "setup-TestOne",
+        "one",
+        "one",
+        "teardown-TestOne",
+        "setup-TestTwo",
+        "two",
+        "teardown-TestTwo",
+    ]
 
-def test_pytest_runtest_logfinish_is_called(testdir):
-    hook_message = "Message from pytest_runtest_logfinish hook"
+
+def test_reruns_scope_incompatible_with_reruns_defer(testdir):
     testdir.makepyfile("def test_pass(): pass")
-    testdir.makeconftest(
-        rf"""
-        def pytest_runtest_logfinish(nodeid, location):
-            print("\n{hook_message}\n")
-    """
+    result = testdir.runpytest(
+        "--reruns", "1", "--reruns-scope", "module", "--reruns-defer"
     )
-    result = testdir.runpytest("--reruns", "1", "-s")
-    result.stdout.fnmatch_lines(hook_message)
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*--reruns-scope incompatible with --reruns-defer*"])
 
 
-@pytest.mark.parametrize(
-    "only_rerun_texts, should_rerun",
-    [
-        (["AssertionError"], True),
-        (["Assertion*"], True),
-        (["Assertion"], True),
-        (["ValueError"], False),
-        ([""], True),
-        (["AssertionError: "], True),
-        (["AssertionError: ERR"], True),
-        (["ERR"], True),
-        (["AssertionError,ValueError"], False),
-        (["AssertionError ValueError"], False),
-        (["AssertionError", "ValueError"], True),
-    ],
-)
-def test_only_rerun_flag(testdir, only_rerun_texts, should_rerun):
-    testdir.makepyfile("""
-        def test_only_rerun1():
-            raise AssertionError("ERR")
+def test_reruns_delay_nonblocking_waits_for_parked_reruns_at_the_end(testdir):
+    testdir.makepyfile(
+        """
+        def test_fail():
+            assert False
 
-        def test_only_rerun2():
-            assert False, "ERR"
-    """)
+        def test_pass():
+            pass"""
+    )
 
-    num_failed = 2
-    num_passed = 0
-    num_reruns = 2
-    num_reruns_actual = num_reruns * 2 if should_rerun else 0
+    time.sleep = mock.MagicMock()
 
-    pytest_args = ["--reruns", str(num_reruns)]
-    for only_rerun_text in only_rerun_texts:
-        pytest_args.extend(["--only-rerun", only_rerun_text])
-    result = testdir.runpytest(*pytest_args)
-    assert_outcomes(
-        result, passed=num_passed, failed=num_failed, rerun=num_reruns_actual
+    result = testdir.runpytest(
+        "--reruns",
+        "2",
+        "--reruns-delay",
+        "1",
+        "--reruns-delay-backoff-factor",
+        "2",
+        "--reruns-delay-nonblocking",
     )
 
+    # the remaining delays are waited for once the other tests are done
+    assert [call.args[0] for call in time.sleep.call_args_list] == [
+        pytest.approx(1, abs=0.5),
+        pytest.approx(2, abs=0.5),
+    ]
+    assert_outcomes(result, passed=1, failed=1, rerun=2)
+
 
-def test_no_rerun_on_strict_xfail_with_only_rerun_flag(testdir):
+def test_invalid_marker_settings_warn_once_per_marker(testdir):
     testdir.makepyfile(
         """
         import pytest
-        @pytest.mark.xfail(strict=True)
-        def test_xfail():
-            assert True
-    """
-    )
-    result = testdir.runpytest("--reruns", "1", "--only-rerun", "RuntimeError")
-    assert_outcomes(result, passed=0, failed=1, rerun=0)
 
+        @pytest.mark.flaky(reruns="2", reruns_delay=-1)
+        class TestFlaky:
+            def test_a(self):
+                assert False
 
-@pytest.mark.parametrize(
-    "rerun_except_texts, should_rerun",
-    [
-        (["AssertionError"], True),
-        (["Assertion*"], True),
-        (["Assertion"], True),
-        (["ValueError"], False),
-        (["AssertionError: "], True),
-        (["ERR"], False),
-        (["AssertionError", "OSError"], True),
-        (["ValueError", "OSError"], False),
-    ],
-)
-def test_rerun_except_flag(testdir, rerun_except_texts, should_rerun):
-    testdir.makepyfile('def test_rerun_except(): raise ValueError("ERR")')
+            def test_b(self):
+                assert False
+        """
+    )
 
-    num_failed = 1
-    num_passed = 0
-    num_reruns = 1
-    num_reruns_actual = num_reruns if should_rerun else 0
+    time.sleep = mock.MagicMock()
 
-    pytest_args = ["--reruns", str(num_reruns)]
-    for rerun_except_text in rerun_except_texts:
-        pytest_args.extend(["--rerun-except", rerun_except_text])
-    result = testdir.runpytest(*pytest_args)
-    assert_outcomes(
-        result, passed=num_passed, failed=num_failed, rerun=num_reruns_actual
-    )
+    result = testdir.runpytest()
 
+    result.stdout.fnmatch_lines([
+        "*UserWarning: Invalid reruns '2' in flaky marker, expected an integer. "
+        "Using default value: 1",
+        "*UserWarning: Delay time between re-runs cannot be < 0. "
+        "Using default value: 0",
+    ])
+    assert result.parseoutcomes()["warnings"] == 2
+    assert_outcomes(result, passed=0, failed=2, rerun=2)
 
-def test_rerun_exclude_path_prevents_reruns_in_directory(testdir):
-    testdir.makeconftest(
-        """
-        from pathlib import Path
 
-        def pytest_runtest_call(item):
-            with Path("executions").open("a") as execution_log:
-                execution_log.write(item.name + "\\n")
-    """
-    )
+def test_rerun_policy_is_shared_between_items(testdir):
     testdir.makepyfile(
-        test_normal="""
-        def test_normal_failure():
-            assert False
-    """
-    )
-    excluded_dir = testdir.mkdir("excluded")
-    excluded_dir.join("test_excluded.py").write(
         """
-def test_excluded_failure():
-    assert False
-"""
-    )
+        import pytest
 
-    result = testdir.runpytest("--reruns", "2", "--rerun-exclude-path", "excluded")
+        @pytest.mark.flaky(reruns=2, only_rerun=["AssertionError"])
+        def test_a():
+            pass
 
-    assert_outcomes(result, passed=0, failed=2, rerun=2)
-    executions = testdir.tmpdir.join("executions").read().splitlines()
-    assert executions.count("test_normal_failure") == 3
-    assert executions.count("test_excluded_failure") == 1
+        @pytest.mark.flaky(reruns=2, only_rerun=["AssertionError"])
+        def test_b():
+            pass
 
+        @pytest.mark.flaky(reruns=3)
+        def test_c():
+            pass
 
-def test_rerun_exclude_path_prevents_reruns_for_file(testdir):
-    testdir.makeconftest(
-        """
-        from pathlib import Path
+        def test_d():
+            pass
 
-        def pytest_runtest_call(item):
-            with Path("executions").open("a") as execution_log:
-                execution_log.write(item.name + "\\n")
-    """
-    )
-    testdir.makepyfile(
-        test_normal="""
-        def test_normal_failure():
-            assert False
-    """
-    )
-    excluded_dir = testdir.mkdir("excluded")
-    excluded_dir.join("test_excluded.py").write(
+        def test_e():
+            pass
         """
-def test_excluded_failure():
-    assert False
-"""
     )
+    testdir.makeconftest(
+        """
+        from pytest_rerunfailures import _get_policy
 
-    result = testdir.runpytest(
-        "--reruns",
-        "2",
-        "--rerun-exclude-path",
-        "excluded/test_excluded.py",
+        def pytest_collection_finish(session):
+            policies = [_get_policy(item) for item in session.items]
+            print(f"DISTINCT POLICIES: {len(set(map(id, policies)))}")
+        """
     )
-
-    assert_outcomes(result, passed=0, failed=2, rerun=2)
-    executions = testdir.tmpdir.join("executions").read().splitlines()
-    assert executions.count("test_normal_failure") == 3
-    assert executions.count("test_excluded_failure") == 1
+    result = testdir.runpytest("--reruns", "1", "-s")
+    result.stdout.fnmatch_lines("DISTINCT POLICIES: 3")
+    assert_outcomes(result, passed=5)
 
 
-def test_rerun_exclude_path_accepts_multiple_paths(testdir):
-    testdir.makeconftest(
-        """
-        from pathlib import Path
-
-        def pytest_runtest_call(item):
-            with Path("executions").open("a") as execution_log:
-                execution_log.write(item.name + "\\n")
+def test_rerun_on_setup_class_with_error_with_reruns(testdir):
     """
-    )
-    testdir.makepyfile(
-        test_normal="""
-        def test_normal_failure():
-            assert False
+    Case: setup_class throwing error on the first execution for parametrized test
     """
-    )
-    excluded_a_dir = testdir.mkdir("excluded_a")
-    excluded_a_dir.join("test_excluded_a.py").write(
-        """
-def test_excluded_a_failure():
-    assert False
-"""
-    )
-    excluded_b_dir = testdir.mkdir("excluded_b")
-    excluded_b_dir.join("test_excluded_b.py").write(
+    testdir.makepyfile(
         """
-def test_excluded_b_failure():
-    assert False
-"""
-    )
-
-    result = testdir.runpytest(
-        "--reruns",
-        "2",
-        "--rerun-exclude-path",
-        "excluded_a",
-        "--rerun-exclude-path",
-        "excluded_b",
-    )
+        import pytest
 
-    assert_outcomes(result, passed=0, failed=3, rerun=2)
-    executions = testdir.tmpdir.join("executions").read().splitlines()
-    assert executions.count("test_normal_failure") == 3
-    assert executions.count("test_excluded_a_failure") == 1
-    assert executions.count("test_excluded_b_failure") == 1
+        pass_fixture = False
 
+        class TestFoo(object):
+            @classmethod
+            def setup_class(cls):
+                global pass_fixture
+                if not pass_fixture:
+                    pass_fixture = True
+                    assert False
+                assert True
+            @pytest.mark.parametrize('param', [1, 2, 3])
+            def test_pass(self, param):
+                assert param"""
+    )
+    result = testdir.runpytest("--reruns", "1")
+    assert_outcomes(result, passed=3, rerun=1)
 
-def test_rerun_exclude_path_prevents_reruns_for_doctest(testdir):
-    testdir.makeconftest(
-        """
-        from pathlib import Path
 
-        def pytest_runtest_call(item):
-            with Path("executions").open("a") as execution_log:
-                execution_log.write(item.name + "\\n")
+def test_rerun_on_class_scope_fixture_with_error_with_reruns(testdir):
     """
-    )
-    testdir.makepyfile(
-        test_normal="""
-        def test_normal_failure():
-            assert False
+    Case: Class scope fixture throwing error on the first execution
+    for parametrized test
     """
-    )
-    docs_dir = testdir.mkdir("docs")
-    docs_dir.join("guide.txt").write(
+    testdir.makepyfile(
         """
-This example fails:
+        import pytest
 
-    >>> 1 + 1
-    3
-"""
-    )
+        pass_fixture = False
 
-    result = testdir.runpytest(
-        "--doctest-glob=*.txt",
-        "--reruns",
-        "2",
-        "--rerun-exclude-path",
-        "docs/guide.txt",
+        class TestFoo(object):
+
+            @pytest.fixture(scope="class")
+            def setup_fixture(self):
+                global pass_fixture
+                if not pass_fixture:
+                    pass_fixture = True
+                    assert False
+                assert True
+            @pytest.mark.parametrize('param', [1, 2, 3])
+            def test_pass(self, setup_fixture, param):
+                assert param"""
     )
+    result = testdir.runpytest("--reruns", "1")
+    assert_outcomes(result, passed=3, rerun=1)
 
-    assert_outcomes(result, passed=0, failed=2, rerun=2)
-    executions = testdir.tmpdir.join("executions").read().splitlines()
-    assert executions.count("test_normal_failure") == 3
-    assert executions.count("guide.txt") == 1
 
+def test_rerun_on_module_fixture_with_reruns(testdir):
+    """
+    Case: Module scope fixture is not re-executed when class scope fixture throwing
+    error on the first execution for parametrized test
+    """
+    testdir.makepyfile(
+        """
+        import pytest
 
-@pytest.mark.parametrize(
-    "only_rerun_texts, rerun_except_texts, should_rerun",
-    [
-        # Matches --only-rerun, but not --rerun-except (rerun)
-        (["ValueError"], ["Not a Match"], True),
-        (["ValueError", "AssertionError"], ["Not a match", "OSError"], True),
-        # Matches --only-rerun AND --rerun-except (no rerun)
-        (["ValueError"], ["ERR"], False),
-        (["OSError", "ValueError"], ["Not a match", "ERR"], False),
-        # Matches --rerun-except, but not --only-rerun (no rerun)
-        (["OSError", "AssertionError"], ["TypeError", "ValueError"], False),
-        # Matches neither --only-rerun nor --rerun-except (no rerun)
-        (["AssertionError"], ["OSError"], False),
-        # --rerun-except overrides --only-rerun for same arg (no rerun)
-        (["ValueError"], ["ValueError"], False),
-    ],
-)
-def test_rerun_except_and_only_rerun(
-    testdir, rerun_except_texts, only_rerun_texts, should_rerun
-):
-    testdir.makepyfile('def test_only_rerun_except(): raise ValueError("ERR")')
+        pass_fixture = False
 
-    num_failed = 1
-    num_passed = 0
-    num_reruns = 1
-    num_reruns_actual = num_reruns if should_rerun else 0
+        @pytest.fixture(scope='module')
+        def module_fixture():
+            assert not pass_fixture
 
-    pytest_args = ["--reruns", str(num_reruns)]
-    for only_rerun_text in only_rerun_texts:
-        pytest_args.extend(["--only-rerun", only_rerun_text])
-    for rerun_except_text in rerun_except_texts:
-        pytest_args.extend(["--rerun-except", rerun_except_text])
-    result = testdir.runpytest(*pytest_args)
-    assert_outcomes(
-        result, passed=num_passed, failed=num_failed, rerun=num_reruns_actual
+        class TestFoo(object):
+            @pytest.fixture(scope="class")
+            def setup_fixture(self):
+                global pass_fixture
+                if not pass_fixture:
+                    pass_fixture = True
+                    assert False
+                assert True
+            def test_pass_1(self, module_fixture, setup_fixture):
+                assert True
+
+            def test_pass_2(self, module_fixture, setup_fixture):
+                assert True"""
     )
+    result = testdir.runpytest("--reruns", "1")
+    assert_outcomes(result, passed=2, rerun=1)
 
 
-def test_rerun_except_passes_setup_errors(testdir):
+def test_rerun_on_session_fixture_with_reruns(testdir):
+    """
+    Case: Module scope fixture is not re-executed when class scope fixture
+    throwing error on the first execution for parametrized test
+    """
     testdir.makepyfile(
         """
         import pytest
 
-        @pytest.fixture()
-        def fixture_setup_fails(non_existent_fixture):
-            return 1
+        pass_fixture = False
 
-        def test_will_not_run(fixture_setup_fails):
-            assert fixture_setup_fails == 1"""
-    )
+        @pytest.fixture(scope='session')
+        def session_fixture():
+            assert not pass_fixture
 
-    num_reruns = 1
-    pytest_args = ["--reruns", str(num_reruns), "--rerun-except", "ValueError"]
-    result = testdir.runpytest(*pytest_args)
-    assert result.ret != pytest.ExitCode.INTERNAL_ERROR
-    assert_outcomes(result, passed=0, error=1, rerun=num_reruns)
+        class TestFoo(object):
+            @pytest.fixture(scope="class")
+            def setup_fixture(self):
+                global pass_fixture
+                if not pass_fixture:
+                    pass_fixture = True
+                    assert False
+                assert True
 
+            def test_pass_1(self, session_fixture, setup_fixture):
+                assert True
+            def test_pass_2(self, session_fixture, setup_fixture):
+                assert True"""
+    )
+    result = testdir.runpytest("--reruns", "1")
+    assert_outcomes(result, passed=2, rerun=1)
 
-@pytest.mark.parametrize(
-    "rerun_except, expected_reruns",
-    [("ValueError", 0), ("TypeError", 1)],
-)
-def test_rerun_except_setup_error(testdir, rerun_except, expected_reruns):
+
+def test_rerun_recreates_test_class_instance(testdir):
+    """
+    Case: state stored on ``self`` by a failed attempt must not leak into the
+    rerun, i.e. every attempt gets a fresh test class instance
+    """
     testdir.makepyfile(
         """
         import pytest
 
-        @pytest.fixture()
-        def fixture_setup_fails():
-            raise ValueError("setup error")
+        attempts = 0
 
-        def test_will_not_run(fixture_setup_fails):
-            pass
-        """
-    )
+        class TestFoo(object):
+            @pytest.fixture(autouse=True)
+            def counting_fixture(self):
+                assert not hasattr(self, 'seen_by_fixture')
+                self.seen_by_fixture = True
 
-    result = testdir.runpytest("--reruns", "1", "--rerun-except", rerun_except)
-    assert_outcomes(result, passed=0, error=1, rerun=expected_reruns)
+            @pytest.mark.flaky(reruns=2)
+            def test_fresh_instance(self):
+                global attempts
+                attempts += 1
+                assert not hasattr(self, 'seen_by_test')
+                self.seen_by_test = True
+                assert attempts == 3"""
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=1, rerun=2)
 
 
-def test_rerun_except_teardown_error_prevents_rerun(testdir):
-    """Teardown errors covered by --rerun-except must prevent reruns."""
+def test_rerun_recreates_instance_without_re_executing_scoped_fixtures(testdir):
+    """
+    Case: recreating the test class instance for a rerun must not invalidate
+    fixtures cached at a higher scope than function
+    """
     testdir.makepyfile(
         """
         import pytest
 
-        @pytest.fixture()
-        def broken_fixture():
-            yield
-            raise ValueError("teardown error")
+        attempts = 0
+        executions = {'session': 0, 'module': 0, 'class': 0}
 
-        def test_fail_in_fixture(broken_fixture):
-            assert False
-    """
-    )
-
-    result = testdir.runpytest("--reruns", "1", "--rerun-except", "ValueError")
-    assert_outcomes(result, passed=0, failed=1, error=1, rerun=0)
+        @pytest.fixture(scope='session')
+        def session_fixture():
+            executions['session'] += 1
 
+        @pytest.fixture(scope='module')
+        def module_fixture():
+            executions['module'] += 1
 
-@pytest.mark.parametrize(
-    "condition, expected_reruns",
-    [
-        (1 == 1, 2),
-        (1 == 2, 0),
-        (True, 2),
-        (False, 0),
-        (1, 2),
-        (0, 0),
-        (["list"], 2),
-        ([], 0),
-        ({"dict": 1}, 2),
-        ({}, 0),
-        (None, 0),
-    ],
-)
-def test_reruns_with_condition_marker(testdir, condition, expected_reruns):
-    testdir.makepyfile(
-        f"""
-        import pytest
+        @pytest.fixture(scope='class')
+        def class_fixture():
+            executions['class'] += 1
 
-        @pytest.mark.flaky(reruns=2, condition={condition})
-        def test_fail_two():
-            assert False"""
+        class TestFoo(object):
+            @pytest.mark.flaky(reruns=2)
+            def test_fresh_instance(
+                self, session_fixture, module_fixture, class_fixture
+            ):
+                global attempts
+                attempts += 1
+                assert executions == {'session': 1, 'module': 1, 'class': 1}
+                assert not hasattr(self, 'seen_by_test')
+                self.seen_by_test = True
+                assert attempts == 3"""
     )
-
     result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1, rerun=expected_reruns)
-
+    assert_outcomes(result, passed=1, rerun=2)
 
-@pytest.mark.parametrize(
-    "condition, expected_reruns",
-    [('sys.platform.startswith("non-exists") == False', 2), ("os.getpid() != -1", 2)],
-)
-# before evaluating the condition expression, sys&os&platform package has been imported
-def test_reruns_with_string_condition(testdir, condition, expected_reruns):
-    testdir.makepyfile(
-        f"""
-           import pytest
 
-           @pytest.mark.flaky(reruns=2, condition='{condition}')
-           def test_fail_two():
-               assert False"""
+def test_execution_count_exposed(testdir):
+    testdir.makepyfile("def test_pass(): assert True")
+    testdir.makeconftest(
+        """
+        def pytest_runtest_teardown(item):
+            assert item.execution_count == 3"""
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    result = testdir.runpytest("--reruns", "2")
+    assert_outcomes(result, passed=3, rerun=2)
 
 
-def test_reruns_with_string_condition_with_global_var(testdir):
-    testdir.makepyfile(
+def test_rerun_report(testdir):
+    testdir.makepyfile("def test_pass(): assert False")
+    testdir.makeconftest(
+        """
+        def pytest_runtest_logreport(report):
+            assert hasattr(report, 'rerun')
+            assert isinstance(report.rerun, int)
+            assert report.rerun <= 2
         """
-              import pytest
-
-              rerunBool = False
-              @pytest.mark.flaky(reruns=2, condition='rerunBool')
-              def test_fail_two():
-                  global rerunBool
-                  rerunBool = True
-                  assert False"""
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    result = testdir.runpytest("--reruns", "2")
+    assert_outcomes(result, failed=1, rerun=2, passed=0)
 
 
-@pytest.mark.parametrize(
-    "marker_only_rerun,cli_only_rerun,should_rerun",
-    [
-        ("AssertionError", None, True),
-        ("AssertionError: ERR", None, True),
-        (["AssertionError"], None, True),
-        (["AssertionError: ABC"], None, False),
-        ("ValueError", None, False),
-        (["ValueError"], None, False),
-        (["AssertionError", "ValueError"], None, True),
-        # CLI override behavior
-        ("AssertionError", "ValueError", True),
-        ("ValueError", "AssertionError", False),
-    ],
-)
-def test_only_rerun_flag_in_flaky_marker(
-    testdir, marker_only_rerun, cli_only_rerun, should_rerun
-):
-    testdir.makepyfile(
-        f"""
-        import pytest
+def test_rerun_report_includes_teardown_from_each_attempt(testdir):
+    testdir.makepyfile("def test_fail(): assert False")
+    testdir.makeconftest(
+        """
+        reports = []
 
-        @pytest.mark.flaky(reruns=1, only_rerun={marker_only_rerun!r})
-        def test_fail():
-            raise AssertionError("ERR")
+        def pytest_runtest_logreport(report):
+            reports.append((report.when, report.outcome, report.rerun))
+
+        def pytest_sessionfinish():
+            print(f"REPORTS: {reports!r}")
         """
     )
-    args = []
-    if cli_only_rerun:
-        args.extend(["--only-rerun", cli_only_rerun])
-    result = testdir.runpytest(*args)
-    num_reruns = 1 if should_rerun else 0
-    assert_outcomes(result, passed=0, failed=1, rerun=num_reruns)
-
 
-@pytest.mark.parametrize(
-    "filter_kwarg,should_rerun",
-    [
-        ("only_rerun=[AssertionError]", True),
-        ("only_rerun=[ValueError]", False),
-        ("rerun_except=[AssertionError]", False),
-        ("rerun_except=[ValueError]", True),
-    ],
-)
-def test_rerun_filter_accepts_exception_classes(testdir, filter_kwarg, should_rerun):
-    testdir.makepyfile(
-        f"""
-        import pytest
+    result = testdir.runpytest("--reruns", "1")
 
-        @pytest.mark.flaky(reruns=1, {filter_kwarg})
-        def test_fail():
-            raise AssertionError("ERR")
-        """
+    assert_outcomes(result, failed=1, rerun=1, passed=0)
+    expected_reports = (
+        "REPORTS: [('setup', 'passed', 0), ('call', 'rerun', 0), "
+        "('teardown', 'passed', 0), ('setup', 'passed', 1), "
+        "('call', 'failed', 1), ('teardown', 'passed', 1)]"
     )
-    result = testdir.runpytest()
-    num_reruns = 1 if should_rerun else 0
-    assert_outcomes(result, passed=0, failed=1, rerun=num_reruns)
+    assert expected_reports in result.stdout.str()
 
 
-@pytest.mark.parametrize(
-    "marker_rerun_except,cli_rerun_except,raised_error,should_rerun",
-    [
-        ("AssertionError", None, "AssertionError", False),
-        ("AssertionError: ERR", None, "AssertionError", False),
-        (["AssertionError"], None, "AssertionError", False),
-        (["AssertionError: ABC"], None, "AssertionError", True),
-        ("ValueError", None, "AssertionError", True),
-        (["ValueError"], None, "AssertionError", True),
-        (["OSError", "ValueError"], None, "AssertionError", True),
-        (["OSError", "AssertionError"], None, "AssertionError", False),
-        # CLI override behavior
-        ("AssertionError", "ValueError", "AssertionError", False),
-        ("ValueError", "AssertionError", "AssertionError", True),
-        ("CustomFailure", None, "CustomFailure", False),
-        ("CustomFailure", None, "AssertionError", True),
-    ],
-)
-def test_rerun_except_flag_in_flaky_marker(
-    testdir, marker_rerun_except, cli_rerun_except, raised_error, should_rerun
-):
-    testdir.makepyfile(
-        f"""
+def test_single_attempt_triggers_at_most_one_rerun(testdir):
+    testdir.makepyfile("def test_fail(failing_teardown): assert False")
+    testdir.makeconftest(
+        """
         import pytest
 
-        class CustomFailure(Exception):
-            pass
+        attempts = 0
+        first_attempt_reports = []
 
-        @pytest.mark.flaky(reruns=1, rerun_except={marker_rerun_except!r})
-        def test_fail():
-            raise {raised_error}("ERR")
-        """
-    )
-    args = []
-    if cli_rerun_except:
-        args.extend(["--rerun-except", cli_rerun_except])
-    result = testdir.runpytest(*args)
-    num_reruns = 1 if should_rerun else 0
-    assert_outcomes(result, passed=0, failed=1, rerun=num_reruns)
+        @pytest.fixture
+        def failing_teardown():
+            global attempts
+            attempts += 1
+            yield
+            raise RuntimeError("teardown failure")
 
+        def pytest_runtest_logreport(report):
+            if report.rerun == 0 and report.when in ("call", "teardown"):
+                first_attempt_reports.append((report.when, report.outcome))
 
-def test_ini_file_parameters(testdir):
-    testdir.makepyfile(
-        """
-        import time
-        def test_foo():
-            assert False
-    """
-    )
-    testdir.makeini(
+        def pytest_sessionfinish():
+            print(f"ATTEMPTS: {attempts}")
+            print(f"FIRST ATTEMPT REPORTS: {first_attempt_reports!r}")
         """
-        [pytest]
-        reruns = 2
-        reruns_delay = 3
-    """
     )
-    time.sleep = mock.MagicMock()
-    result = testdir.runpytest()
 
-    time.sleep.assert_called_with(3)
-    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    result = testdir.runpytest("--reruns", "1")
+
+    stdout = result.stdout.str()
+    assert "ATTEMPTS: 2" in stdout
+    assert (
+        "FIRST ATTEMPT REPORTS: [('call', 'rerun'), ('teardown', 'failed')]" in stdout
+    )
 
 
-def test_ini_file_parameters_override(testdir):
-    testdir.makepyfile(
-        """
-        import time
-        def test_foo():
-            assert False
+def test_pytest_runtest_logfinish_is_called(testdir):
+    hook_message = "Message from pytest_runtest_logfinish hook"
+    testdir.makepyfile("def test_pass(): pass")
+    testdir.makeconftest(
+        rf"""
+        def pytest_runtest_logfinish(nodeid, location):
+            print("\n{hook_message}\n")
     """
     )
-    testdir.makeini(
-        """
-        [pytest]
-        reruns = 2
-        reruns_delay = 3
-    """
-    )
-    time.sleep = mock.MagicMock()
-    result = testdir.runpytest("--reruns", "4", "--reruns-delay", "5")
+    result = testdir.runpytest("--reruns", "1", "-s")
+    result.stdout.fnmatch_lines(hook_message)
 
-    time.sleep.assert_called_with(5)
-    assert_outcomes(result, passed=0, failed=1, rerun=4)
 
+@pytest.mark.parametrize(
+    "only_rerun_texts, should_rerun",
+    [
+        (["AssertionError"], True),
+        (["Assertion*"], True),
+        (["Assertion"], True),
+        (["ValueError"], False),
+        ([""], True),
+        (["AssertionError: "], True),
+        (["AssertionError: ERR"], True),
+        (["ERR"], True),
+        (["AssertionError,ValueError"], False),
+        (["AssertionError ValueError"], False),
+        (["AssertionError", "ValueError"], True),
+    ],
+)
+def test_only_rerun_flag(testdir, only_rerun_texts, should_rerun):
+    testdir.makepyfile("""
+        def test_only_rerun1():
+            raise AssertionError("ERR")
+
+        def test_only_rerun2():
+            assert False, "ERR"
+    """)
 
-def test_run_session_teardown_once_after_reruns(testdir):
+    num_failed = 2
+    num_passed = 0
+    num_reruns = 2
+    num_reruns_actual = num_reruns * 2 if should_rerun else 0
+
+    pytest_args = ["--reruns", str(num_reruns)]
+    for only_rerun_text in only_rerun_texts:
+        pytest_args.extend(["--only-rerun", only_rerun_text])
+    result = testdir.runpytest(*pytest_args)
+    assert_outcomes(
+        result, passed=num_passed, failed=num_failed, rerun=num_reruns_actual
+    )
+
+
+def test_no_rerun_on_strict_xfail_with_only_rerun_flag(testdir):
     testdir.makepyfile(
         """
-        import logging
         import pytest
+        @pytest.mark.xfail(strict=True)
+        def test_xfail():
+            assert True
+    """
+    )
+    result = testdir.runpytest("--reruns", "1", "--only-rerun", "RuntimeError")
+    assert_outcomes(result, passed=0, failed=1, rerun=0)
 
-        from unittest import TestCase
 
-        @pytest.fixture(scope='session', autouse=True)
-        def session_fixture():
-            logging.info('session setup')
-            yield
-            logging.info('session teardown')
+@pytest.mark.parametrize(
+    "rerun_except_texts, should_rerun",
+    [
+        (["AssertionError"], True),
+        (["Assertion*"], True),
+        (["Assertion"], True),
+        (["ValueError"], False),
+        (["AssertionError: "], True),
+        (["ERR"], False),
+        (["AssertionError", "OSError"], True),
+        (["ValueError", "OSError"], False),
+    ],
+)
+def test_rerun_except_flag(testdir, rerun_except_texts, should_rerun):
+    testdir.makepyfile('def test_rerun_except(): raise ValueError("ERR")')
 
-        @pytest.fixture(scope='class', autouse=True)
-        def class_fixture():
-            logging.info('class setup')
-            yield
-            logging.info('class teardown')
+    num_failed = 1
+    num_passed = 0
+    num_reruns = 1
+    num_reruns_actual = num_reruns if should_rerun else 0
 
-        @pytest.fixture(scope='function', autouse=True)
-        def function_fixture():
-            logging.info('function setup')
-            yield
-            logging.info('function teardown')
+    pytest_args = ["--reruns", str(num_reruns)]
+    for rerun_except_text in rerun_except_texts:
+        pytest_args.extend(["--rerun-except", rerun_except_text])
+    result = testdir.runpytest(*pytest_args)
+    assert_outcomes(
+        result, passed=num_passed, failed=num_failed, rerun=num_reruns_actual
+    )
 
-        @pytest.fixture(scope='function')
-        def function_skip_fixture():
-            logging.info('skip fixture setup')
-            pytest.skip('some reason')
-            yield
-            logging.info('skip fixture teardown')
 
-        @pytest.fixture(scope='function')
-        def function_setup_fail_fixture():
-            logging.info('fail fixture setup')
-            assert False
-            yield
-            logging.info('fail fixture teardown')
+def test_rerun_exclude_path_prevents_reruns_in_directory(testdir):
+    testdir.makeconftest(
+        """
+        from pathlib import Path
 
-        class TestFirstPassLastFail:
+        def pytest_runtest_call(item):
+            with Path("executions").open("a") as execution_log:
+                execution_log.write(item.name + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        test_normal="""
+        def test_normal_failure():
+            assert False
+    """
+    )
+    excluded_dir = testdir.mkdir("excluded")
+    excluded_dir.join("test_excluded.py").write(
+        """
+def test_excluded_failure():
+    assert False
+"""
+    )
 
-            @staticmethod
-            def test_1():
-                logging.info("TestFirstPassLastFail 1")
+    result = testdir.runpytest("--reruns", "2", "--rerun-exclude-path", "excluded")
 
-            @staticmethod
-            def test_2():
-                logging.info("TestFirstPassLastFail 2")
-                assert False
+    assert_outcomes(result, passed=0, failed=2, rerun=2)
+    executions = testdir.tmpdir.join("executions").read().splitlines()
+    assert executions.count("test_normal_failure") == 3
+    assert executions.count("test_excluded_failure") == 1
 
-        class TestFirstFailLastPass:
 
-            @staticmethod
-            def test_1():
-                logging.info("TestFirstFailLastPass 1")
-                assert False
+def test_rerun_exclude_path_prevents_reruns_for_file(testdir):
+    testdir.makeconftest(
+        """
+        from pathlib import Path
 
-            @staticmethod
-            def test_2():
-                logging.info("TestFirstFailLastPass 2")
+        def pytest_runtest_call(item):
+            with Path("executions").open("a") as execution_log:
+                execution_log.write(item.name + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        test_normal="""
+        def test_normal_failure():
+            assert False
+    """
+    )
+    excluded_dir = testdir.mkdir("excluded")
+    excluded_dir.join("test_excluded.py").write(
+        """
+def test_excluded_failure():
+    assert False
+"""
+    )
 
-        class TestSkipFirst:
-            @staticmethod
-            @pytest.mark.skipif(True, reason='Some reason')
-            def test_1():
-                logging.info("TestSkipFirst 1")
-                assert False
+    result = testdir.runpytest(
+        "--reruns",
+        "2",
+        "--rerun-exclude-path",
+        "excluded/test_excluded.py",
+    )
 
-            @staticmethod
-            def test_2():
-                logging.info("TestSkipFirst 2")
-                assert False
+    assert_outcomes(result, passed=0, failed=2, rerun=2)
+    executions = testdir.tmpdir.join("executions").read().splitlines()
+    assert executions.count("test_normal_failure") == 3
+    assert executions.count("test_excluded_failure") == 1
 
-        class TestSkipLast:
-            @staticmethod
-            def test_1():
-                logging.info("TestSkipLast 1")
-                assert False
 
-            @staticmethod
-            @pytest.mark.skipif(True, reason='Some reason')
-            def test_2():
-                logging.info("TestSkipLast 2")
-                assert False
+def test_rerun_exclude_path_accepts_multiple_paths(testdir):
+    testdir.makeconftest(
+        """
+        from pathlib import Path
 
-        class TestSkipFixture:
-            @staticmethod
-            def test_1(function_skip_fixture):
-                logging.info("TestSkipFixture 1")
+        def pytest_runtest_call(item):
+            with Path("executions").open("a") as execution_log:
+                execution_log.write(item.name + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        test_normal="""
+        def test_normal_failure():
+            assert False
+    """
+    )
+    excluded_a_dir = testdir.mkdir("excluded_a")
+    excluded_a_dir.join("test_excluded_a.py").write(
+        """
+def test_excluded_a_failure():
+    assert False
+"""
+    )
+    excluded_b_dir = testdir.mkdir("excluded_b")
+    excluded_b_dir.join("test_excluded_b.py").write(
+        """
+def test_excluded_b_failure():
+    assert False
+"""
+    )
 
-        class TestSetupFailed:
-            @staticmethod
-            def test_1(function_setup_fail_fixture):
-                logging.info("TestSetupFailed 1")
+    result = testdir.runpytest(
+        "--reruns",
+        "2",
+        "--rerun-exclude-path",
+        "excluded_a",
+        "--rerun-exclude-path",
+        "excluded_b",
+    )
 
-        class TestTestCaseFailFirstFailLast(TestCase):
+    assert_outcomes(result, passed=0, failed=3, rerun=2)
+    executions = testdir.tmpdir.join("executions").read().splitlines()
+    assert executions.count("test_normal_failure") == 3
+    assert executions.count("test_excluded_a_failure") == 1
+    assert executions.count("test_excluded_b_failure") == 1
+
+
+def test_rerun_exclude_path_prevents_reruns_for_doctest(testdir):
+    testdir.makeconftest(
+        """
+        from pathlib import Path
+
+        def pytest_runtest_call(item):
+            with Path("executions").open("a") as execution_log:
+                execution_log.write(item.name + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        test_normal="""
+        def test_normal_failure():
+            assert False
+    """
+    )
+    docs_dir = testdir.mkdir("docs")
+    docs_dir.join("guide.txt").write(
+        """
+This example fails:
+
+    >>> 1 + 1
+    3
+"""
+    )
+
+    result = testdir.runpytest(
+        "--doctest-glob=*.txt",
+        "--reruns",
+        "2",
+        "--rerun-exclude-path",
+        "docs/guide.txt",
+    )
+
+    assert_outcomes(result, passed=0, failed=2, rerun=2)
+    executions = testdir.tmpdir.join("executions").read().splitlines()
+    assert executions.count("test_normal_failure") == 3
+    assert executions.count("guide.txt") == 1
+
+
+@pytest.mark.parametrize(
+    "only_rerun_texts, rerun_except_texts, should_rerun",
+    [
+        # Matches --only-rerun, but not --rerun-except (rerun)
+        (["ValueError"], ["Not a Match"], True),
+        (["ValueError", "AssertionError"], ["Not a match", "OSError"], True),
+        # Matches --only-rerun AND --rerun-except (no rerun)
+        (["ValueError"], ["ERR"], False),
+        (["OSError", "ValueError"], ["Not a match", "ERR"], False),
+        # Matches --rerun-except, but not --only-rerun (no rerun)
+        (["OSError", "AssertionError"], ["TypeError", "ValueError"], False),
+        # Matches neither --only-rerun nor --rerun-except (no rerun)
+        (["AssertionError"], ["OSError"], False),
+        # --rerun-except overrides --only-rerun for same arg (no rerun)
+        (["ValueError"], ["ValueError"], False),
+    ],
+)
+def test_rerun_except_and_only_rerun(
+    testdir, rerun_except_texts, only_rerun_texts, should_rerun
+):
+    testdir.makepyfile('def test_only_rerun_except(): raise ValueError("ERR")')
+
+    num_failed = 1
+    num_passed = 0
+    num_reruns = 1
+    num_reruns_actual = num_reruns if should_rerun else 0
+
+    pytest_args = ["--reruns", str(num_reruns)]
+    for only_rerun_text in only_rerun_texts:
+        pytest_args.extend(["--only-rerun", only_rerun_text])
+    for rerun_except_text in rerun_except_texts:
+        pytest_args.extend(["--rerun-except", rerun_except_text])
+    result = testdir.runpytest(*pytest_args)
+    assert_outcomes(
+        result, passed=num_passed, failed=num_failed, rerun=num_reruns_actual
+    )
+
+
+def test_rerun_except_passes_setup_errors(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture()
+        def fixture_setup_fails(non_existent_fixture):
+            return 1
+
+        def test_will_not_run(fixture_setup_fails):
+            assert fixture_setup_fails == 1"""
+    )
+
+    num_reruns = 1
+    pytest_args = ["--reruns", str(num_reruns), "--rerun-except", "ValueError"]
+    result = testdir.runpytest(*pytest_args)
+    assert result.ret != pytest.ExitCode.INTERNAL_ERROR
+    assert_outcomes(result, passed=0, error=1, rerun=num_reruns)
+
+
+@pytest.mark.parametrize(
+    "rerun_except, expected_reruns",
+    [("ValueError", 0), ("TypeError", 1)],
+)
+def test_rerun_except_setup_error(testdir, rerun_except, expected_reruns):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture()
+        def fixture_setup_fails():
+            raise ValueError("setup error")
+
+        def test_will_not_run(fixture_setup_fails):
+            pass
+        """
+    )
+
+    result = testdir.runpytest("--reruns", "1", "--rerun-except", rerun_except)
+    assert_outcomes(result, passed=0, error=1, rerun=expected_reruns)
+
+
+def test_rerun_except_teardown_error_prevents_rerun(testdir):
+    """Teardown errors covered by --rerun-except must prevent reruns."""
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture()
+        def broken_fixture():
+            yield
+            raise ValueError("teardown error")
+
+        def test_fail_in_fixture(broken_fixture):
+            assert False
+    """
+    )
+
+    result = testdir.runpytest("--reruns", "1", "--rerun-except", "ValueError")
+    assert_outcomes(result, passed=0, failed=1, error=1, rerun=0)
+
+
+@pytest.mark.parametrize(
+    "condition, expected_reruns",
+    [
+        (1 == 1, 2),
+        (1 == 2, 0),
+        (True, 2),
+        (False, 0),
+        (1, 2),
+        (0, 0),
+        (["list"], 2),
+        ([], 0),
+        ({"dict": 1}, 2),
+        ({}, 0),
+        (None, 0),
+    ],
+)
+def test_reruns_with_condition_marker(testdir, condition, expected_reruns):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        @pytest.mark.flaky(reruns=2, condition={condition})
+        def test_fail_two():
+            assert False"""
+    )
+
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=expected_reruns)
+
+
+@pytest.mark.parametrize(
+    "condition, expected_reruns",
+    [('sys.platform.startswith("non-exists") == False', 2), ("os.getpid() != -1", 2)],
+)
+# before evaluating the condition expression, sys&os&platform package has been imported
+def test_reruns_with_string_condition(testdir, condition, expected_reruns):
+    testdir.makepyfile(
+        f"""
+           import pytest
+
+           @pytest.mark.flaky(reruns=2, condition='{condition}')
+           def test_fail_two():
+               assert False"""
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+def test_reruns_with_string_condition_with_global_var(testdir):
+    testdir.makepyfile(
+        """
+              import pytest
+
+              rerunBool = False
+              @pytest.mark.flaky(reruns=2, condition='rerunBool')
+              def test_fail_two():
+                  global rerunBool
+                  rerunBool = True
+                  assert False"""
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+def test_reruns_with_string_condition_with_nested_scope(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        PLATFORMS = ("non-exists", "")
+
+        @pytest.mark.flaky(
+            reruns=2, condition="any(sys.platform.startswith(p) for p in PLATFORMS)"
+        )
+        def test_fail_two():
+            assert False"""
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+@pytest.mark.parametrize("returns, expected_reruns", [(True, 2), (False, 0)])
+def test_reruns_with_callable_condition(testdir, returns, expected_reruns):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        @pytest.mark.flaky(reruns=2, condition=lambda: {returns})
+        def test_fail_two():
+            assert False"""
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=expected_reruns)
+
+
+@pytest.mark.parametrize("pure, expected_calls", [(False, 7), (True, 1)])
+def test_reruns_with_pure_condition(testdir, pure, expected_calls):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        calls = []
+
+        def condition():
+            calls.append(1)
+            return True
+
+        @pytest.mark.flaky(reruns=2, condition=condition, pure_condition={pure})
+        def test_fail_two():
+            assert False
+
+        def test_calls():
+            assert len(calls) == {expected_calls}"""
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=1, failed=1, rerun=2)
+
+
+def test_evaluate_condition_takes_the_marker():
+    mark = pytest.mark.flaky.mark
+    assert evaluate_condition(None, mark, lambda: True) is True
+    with pytest.raises(pytest.fail.Exception, match="Error evaluating 'flaky'"):
+        evaluate_condition(None, mark, lambda: 1 / 0)
+
+
+def test_reruns_condition_is_evaluated_without_marker_lookups(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.flaky(reruns=2, condition="True")
+        def test_fail_two():
+            assert False"""
+    )
+    with mock.patch(
+        "pytest_rerunfailures._get_marker",
+        wraps=_get_marker,
+    ) as get_marker:
+        result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    # only to resolve the policy of the item
+    assert get_marker.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "marker_only_rerun,cli_only_rerun,should_rerun",
+    [
+        ("AssertionError", None, True),
+        ("AssertionError: ERR", None, True),
+        (["AssertionError"], None, True),
+        (["AssertionError: ABC"], None, False),
+        ("ValueError", None, False),
+        (["ValueError"], None, False),
+        (["AssertionError", "ValueError"], None, True),
+        # CLI override behavior
+        ("AssertionError", "ValueError", True),
+        ("ValueError", "AssertionError", False),
+    ],
+)
+def test_only_rerun_flag_in_flaky_marker(
+    testdir, marker_only_rerun, cli_only_rerun, should_rerun
+):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        @pytest.mark.flaky(reruns=1, only_rerun={marker_only_rerun!r})
+        def test_fail():
+            raise AssertionError("ERR")
+        """
+    )
+    args = []
+    if cli_only_rerun:
+        args.extend(["--only-rerun", cli_only_rerun])
+    result = testdir.runpytest(*args)
+    num_reruns = 1 if should_rerun else 0
+    assert_outcomes(result, passed=0, failed=1, rerun=num_reruns)
+
+
+@pytest.mark.parametrize(
+    "filter_kwarg,should_rerun",
+    [
+        ("only_rerun=[AssertionError]", True),
+        ("only_rerun=[ValueError]", False),
+        ("rerun_except=[AssertionError]", False),
+        ("rerun_except=[ValueError]", True),
+    ],
+)
+def test_rerun_filter_accepts_exception_classes(testdir, filter_kwarg, should_rerun):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        @pytest.mark.flaky(reruns=1, {filter_kwarg})
+        def test_fail():
+            raise AssertionError("ERR")
+        """
+    )
+    result = testdir.runpytest()
+    num_reruns = 1 if should_rerun else 0
+    assert_outcomes(result, passed=0, failed=1, rerun=num_reruns)
+
+
+@pytest.mark.parametrize(
+    "marker_rerun_except,cli_rerun_except,raised_error,should_rerun",
+    [
+        ("AssertionError", None, "AssertionError", False),
+        ("AssertionError: ERR", None, "AssertionError", False),
+        (["AssertionError"], None, "AssertionError", False),
+        (["AssertionError: ABC"], None, "AssertionError", True),
+        ("ValueError", None, "AssertionError", True),
+        (["ValueError"], None, "AssertionError", True),
+        (["OSError", "ValueError"], None, "AssertionError", True),
+        (["OSError", "AssertionError"], None, "AssertionError", False),
+        # CLI override behavior
+        ("AssertionError", "ValueError", "AssertionError", False),
+        ("ValueError", "AssertionError", "AssertionError", True),
+        ("CustomFailure", None, "CustomFailure", False),
+        ("CustomFailure", None, "AssertionError", True),
+    ],
+)
+def test_rerun_except_flag_in_flaky_marker(
+    testdir, marker_rerun_except, cli_rerun_except, raised_error, should_rerun
+):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        class CustomFailure(Exception):
+            pass
+
+        @pytest.mark.flaky(reruns=1, rerun_except={marker_rerun_except!r})
+        def test_fail():
+            raise {raised_error}("ERR")
+        """
+    )
+    args = []
+    if cli_rerun_except:
+        args.extend(["--rerun-except", cli_rerun_except])
+    result = testdir.runpytest(*args)
+    num_reruns = 1 if should_rerun else 0
+    assert_outcomes(result, passed=0, failed=1, rerun=num_reruns)
+
+
+class RegisteredError(Exception, metaclass=abc.ABCMeta):
+    pass
+
+
+# a virtual subclass, which is not in the MRO of KeyError
+RegisteredError.register(KeyError)
+
+
+@pytest.mark.parametrize(
+    "only_rerun,rerun_except,exc_type,message,hard_fail",
+    [
+        (("ValueError", "(?i)assertionerror: err"), None, AssertionError, "ERR", False),
+        (("ValueError", "(R)\\1"), None, AssertionError, "ERR", False),
+        (("ValueError", "(?P<c>X)(?P=c)"), None, AssertionError, "ERR", True),
+        (("Value", "Key"), ("Assertion",), KeyError, "ERR", False),
+        (("Value", "Key"), ("Assertion",), AssertionError, "ERR", True),
+        ((LookupError,), None, KeyError, "ERR", False),
+        ((LookupError,), ("ERR",), KeyError, "ERR", True),
+        (None, (ArithmeticError, "Foo"), ZeroDivisionError, "ERR", True),
+        ((RegisteredError,), None, KeyError, "ERR", False),
+        (None, (RegisteredError,), KeyError, "ERR", True),
+    ],
+)
+def test_error_matcher(only_rerun, rerun_except, exc_type, message, hard_fail):
+    matcher = _ErrorMatcher(only_rerun, rerun_except)
+    excinfo = SimpleNamespace(type=exc_type, value=exc_type(message))
+    assert matcher.should_hard_fail(excinfo) is hard_fail
+
+
+def test_rerun_match_max_chars_limits_matched_message(testdir):
+    testdir.makepyfile(
+        """
+        def test_fail():
+            raise AssertionError("x" * 100 + "needle")
+        """
+    )
+    result = testdir.runpytest("--reruns", "1", "--only-rerun", "needle")
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    result = testdir.runpytest(
+        "--reruns", "1", "--only-rerun", "needle", "--rerun-match-max-chars", "50"
+    )
+    assert_outcomes(result, passed=0, failed=1, rerun=0)
+
+
+def test_ini_file_parameters(testdir):
+    testdir.makepyfile(
+        """
+        import time
+        def test_foo():
+            assert False
+    """
+    )
+    testdir.makeini(
+        """
+        [pytest]
+        reruns = 2
+        reruns_delay = 3
+    """
+    )
+    time.sleep = mock.MagicMock()
+    result = testdir.runpytest()
+
+    time.sleep.assert_called_with(3)
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+def test_ini_file_parameters_override(testdir):
+    testdir.makepyfile(
+        """
+        import time
+        def test_foo():
+            assert False
+    """
+    )
+    testdir.makeini(
+        """
+        [pytest]
+        reruns = 2
+        reruns_delay = 3
+    """
+    )
+    time.sleep = mock.MagicMock()
+    result = testdir.runpytest("--reruns", "4", "--reruns-delay", "5")
+
+    time.sleep.assert_called_with(5)
+    assert_outcomes(result, passed=0, failed=1, rerun=4)
+
+
+def test_run_session_teardown_once_after_reruns(testdir):
+    testdir.makepyfile(
+        """
+        import logging
+        import pytest
+
+        from unittest import TestCase
+
+        @pytest.fixture(scope='session', autouse=True)
+        def session_fixture():
+            logging.info('session setup')
+            yield
+            logging.info('session teardown')
+
+        @pytest.fixture(scope='class', autouse=True)
+        def class_fixture():
+            logging.info('class setup')
+            yield
+            logging.info('class teardown')
+
+        @pytest.fixture(scope='function', autouse=True)
+        def function_fixture():
+            logging.info('function setup')
+            yield
+            logging.info('function teardown')
+
+        @pytest.fixture(scope='function')
+        def function_skip_fixture():
+            logging.info('skip fixture setup')
+            pytest.skip('some reason')
+            yield
+            logging.info('skip fixture teardown')
+
+        @pytest.fixture(scope='function')
+        def function_setup_fail_fixture():
+            logging.info('fail fixture setup')
+            assert False
+            yield
+            logging.info('fail fixture teardown')
+
+        class TestFirstPassLastFail:
+
+            @staticmethod
+            def test_1():
+                logging.info("TestFirstPassLastFail 1")
+
+            @staticmethod
+            def test_2():
+                logging.info("TestFirstPassLastFail 2")
+                assert False
+
+        class TestFirstFailLastPass:
+
+            @staticmethod
+            def test_1():
+                logging.info("TestFirstFailLastPass 1")
+                assert False
+
+            @staticmethod
+            def test_2():
+                logging.info("TestFirstFailLastPass 2")
+
+        class TestSkipFirst:
+            @staticmethod
+            @pytest.mark.skipif(True, reason='Some reason')
+            def test_1():
+                logging.info("TestSkipFirst 1")
+                assert False
+
+            @staticmethod
+            def test_2():
+                logging.info("TestSkipFirst 2")
+                assert False
+
+        class TestSkipLast:
+            @staticmethod
+            def test_1():
+                logging.info("TestSkipLast 1")
+                assert False
+
+            @staticmethod
+            @pytest.mark.skipif(True, reason='Some reason')
+            def test_2():
+                logging.info("TestSkipLast 2")
+                assert False
+
+        class TestSkipFixture:
+            @staticmethod
+            def test_1(function_skip_fixture):
+                logging.info("TestSkipFixture 1")
+
+        class TestSetupFailed:
+            @staticmethod
+            def test_1(function_setup_fail_fixture):
+                logging.info("TestSetupFailed 1")
+
+        class TestTestCaseFailFirstFailLast(TestCase):
+
+            @staticmethod
+            def test_1():
+                logging.info("TestTestCaseFailFirstFailLast 1")
+                assert False
+
+            @staticmethod
+            def test_2():
+                logging.info("TestTestCaseFailFirstFailLast 2")
+                assert False
+
+        class TestTestCaseSkipFirst(TestCase):
+
+            @staticmethod
+            @pytest.mark.skipif(True, reason='Some reason')
+            def test_1():
+                logging.info("TestTestCaseSkipFirst 1")
+                assert False
+
+            @staticmethod
+            def test_2():
+                logging.info("TestTestCaseSkipFirst 2")
+                assert False
+
+        class TestTestCaseSkipLast(TestCase):
+
+            @staticmethod
+            def test_1():
+                logging.info("TestTestCaseSkipLast 1")
+                assert False
+
+            @staticmethod
+            @pytest.mark.skipif(True, reason="Some reason")
+            def test_2():
+                logging.info("TestTestCaseSkipLast 2")
+                assert False"""
+    )
+    import logging
+
+    logging.info = mock.MagicMock()
+
+    result = testdir.runpytest("--reruns", "2")
+    expected_calls = [
+        mock.call("session setup"),
+        # TestFirstPassLastFail
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("TestFirstPassLastFail 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestFirstPassLastFail 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestFirstPassLastFail 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestFirstPassLastFail 2"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestFirstFailLastPass
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("TestFirstFailLastPass 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestFirstFailLastPass 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestFirstFailLastPass 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestFirstFailLastPass 2"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestSkipFirst
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("TestSkipFirst 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestSkipFirst 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestSkipFirst 2"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestSkipLast
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("TestSkipLast 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestSkipLast 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestSkipLast 1"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestSkipFixture
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("skip fixture setup"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestSetupFailed
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("fail fixture setup"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("fail fixture setup"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("fail fixture setup"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestTestCaseFailFirstFailLast
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseFailFirstFailLast 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseFailFirstFailLast 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseFailFirstFailLast 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseFailFirstFailLast 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseFailFirstFailLast 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseFailFirstFailLast 2"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestTestCaseSkipFirst
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseSkipFirst 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseSkipFirst 2"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseSkipFirst 2"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        # TestTestCaseSkipLast
+        mock.call("class setup"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseSkipLast 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseSkipLast 1"),
+        mock.call("function teardown"),
+        mock.call("function setup"),
+        mock.call("TestTestCaseSkipLast 1"),
+        mock.call("function teardown"),
+        mock.call("class teardown"),
+        mock.call("session teardown"),
+    ]
+
+    logging.info.assert_has_calls(expected_calls, any_order=False)
+    assert_outcomes(result, failed=8, passed=2, rerun=18, skipped=5, error=1)
+
+
+def test_run_session_teardown_when_fixture_teardown_fails(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope='session', autouse=True)
+        def session_fixture():
+            yield
+            print('session teardown')
+
+        @pytest.fixture(scope='module', autouse=True)
+        def module_fixture():
+            yield
+            print('module teardown')
+
+        @pytest.fixture
+        def broken_fixture():
+            yield
+            raise Exception("fixture teardown error")
+
+        def test_fail_in_fixture(broken_fixture):
+            pass
+
+        def test_ok():
+            pass
+    """
+    )
+
+    result = testdir.runpytest("--reruns", "1", "-s")
+    result.stdout.fnmatch_lines("*session teardown*")
+    result.stdout.fnmatch_lines("*module teardown*")
+    assert_outcomes(result, passed=3, rerun=1, error=1)
+
+
+def test_exception_matches_rerun_except_query(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            print("session setup")
+            yield "session"
+            print("session teardown")
+
+        @pytest.fixture(scope="package", autouse=True)
+        def package_fixture():
+            print("package setup")
+            yield "package"
+            print("package teardown")
+
+        @pytest.fixture(scope="module", autouse=True)
+        def module_fixture():
+            print("module setup")
+            yield "module"
+            print("module teardown")
+
+        @pytest.fixture(scope="class", autouse=True)
+        def class_fixture():
+            print("class setup")
+            yield "class"
+            print("class teardown")
+
+        @pytest.fixture(scope="function", autouse=True)
+        def function_fixture():
+            print("function setup")
+            yield "function"
+            print("function teardown")
+
+        @pytest.mark.flaky(reruns=1, rerun_except=["AssertionError"])
+        class TestStuff:
+            def test_1(self):
+                raise AssertionError("fail")
+
+            def test_2(self):
+                raise ValueError("fail")
+
+    """
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=2, rerun=1)
+    result.stdout.fnmatch_lines("session teardown")
+    result.stdout.fnmatch_lines("package teardown")
+    result.stdout.fnmatch_lines("module teardown")
+    result.stdout.fnmatch_lines("class teardown")
+    result.stdout.fnmatch_lines("function teardown")
+
+
+def test_exception_not_match_rerun_except_query(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            print("session setup")
+            yield "session"
+            print("session teardown")
+
+        @pytest.fixture(scope="function", autouse=True)
+        def function_fixture():
+            print("function setup")
+            yield "function"
+            print("function teardown")
+
+        @pytest.mark.flaky(reruns=1, rerun_except="AssertionError")
+        def test_1(session_fixture, function_fixture):
+            raise ValueError("value")
+    """
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    result.stdout.fnmatch_lines("session teardown")
+
+
+def test_exception_matches_only_rerun_query(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            print("session setup")
+            yield "session"
+            print("session teardown")
+
+        @pytest.fixture(scope="function", autouse=True)
+        def function_fixture():
+            print("function setup")
+            yield "function"
+            print("function teardown")
+
+        @pytest.mark.flaky(reruns=1, only_rerun=["AssertionError"])
+        def test_1(session_fixture, function_fixture):
+            raise AssertionError("fail")
+    """
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    result.stdout.fnmatch_lines("session teardown")
+
+
+def test_exception_not_match_only_rerun_query(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            print("session setup")
+            yield "session"
+            print("session teardown")
+
+        @pytest.fixture(scope="function", autouse=True)
+        def function_fixture():
+            print("function setup")
+            yield "function"
+            print("function teardown")
+
+        @pytest.mark.flaky(reruns=1, only_rerun=["AssertionError"])
+        def test_1(session_fixture, function_fixture):
+            raise ValueError("fail")
+    """
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1)
+    result.stdout.fnmatch_lines("session teardown")
+
+
+def test_exception_match_rerun_except_in_dual_query(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            print("session setup")
+            yield "session"
+            print("session teardown")
+
+        @pytest.fixture(scope="function", autouse=True)
+        def function_fixture():
+            print("function setup")
+            yield "function"
+            print("function teardown")
+
+        @pytest.mark.flaky(reruns=1, rerun_except=["Exception"], only_rerun=["Not"])
+        def test_1(session_fixture, function_fixture):
+            raise Exception("fail")
+    """
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1)
+    result.stdout.fnmatch_lines("session teardown")
+
+
+def test_exception_match_only_rerun_in_dual_query(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def session_fixture():
+            print("session setup")
+            yield "session"
+            print("session teardown")
+
+        @pytest.fixture(scope="function", autouse=True)
+        def function_fixture():
+            print("function setup")
+            yield "function"
+            print("function teardown")
+
+        @pytest.mark.flaky(reruns=1, rerun_except=["Not"], only_rerun=["Exception"])
+        def test_1(session_fixture, function_fixture):
+            raise Exception("fail")
+    """
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    result.stdout.fnmatch_lines("session teardown")
+
+
+@pytest.mark.parametrize("mark_params", ["", "reruns=1"])
+def test_force_reruns(testdir, mark_params):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        @pytest.mark.flaky({mark_params})
+        def test_fail():
+            assert False
+    """
+    )
+
+    result = testdir.runpytest("--force-reruns", "3")
+    assert_outcomes(result, passed=0, failed=1, rerun=3)
+
+
+def test_reruns_mode_append_sums_marker_and_cli(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.flaky(reruns=2)
+        def test_fail():
+            assert False
+    """
+    )
+
+    result = testdir.runpytest("--reruns", "4", "--reruns-mode", "append")
+    assert_outcomes(result, passed=0, failed=1, rerun=6)
+
+
+def test_reruns_mode_default_is_strict(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.flaky(reruns=2)
+        def test_fail():
+            assert False
+    """
+    )
+
+    result = testdir.runpytest("--reruns", "4")
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+def test_reruns_mode_append_without_marker_uses_global(testdir):
+    testdir.makepyfile(
+        """
+        def test_fail():
+            assert False
+    """
+    )
+
+    result = testdir.runpytest("--reruns", "3", "--reruns-mode", "append")
+    assert_outcomes(result, passed=0, failed=1, rerun=3)
+
+
+def test_reruns_mode_invalid_choice_errors(testdir):
+    testdir.makepyfile(
+        """
+        def test_pass():
+            assert True
+    """
+    )
+
+    result = testdir.runpytest("--reruns-mode", "bogus")
+    assert result.ret != 0
+
+
+def test_max_suite_reruns_caps_total_reruns(testdir):
+    """Suite limit stops reruns once the total across all tests is reached."""
+    testdir.makepyfile(
+        """
+        def test_fail_1():
+            assert False
+
+        def test_fail_2():
+            assert False
+
+        def test_fail_3():
+            assert False
+    """
+    )
+    # 3 tests each allowed up to 3 reruns, but suite cap is 4 total
+    result = testdir.runpytest("--reruns", "3", "--max-suite-reruns", "4")
+    assert_outcomes(result, passed=0, failed=3, rerun=4)
+
+
+def test_max_suite_reruns_caps_force_reruns(testdir):
+    """Suite cap applies after ``--force-reruns`` selection."""
+    testdir.makepyfile(
+        """
+        def test_fail_1():
+            assert False
+
+        def test_fail_2():
+            assert False
+    """
+    )
+    # Force reruns allows every failing test to rerun, but the suite cap should
+    # limit total reruns to one.
+    result = testdir.runpytest("--force-reruns", "5", "--max-suite-reruns", "1")
+    assert_outcomes(result, passed=0, failed=2, rerun=1)
+
+
+def test_max_suite_reruns_does_not_limit_when_sufficient(testdir):
+    """Suite limit has no effect when total reruns stay below the cap."""
+    testdir.makepyfile(
+        """
+        def test_fail():
+            assert False
+    """
+    )
+    result = testdir.runpytest("--reruns", "2", "--max-suite-reruns", "10")
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+def test_max_suite_reruns_zero_disables_all_reruns(testdir):
+    """Suite limit of 0 prevents any reruns from occurring."""
+    testdir.makepyfile(
+        """
+        def test_fail():
+            assert False
+    """
+    )
+    result = testdir.runpytest("--reruns", "3", "--max-suite-reruns", "0")
+    assert_outcomes(result, passed=0, failed=1, rerun=0)
+
+
+def test_max_suite_reruns_works_with_passing_tests(testdir):
+    """Suite limit only counts actual reruns, not passing test runs."""
+    testdir.makepyfile(
+        """
+        def test_pass():
+            assert True
+
+        def test_fail():
+            assert False
+    """
+    )
+    result = testdir.runpytest("--reruns", "3", "--max-suite-reruns", "2")
+    assert_outcomes(result, passed=1, failed=1, rerun=2)
+
+
+def test_max_suite_reruns_without_reruns_has_no_effect(testdir):
+    """--max-suite-reruns alone (without --reruns) does not break anything."""
+    testdir.makepyfile(
+        """
+        def test_fail():
+            assert False
+    """
+    )
+    result = testdir.runpytest("--max-suite-reruns", "5")
+    assert_outcomes(result, passed=0, failed=1, rerun=0)
+
+
+@pytest.mark.skipif(not has_subtests, reason="Only supported on pytest 9.0 and newer")
+def test_failing_subtests_are_rerun(testdir):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        def test_subtests(subtests):
+            with subtests.test("Fails on first attempt"):
+                {indent(temporary_failure(), "    ")}
+    """
+    )
+
+    result = testdir.runpytest("--reruns", "1")
+    assert result.ret == 0
+    assert_outcomes(result, passed=1, rerun=1)
+
+
+@pytest.mark.skipif(not has_subtests, reason="Only supported on pytest 9.0 and newer")
+def test_too_many_failing_subtests_are_failures(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        def test_subtests(subtests):
+            with subtests.test("Always fails"):
+                assert False
+    """
+    )
+
+    result = testdir.runpytest("--reruns", "1")
+    assert result.ret != 0
+    assert_outcomes(result, passed=0, failed=2, rerun=1)
+
+
+def test_max_suite_reruns_caps_flaky_marker_reruns(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.flaky(reruns=3)
+        def test_fail():
+            assert False
+        """
+    )
+    result = testdir.runpytest("--max-suite-reruns", "2")
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+def test_max_suite_reruns_rejects_negative_without_reruns(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest("--max-suite-reruns", "-1")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines("*--max-suite-reruns must be >= 0*")
+
+    collect_result = testdir.runpytest("--collect-only", "--max-suite-reruns", "-1")
+    assert collect_result.ret == pytest.ExitCode.USAGE_ERROR
+    collect_result.stderr.fnmatch_lines("*--max-suite-reruns must be >= 0*")
+
+
+def test_max_suite_rerun_seconds_caps_total_rerun_time(testdir):
+    testdir.makepyfile(
+        """
+        def test_fail_1():
+            assert False
+
+        def test_fail_2():
+            assert False
+    """
+    )
+    time.sleep = mock.MagicMock()
+    # every rerun is charged its 10 second delay, the budget is spent after
+    # the third one
+    result = testdir.runpytest(
+        "--reruns", "5", "--reruns-delay", "10", "--max-suite-rerun-seconds", "25"
+    )
+    assert_outcomes(result, passed=0, failed=2, rerun=3)
+    assert time.sleep.call_args_list == [mock.call(10)] * 3
+
+
+def test_max_suite_rerun_seconds_charges_attempt_duration(testdir):
+    testdir.makepyfile(
+        """
+        import threading
+
+        def test_slow_fail():
+            threading.Event().wait(0.2)
+            assert False
+    """
+    )
+    result = testdir.runpytest("--reruns", "5", "--max-suite-rerun-seconds", "0.3")
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+
+
+def test_max_suite_rerun_seconds_zero_disables_all_reruns(testdir):
+    testdir.makepyfile("def test_fail(): assert False")
+    result = testdir.runpytest("--reruns", "3", "--max-suite-rerun-seconds", "0")
+    assert_outcomes(result, passed=0, failed=1, rerun=0)
+
+
+def test_passing_tests_do_not_check_the_suite_budget(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    with mock.patch("pytest_rerunfailures._is_suite_budget_spent") as spent:
+        result = testdir.runpytest(
+            "--reruns",
+            "1",
+            "--max-suite-reruns",
+            "1",
+            "--max-suite-rerun-seconds",
+            "10",
+        )
+    assert_outcomes(result, passed=1)
+    # a round trip to the controller with pytest-xdist
+    spent.assert_not_called()
+
+
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_max_suite_rerun_seconds_is_shared_by_xdist_workers(testdir):
+    testdir.makepyfile(
+        """
+        import threading
+
+        import pytest
+
+        @pytest.mark.parametrize("n", range(4))
+        def test_fail(n):
+            threading.Event().wait(0.2)
+            assert False
+    """
+    )
+    # the attempts of both workers are charged to one budget, which is spent
+    # after the third rerun
+    result = testdir.runpytest(
+        "-p", "xdist", "-n", "2", "--reruns", "5", "--max-suite-rerun-seconds", "0.5"
+    )
+    check_outcome_field(result.parseoutcomes(), "rerun", 3)
+
+
+def test_max_suite_rerun_seconds_rejects_negative(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest("--max-suite-rerun-seconds", "-1")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines("*--max-suite-rerun-seconds must be >= 0*")
+
+
+def test_max_suite_reruns_preserves_fixture_teardown_when_exhausted(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="module", autouse=True)
+        def module_fixture():
+            yield
+            print("module teardown")
+
+        def test_fail():
+            assert False
+        """
+    )
+    result = testdir.runpytest("-s", "--reruns", "1", "--max-suite-reruns", "0")
+    result.stdout.fnmatch_lines("*module teardown*")
+
+
+@pytest.mark.parametrize("max_attempt_seconds, reruns", [(0.1, 0), (5, 3)])
+def test_max_attempt_seconds_skips_rerun_of_slow_attempts(
+    testdir, max_attempt_seconds, reruns
+):
+    testdir.makepyfile(
+        f"""
+        import threading
+
+        import pytest
+
+        @pytest.mark.flaky(reruns=3, max_attempt_seconds={max_attempt_seconds})
+        def test_slow_fail():
+            threading.Event().wait(0.2)
+            assert False
+    """
+    )
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=0, failed=1, rerun=reruns)
+
+
+def test_deadline_includes_rerun_delays(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.flaky(reruns=5, reruns_delay=10, deadline=25)
+        def test_fail():
+            assert False
+    """
+    )
+    time.sleep = mock.MagicMock()
+    result = testdir.runpytest()
+    # a third rerun would only start after 30 seconds of delays
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    assert time.sleep.call_args_list == [mock.call(10)] * 2
+
+
+def test_time_limits_from_command_line_and_ini_file(testdir):
+    testdir.makepyfile(
+        """
+        import threading
+
+        import pytest
+
+        def test_slow_fail():
+            threading.Event().wait(0.2)
+            assert False
+
+        @pytest.mark.flaky(reruns=2, max_attempt_seconds=None)
+        def test_slow_fail_without_limit():
+            threading.Event().wait(0.2)
+            assert False
+    """
+    )
+    testdir.makeini(
+        """
+        [pytest]
+        reruns_deadline = 0.3
+    """
+    )
+    time.sleep = mock.MagicMock()
+    # the global delay does not fit the deadline of the ini file, the marker
+    # has no delay
+    result = testdir.runpytest("--reruns", "2", "--reruns-delay", "0.2", "-r", "R")
+    assert_outcomes(result, passed=0, failed=2, rerun=1)
+    result.stdout.fnmatch_lines("RERUN *::test_slow_fail_without_limit")
+
+    # the command line overrides the ini file, the marker lifts the attempt
+    # limit
+    result = testdir.runpytest(
+        "--reruns",
+        "2",
+        "--reruns-deadline",
+        "10",
+        "--reruns-max-attempt-seconds",
+        "0.1",
+        "-r",
+        "R",
+    )
+    assert_outcomes(result, passed=0, failed=2, rerun=2)
+    result.stdout.fnmatch_lines(["RERUN *::test_slow_fail_without_limit"] * 2)
+
+
+def test_time_limits_keep_fixtures_torn_down_once(testdir):
+    testdir.makepyfile(
+        """
+        import threading
+
+        import pytest
+
+        @pytest.fixture(scope="module", autouse=True)
+        def module_fixture():
+            yield
+            print("module teardown")
+
+        @pytest.fixture
+        def slow_teardown():
+            yield
+            threading.Event().wait(0.2)
+
+        @pytest.mark.flaky(reruns=1, max_attempt_seconds=0.1)
+        def test_fail(slow_teardown):
+            assert False
+    """
+    )
+    result = testdir.runpytest("-s")
+    assert_outcomes(result, passed=0, failed=1, rerun=0)
+    assert result.stdout.str().count("module teardown") == 1
+
+
+def test_time_limits_reject_invalid_values(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.flaky(reruns=1, deadline="soon")
+        def test_fail():
+            assert False
+    """
+    )
+    result = testdir.runpytest()
+    result.stdout.fnmatch_lines(
+        "*UserWarning: Invalid deadline 'soon' in flaky marker, expected a number "
+        ">= 0. Using default value: None"
+    )
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+
+    result = testdir.runpytest("--reruns-deadline", "-1")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines("*--reruns-deadline must be >= 0*")
+
+
+def test_reruns_fixture_budget_shares_failures_of_a_module_fixture(testdir):
+    testdir.makeconftest(
+        """
+        import pytest
+
+        @pytest.fixture(scope="module")
+        def resource():
+            with open("log", "a") as f:
+                f.write("setup\\n")
+            raise ValueError()
+        """
+    )
+    testdir.makepyfile(
+        test_a="""
+            def test_a1(resource):
+                pass
+
+            def test_a2(resource):
+                pass
+
+            def test_a3(resource):
+                pass
+        """,
+        test_b="""
+            def test_b1(resource):
+                pass
+        """,
+    )
+    result = testdir.runpytest(
+        "--reruns", "3", "--reruns-fixture-budget", "1", "-r", "R"
+    )
+
+    assert_outcomes(result, passed=0, error=4, rerun=2)
+    # one retry of the fixture in every module, the other tests fail with the
+    # cached error
+    assert testdir.tmpdir.join("log").read().split() == ["setup"] * 4
+    result.stdout.fnmatch_lines([
+        "RERUN STOPPED test_a.py::test_a1 - "
+        "fixture 'resource' failed 2 times for this module",
+        "RERUN STOPPED test_a.py::test_a2 - *",
+        "RERUN STOPPED test_a.py::test_a3 - *",
+        "RERUN STOPPED test_b.py::test_b1 - *",
+    ])
+
+
+def test_reruns_fixture_budget_of_zero_stops_after_one_failure(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="module")
+        def resource():
+            raise ValueError()
+
+        def test_one(resource):
+            pass
+        """
+    )
+    result = testdir.runpytest(
+        "--reruns", "3", "--reruns-fixture-budget", "0", "-r", "R"
+    )
+
+    assert_outcomes(result, passed=0, error=1)
+    result.stdout.fnmatch_lines(
+        "RERUN STOPPED *::test_one - fixture 'resource' failed once for this module"
+    )
+
+
+def test_reruns_fixture_budget_retries_a_fixture_within_the_budget(testdir):
+    testdir.makeini(
+        """
+        [pytest]
+        reruns_fixture_budget = 1
+    """
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        runs = []
+
+        @pytest.fixture(scope="module")
+        def resource():
+            runs.append(None)
+            if len(runs) == 1:
+                raise ValueError()
+
+        def test_one(resource):
+            pass
+
+        def test_two(resource):
+            assert len(runs) == 2
+    """
+    )
+    result = testdir.runpytest("--reruns", "3")
+    assert_outcomes(result, passed=2, rerun=1)
+
+    result = testdir.runpytest("--reruns-fixture-budget", "-1")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines("*--reruns-fixture-budget must be >= 0*")
+
+
+def test_rerun_stop_on_identical_stops_deterministic_failures(testdir):
+    testdir.makepyfile(
+        """
+        def test_fail():
+            assert 1 == 2
+
+        def test_pass():
+            pass
+    """
+    )
+    result = testdir.runpytest(
+        "--reruns", "5", "--rerun-stop-on-identical", "3", "-r", "R"
+    )
+    assert_outcomes(result, passed=1, failed=1, rerun=2)
+    result.stdout.fnmatch_lines(
+        "RERUN STOPPED *::test_fail - same failure on 3 consecutive attempts"
+    )
+
+
+def test_rerun_stop_on_identical_ignores_numbers_in_messages(testdir):
+    # the message holds the attempt number
+    testdir.makepyfile(
+        f"""
+        def test_fail():
+            {temporary_failure(3)}
+    """
+    )
+    result = testdir.runpytest("--reruns", "5", "--rerun-stop-on-identical", "2")
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+
+
+def test_rerun_stop_on_identical_reruns_changing_failures(testdir):
+    testdir.makepyfile(
+        """
+        import py
+
+        def test_fail():
+            path = py.path.local(__file__).dirpath().ensure('test.res')
+            count = int(path.read() or 0)
+            path.write(count + 1)
+            if count % 2:
+                raise ValueError("odd")
+            raise ValueError("even")
+    """
+    )
+    result = testdir.runpytest(
+        "--reruns", "3", "--rerun-stop-on-identical", "2", "-r", "R"
+    )
+    assert_outcomes(result, passed=0, failed=1, rerun=3)
+    assert "RERUN STOPPED" not in result.stdout.str()
+
+
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_rerun_stop_on_identical_is_reported_by_xdist_workers(testdir):
+    testdir.makepyfile("def test_fail(): assert False")
+    result = testdir.runpytest(
+        "-p",
+        "xdist",
+        "-n",
+        "1",
+        "--reruns",
+        "5",
+        "--rerun-stop-on-identical",
+        "2",
+        "-r",
+        "R",
+    )
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    result.stdout.fnmatch_lines("RERUN STOPPED *::test_fail - *")
 
-            @staticmethod
-            def test_1():
-                logging.info("TestTestCaseFailFirstFailLast 1")
-                assert False
 
-            @staticmethod
-            def test_2():
-                logging.info("TestTestCaseFailFirstFailLast 2")
-                assert False
+def test_rerun_stop_on_identical_rejects_values_below_two(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest("--rerun-stop-on-identical", "1")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines("*--rerun-stop-on-identical must be >= 2*")
 
-        class TestTestCaseSkipFirst(TestCase):
 
-            @staticmethod
-            @pytest.mark.skipif(True, reason='Some reason')
-            def test_1():
-                logging.info("TestTestCaseSkipFirst 1")
-                assert False
+def test_rerun_circuit_breaker_stops_reruns_when_many_tests_fail(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
 
-            @staticmethod
-            def test_2():
-                logging.info("TestTestCaseSkipFirst 2")
-                assert False
+        @pytest.mark.parametrize("n", range(5))
+        def test_fail(n):
+            assert False
+    """
+    )
+    result = testdir.runpytest(
+        "--reruns",
+        "2",
+        "--rerun-circuit-breaker",
+        "0.5",
+        "--rerun-circuit-breaker-window",
+        "4",
+        "-r",
+        "R",
+    )
+    # the first test is rerun twice, the window is full after the first
+    # attempt of the second test, which trips the breaker
+    assert_outcomes(result, passed=0, failed=5, rerun=2)
+    result.stdout.fnmatch_lines(
+        "RERUN STOPPED *::test_fail[[]1[]] - circuit breaker open, "
+        "4 of the last 4 attempts failed"
+    )
 
-        class TestTestCaseSkipLast(TestCase):
 
-            @staticmethod
-            def test_1():
-                logging.info("TestTestCaseSkipLast 1")
-                assert False
+def test_rerun_circuit_breaker_grants_reruns_below_the_threshold(testdir):
+    testdir.makepyfile(
+        f"""
+        import pytest
 
-            @staticmethod
-            @pytest.mark.skipif(True, reason="Some reason")
-            def test_2():
-                logging.info("TestTestCaseSkipLast 2")
-                assert False"""
+        @pytest.mark.parametrize("n", range(5))
+        def test_pass(n):
+            pass
+
+        def test_flaky():
+            {temporary_failure()}
+    """
     )
-    import logging
+    result = testdir.runpytest(
+        "--reruns",
+        "2",
+        "--rerun-circuit-breaker",
+        "0.5",
+        "--rerun-circuit-breaker-window",
+        "4",
+    )
+    assert_outcomes(result, passed=6, rerun=1)
 
-    logging.info = mock.MagicMock()
 
-    result = testdir.runpytest("--reruns", "2")
-    expected_calls = [
-        mock.call("session setup"),
-        # TestFirstPassLastFail
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("TestFirstPassLastFail 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestFirstPassLastFail 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestFirstPassLastFail 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestFirstPassLastFail 2"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestFirstFailLastPass
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("TestFirstFailLastPass 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestFirstFailLastPass 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestFirstFailLastPass 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestFirstFailLastPass 2"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestSkipFirst
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("TestSkipFirst 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestSkipFirst 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestSkipFirst 2"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestSkipLast
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("TestSkipLast 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestSkipLast 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestSkipLast 1"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestSkipFixture
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("skip fixture setup"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestSetupFailed
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("fail fixture setup"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("fail fixture setup"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("fail fixture setup"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestTestCaseFailFirstFailLast
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseFailFirstFailLast 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseFailFirstFailLast 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseFailFirstFailLast 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseFailFirstFailLast 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseFailFirstFailLast 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseFailFirstFailLast 2"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestTestCaseSkipFirst
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseSkipFirst 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseSkipFirst 2"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseSkipFirst 2"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        # TestTestCaseSkipLast
-        mock.call("class setup"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseSkipLast 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseSkipLast 1"),
-        mock.call("function teardown"),
-        mock.call("function setup"),
-        mock.call("TestTestCaseSkipLast 1"),
-        mock.call("function teardown"),
-        mock.call("class teardown"),
-        mock.call("session teardown"),
+def test_maxfail_cancels_pending_deferred_reruns(testdir):
+    testdir.makepyfile(
+        """
+        def test_fail_1():
+            assert False
+
+        def test_fail_2():
+            assert False
+    """
+    )
+    result = testdir.runpytest(
+        "--reruns", "1", "--reruns-defer", "--maxfail", "1", "-r", "R"
+    )
+    # the final failure of the first test stops the session before the
+    # rerun of the second test, whose failure is final
+    assert_outcomes(result, passed=0, failed=2, rerun=2)
+    result.stdout.fnmatch_lines(
+        "RERUN STOPPED *::test_fail_2 - the session is stopping"
+    )
+
+
+def test_maxfail_cancels_parked_reruns(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        def test_fail_1():
+            assert False
+
+        @pytest.mark.flaky(reruns=0)
+        def test_fail_2():
+            assert False
+
+        def test_pass():
+            pass
+    """
+    )
+    result = testdir.runpytest(
+        "--reruns",
+        "1",
+        "--reruns-delay",
+        "60",
+        "--reruns-delay-nonblocking",
+        "--maxfail",
+        "1",
+        "-r",
+        "R",
+    )
+    # the session stops after test_fail_2, while test_fail_1 waits for its
+    # rerun
+    assert_outcomes(result, passed=0, failed=2, rerun=1)
+    result.stdout.fnmatch_lines(
+        "RERUN STOPPED *::test_fail_1 - the session is stopping"
+    )
+
+
+def test_rerun_circuit_breaker_rejects_invalid_values(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest("--rerun-circuit-breaker", "1.5")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines("*--rerun-circuit-breaker must be between 0 and 1*")
+
+    result = testdir.runpytest("--rerun-circuit-breaker-window", "0")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(
+        "*--rerun-circuit-breaker-window must be between 1 and 4096*"
+    )
+
+
+def _flaky_history_module(testdir):
+    testdir.makepyfile(
+        f"""
+        import pytest
+
+        def test_flaky():
+            {temporary_failure()}
+
+        def test_fail():
+            assert 1 == 2
+
+        @pytest.mark.skip
+        def test_skip():
+            pass
+    """
+    )
+
+
+def _read_history(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(
+            "SELECT run, nodeid, attempt, outcome, signature FROM attempts "
+            "ORDER BY nodeid, attempt"
+        ).fetchall()
+    finally:
+        connection.close()
+
+
+def test_rerun_history_records_every_attempt(testdir):
+    _flaky_history_module(testdir)
+    result = testdir.runpytest("--reruns", "1", "--rerun-history")
+    assert_outcomes(result, passed=1, failed=1, skipped=1, rerun=2)
+
+    path = testdir.tmpdir.join(".pytest_cache", "d", "rerunfailures", "history.sqlite")
+    rows = _read_history(str(path))
+    assert [row[1:4] for row in rows] == [
+        ("test_rerun_history_records_every_attempt.py::test_fail", 1, "rerun"),
+        ("test_rerun_history_records_every_attempt.py::test_fail", 2, "failed"),
+        ("test_rerun_history_records_every_attempt.py::test_flaky", 1, "rerun"),
+        ("test_rerun_history_records_every_attempt.py::test_flaky", 2, "passed"),
+        ("test_rerun_history_records_every_attempt.py::test_skip", 1, "skipped"),
     ]
+    assert len({row[0] for row in rows}) == 1
+    assert rows[0][4].endswith(".py:13: assert # == #")
+    assert rows[2][4].endswith(": Exception: Failure: #")
+    assert rows[3][4] is None
+
+
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_rerun_history_is_written_by_xdist_workers(testdir):
+    _flaky_history_module(testdir)
+    path = str(testdir.tmpdir.join("history.sqlite"))
+    result = testdir.runpytest(
+        "-p",
+        "xdist",
+        "-n",
+        "2",
+        "--reruns",
+        "1",
+        "--rerun-history",
+        "--rerun-history-path",
+        path,
+    )
+    assert_outcomes(result, passed=1, failed=1, skipped=1, rerun=2)
+    rows = _read_history(path)
+    assert len(rows) == 5
+    # the attempts of all workers belong to one run
+    assert len({row[0] for row in rows}) == 1
+
+
+def test_rerun_history_report_shows_flaky_tests(testdir):
+    _flaky_history_module(testdir)
+    path = str(testdir.tmpdir.join("history.sqlite"))
+    testdir.runpytest("--reruns", "1", "--rerun-history-path", path, "--rerun-history")
+    testdir.tmpdir.join("test.res").remove()
+    result = testdir.runpytest(
+        "--rerun-history-path",
+        path,
+        "--rerun-history",
+        "--rerun-history-report",
+        "--deselect",
+        "test_rerun_history_report_shows_flaky_tests.py::test_fail",
+    )
+    # test_flaky failed without reruns in the second run
+    result.stdout.fnmatch_lines([
+        "*= rerun history =*",
+        "flakiest tests (flaky runs / runs):",
+        "  50.0% 1/2 *::test_flaky",
+        "most time spent on failed attempts which were rerun:",
+        "*s *::test_f*",
+        "*s *::test_f*",
+    ])
+
+
+def test_rerun_history_report_without_history(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest("--rerun-history-report")
+    result.stdout.fnmatch_lines([
+        "*= rerun history =*",
+        "no flaky tests recorded",
+        "*",
+        "no reruns recorded",
+    ])
 
-    logging.info.assert_has_calls(expected_calls, any_order=False)
-    assert_outcomes(result, failed=8, passed=2, rerun=18, skipped=5, error=1)
 
+def test_rerun_history_needs_a_path_without_cache(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest("-p", "no:cacheprovider", "--rerun-history")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines("*--rerun-history needs the cacheprovider plugin*")
 
-def test_run_session_teardown_when_fixture_teardown_fails(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
 
-        @pytest.fixture(scope='session', autouse=True)
-        def session_fixture():
-            yield
-            print('session teardown')
+@pytest.mark.parametrize(
+    "history, reruns",
+    [
+        ([], 2),
+        ([0, 0], 2),
+        ([0, 0, 0], 0),
+        ([-1], 0),
+        ([-1, -2, 0], 0),
+        ([-2], 2),
+        ([0, 1, 0], 2),
+        ([3, 0, 1], 4),
+        ([4, 4], 5),
+        ([1, -1], 5),
+        ([0, 0, 0, -2], 2),
+        ([0, 0, 0, -2, -2, -2, -2, -2, -2, -2], 2),
+        ([0, 0, 0, -2, -1], 0),
+    ],
+)
+def test_adaptive_reruns_are_derived_from_recent_runs(history, reruns):
+    assert _get_adaptive_reruns(history, 2, 5) == reruns
 
-        @pytest.fixture(scope='module', autouse=True)
-        def module_fixture():
-            yield
-            print('module teardown')
 
-        @pytest.fixture
-        def broken_fixture():
-            yield
-            raise Exception("fixture teardown error")
+def test_reruns_adaptive_adjusts_counts_to_past_runs(testdir):
+    testdir.makepyfile(
+        f"""
+        def test_flaky():
+            {temporary_failure(2)}
 
-        def test_fail_in_fixture(broken_fixture):
+        def test_stable():
             pass
 
-        def test_ok():
-            pass
+        def test_broken():
+            assert False
     """
     )
+    result = testdir.runpytest("--reruns", "3", "--reruns-adaptive")
+    assert_outcomes(result, passed=2, failed=1, rerun=5)
+    cache = testdir.tmpdir.join(".pytest_cache", "v", "rerunfailures", "adaptive")
+    assert cache.check()
+
+    testdir.tmpdir.join("test.res").remove()
+    result = testdir.runpytest("--reruns", "2", "--reruns-adaptive", "-v")
+    # test_flaky needed 2 reruns and gets one more, test_broken is not rerun
+    assert_outcomes(result, passed=2, failed=1, rerun=2)
+    result.stdout.fnmatch_lines([
+        "adaptive reruns: 2 of 3 tests adjusted",
+        "  *::test_flaky: 3 reruns (configured 2)",
+        "  *::test_broken: 0 reruns (configured 2)",
+    ])
 
-    result = testdir.runpytest("--reruns", "1", "-s")
-    result.stdout.fnmatch_lines("*session teardown*")
-    result.stdout.fnmatch_lines("*module teardown*")
-    assert_outcomes(result, passed=3, rerun=1, error=1)
 
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_reruns_adaptive_with_xdist(testdir):
+    testdir.makepyfile("def test_broken(): assert False")
+    result = testdir.runpytest(
+        "-p", "xdist", "-n", "1", "--reruns", "2", "--reruns-adaptive"
+    )
+    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    result = testdir.runpytest(
+        "-p", "xdist", "-n", "1", "--reruns", "2", "--reruns-adaptive"
+    )
+    assert_outcomes(result, passed=0, failed=1, rerun=0)
 
-def test_exception_matches_rerun_except_query(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
 
-        @pytest.fixture(scope="session", autouse=True)
-        def session_fixture():
-            print("session setup")
-            yield "session"
-            print("session teardown")
+def _write_history(path, rows):
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            connection.executescript(HISTORY_SCHEMA)
+            connection.executemany(
+                "INSERT INTO attempts VALUES (?, ?, ?, ?, ?, NULL, ?)", rows
+            )
+    finally:
+        connection.close()
 
-        @pytest.fixture(scope="package", autouse=True)
-        def package_fixture():
-            print("package setup")
-            yield "package"
-            print("package teardown")
 
-        @pytest.fixture(scope="module", autouse=True)
-        def module_fixture():
-            print("module setup")
-            yield "module"
-            print("module teardown")
+def _make_ordered_tests_with_history(testdir):
+    testdir.makepyfile(
+        test_order="""
+            def test_a():
+                pass
 
-        @pytest.fixture(scope="class", autouse=True)
-        def class_fixture():
-            print("class setup")
-            yield "class"
-            print("class teardown")
+            def test_b():
+                pass
 
-        @pytest.fixture(scope="function", autouse=True)
-        def function_fixture():
-            print("function setup")
-            yield "function"
-            print("function teardown")
+            def test_c():
+                pass
 
-        @pytest.mark.flaky(reruns=1, rerun_except=["AssertionError"])
-        class TestStuff:
-            def test_1(self):
-                raise AssertionError("fail")
+            def test_d():
+                pass
+        """
+    )
+    path = str(testdir.tmpdir.join("history.sqlite"))
+    _write_history(
+        path,
+        [
+            # test_c is rerun in one of two runs and takes 1s
+            ("run1", "test_order.py::test_c", 1, "rerun", 1.0, 1),
+            ("run1", "test_order.py::test_c", 2, "passed", 1.0, 1),
+            ("run2", "test_order.py::test_c", 1, "passed", 1.0, 2),
+            # test_d is rerun in every run and takes 0.1s
+            ("run1", "test_order.py::test_d", 1, "rerun", 0.1, 1),
+            ("run1", "test_order.py::test_d", 2, "passed", 0.1, 1),
+            ("run1", "test_order.py::test_a", 1, "passed", 5.0, 1),
+            # recorded after the session started
+            ("run3", "test_order.py::test_b", 1, "rerun", 9.0, 2 * time.time()),
+        ],
+    )
+    return path
 
-            def test_2(self):
-                raise ValueError("fail")
 
-    """
+def test_rerun_flaky_first_orders_by_expected_rerun_time(testdir):
+    path = _make_ordered_tests_with_history(testdir)
+    result = testdir.runpytest(
+        "--rerun-flaky-first", "--rerun-history-path", path, "--co", "-q"
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=2, rerun=1)
-    result.stdout.fnmatch_lines("session teardown")
-    result.stdout.fnmatch_lines("package teardown")
-    result.stdout.fnmatch_lines("module teardown")
-    result.stdout.fnmatch_lines("class teardown")
-    result.stdout.fnmatch_lines("function teardown")
+    result.stdout.fnmatch_lines([
+        "test_order.py::test_c",
+        "test_order.py::test_d",
+        "test_order.py::test_a",
+        "test_order.py::test_b",
+    ])
 
 
-def test_exception_not_match_rerun_except_query(testdir):
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_rerun_flaky_first_orders_the_same_on_all_xdist_workers(testdir):
+    path = _make_ordered_tests_with_history(testdir)
+    result = testdir.runpytest(
+        "-p",
+        "xdist",
+        "-n",
+        "2",
+        "--rerun-flaky-first",
+        "--rerun-history",
+        "--rerun-history-path",
+        path,
+    )
+    assert_outcomes(result, passed=4)
+
+
+def _make_rescheduled_tests(testdir, failures):
     testdir.makepyfile(
-        """
+        f"""
+        import os
+
         import pytest
 
-        @pytest.fixture(scope="session", autouse=True)
-        def session_fixture():
-            print("session setup")
-            yield "session"
-            print("session teardown")
+        def test_flaky():
+            with open("workers.txt", "a") as f:
+                f.write(os.environ["PYTEST_XDIST_WORKER"] + "\\n")
+            {temporary_failure(failures)}
 
-        @pytest.fixture(scope="function", autouse=True)
-        def function_fixture():
-            print("function setup")
-            yield "function"
-            print("function teardown")
+        @pytest.mark.parametrize("i", range(40))
+        def test_pass(i):
+            pass
+        """
+    )
 
-        @pytest.mark.flaky(reruns=1, rerun_except="AssertionError")
-        def test_1(session_fixture, function_fixture):
-            raise ValueError("value")
-    """
+
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_reruns_reschedule_other_runs_the_rerun_on_another_worker(testdir):
+    _make_rescheduled_tests(testdir, failures=1)
+    result = testdir.runpytest(
+        "-p", "xdist", "-n", "2", "--reruns", "1", "--reruns-reschedule", "other"
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1, rerun=1)
-    result.stdout.fnmatch_lines("session teardown")
+    assert_outcomes(result, passed=41, rerun=1)
+    first, second = testdir.tmpdir.join("workers.txt").read().split()
+    assert first != second
 
 
-def test_exception_matches_only_rerun_query(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_reruns_reschedule_counts_the_reruns_across_workers(testdir):
+    _make_rescheduled_tests(testdir, failures=5)
+    result = testdir.runpytest(
+        "-p", "xdist", "-n", "2", "--reruns", "2", "--reruns-reschedule", "any"
+    )
+    assert_outcomes(result, passed=40, failed=1, rerun=2)
+    assert len(testdir.tmpdir.join("workers.txt").read().split()) == 3
 
-        @pytest.fixture(scope="session", autouse=True)
-        def session_fixture():
-            print("session setup")
-            yield "session"
-            print("session teardown")
 
-        @pytest.fixture(scope="function", autouse=True)
-        def function_fixture():
-            print("function setup")
-            yield "function"
-            print("function teardown")
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_reruns_reschedule_retries_the_last_test_of_a_worker_in_place(testdir):
+    testdir.makepyfile(
+        f"""
+        def test_pass():
+            pass
 
-        @pytest.mark.flaky(reruns=1, only_rerun=["AssertionError"])
-        def test_1(session_fixture, function_fixture):
-            raise AssertionError("fail")
-    """
+        def test_flaky():
+            {temporary_failure()}
+        """
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1, rerun=1)
-    result.stdout.fnmatch_lines("session teardown")
+    result = testdir.runpytest(
+        "-p", "xdist", "-n", "2", "--reruns", "1", "--reruns-reschedule", "any"
+    )
+    assert_outcomes(result, passed=2, rerun=1)
 
 
-def test_exception_not_match_only_rerun_query(testdir):
-    testdir.makepyfile(
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+@pytest.mark.parametrize(
+    "option", [["--reruns-reschedule", "any"], ["--reruns-delay-nonblocking"]]
+)
+def test_delayed_rescheduled_rerun_does_not_block_the_worker(testdir, option):
+    testdir.makeconftest(
         """
-        import pytest
+        def pytest_runtest_logreport(report):
+            # xdist sets the node on the reports the controller receives
+            if report.outcome == "rerun" and hasattr(report, "node"):
+                with open("rescheduled", "w") as f:
+                    f.write(str(getattr(report, "rerun_rescheduled", False)))
+        """
+    )
+    testdir.makepyfile(
+        f"""
+        import time
 
-        @pytest.fixture(scope="session", autouse=True)
-        def session_fixture():
-            print("session setup")
-            yield "session"
-            print("session teardown")
+        def log(name):
+            with open("log", "a") as f:
+                f.write(f"{{name}} {{time.monotonic()}}\\n")
 
-        @pytest.fixture(scope="function", autouse=True)
-        def function_fixture():
-            print("function setup")
-            yield "function"
-            print("function teardown")
+        def test_flaky():
+            log("flaky")
+            {temporary_failure()}
 
-        @pytest.mark.flaky(reruns=1, only_rerun=["AssertionError"])
-        def test_1(session_fixture, function_fixture):
-            raise ValueError("fail")
-    """
+        def test_a():
+            log("a")
+
+        def test_b():
+            log("b")
+        """
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1)
-    result.stdout.fnmatch_lines("session teardown")
+    result = testdir.runpytest(
+        "-p",
+        "xdist",
+        "-n",
+        "1",
+        "--reruns",
+        "1",
+        "--reruns-delay",
+        "1",
+        *option,
+    )
+    assert_outcomes(result, passed=3, rerun=1)
+    # the rerun went through the scheduler
+    assert testdir.tmpdir.join("rescheduled").read() == "True"
+    runs = [line.split() for line in testdir.tmpdir.join("log").readlines()]
+    assert [name for name, _ in runs] == ["flaky", "a", "b", "flaky"]
+    times = [float(started) for _, started in runs]
+    # the worker runs the next test right away, the controller holds the
+    # rerun back until its delay elapsed
+    assert times[1] - times[0] < 1
+    assert times[3] - times[0] >= 1
 
 
-def test_exception_match_rerun_except_in_dual_query(testdir):
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_delayed_rerun_runs_in_place_without_the_xdist_controller(testdir):
     testdir.makepyfile(
+        f"""
+        def log(name):
+            with open("log", "a") as f:
+                f.write(name + "\\n")
+
+        def test_flaky():
+            log("flaky")
+            {temporary_failure()}
+
+        def test_pass():
+            log("pass")
         """
-        import pytest
+    )
+    with mock.patch("pytest_rerunfailures._XDistController.get", return_value=None):
+        result = testdir.runpytest(
+            "-p",
+            "xdist",
+            "-n",
+            "1",
+            "--reruns",
+            "1",
+            "--reruns-delay",
+            "0.1",
+            "--reruns-reschedule",
+            "any",
+        )
+    assert_outcomes(result, passed=2, rerun=1)
+    assert testdir.tmpdir.join("log").read().split() == ["flaky", "flaky", "pass"]
 
-        @pytest.fixture(scope="session", autouse=True)
-        def session_fixture():
-            print("session setup")
-            yield "session"
-            print("session teardown")
 
-        @pytest.fixture(scope="function", autouse=True)
-        def function_fixture():
-            print("function setup")
-            yield "function"
-            print("function teardown")
+def _make_reschedule_sched(failed_node, *others):
+    db = ServerStatusDB()
+    config = SimpleNamespace(
+        failures_db=db,
+        option=SimpleNamespace(reruns_reschedule="other"),
+        pluginmanager=SimpleNamespace(getplugin=lambda name: dsession),
+    )
+    failed_node.config = config
+    sched = SimpleNamespace(
+        collection=["test_pass", "test_flaky"],
+        nodes=[failed_node, *others],
+        node2pending={node: list(node.pending) for node in (failed_node, *others)},
+        mark_test_pending=mock.MagicMock(),
+    )
+    dsession = SimpleNamespace(
+        sched=sched, queue=queue.Queue(), shouldstop=False, shuttingdown=False
+    )
+    return sched, db
 
-        @pytest.mark.flaky(reruns=1, rerun_except=["Exception"], only_rerun=["Not"])
-        def test_1(session_fixture, function_fixture):
-            raise Exception("fail")
-    """
+
+def _make_reschedule_node(shutting_down=False, pending=()):
+    # hashable, the scheduler maps the nodes to their pending tests
+    return mock.Mock(shutting_down=shutting_down, pending=pending)
+
+
+def test_reruns_reschedule_other_picks_the_least_busy_other_worker():
+    failed = _make_reschedule_node()
+    busy = _make_reschedule_node(pending=[0, 0])
+    idle = _make_reschedule_node(pending=[0])
+    sched, db = _make_reschedule_sched(failed, busy, idle)
+    report = SimpleNamespace(
+        nodeid="test_flaky", node=failed, outcome="rerun", rerun_rescheduled=True
+    )
+    hooks = XDistHooks()
+    hooks.controller = _XDistController(failed.config.pluginmanager.getplugin(""))
+
+    hooks.pytest_runtest_logreport(report)
+
+    assert report.outcome == "rerun"
+    assert db.get_test_failures(1) == 1
+    idle.send_runtest_some.assert_called_once_with([1])
+    assert sched.node2pending[idle] == [0, 1]
+    busy.send_runtest_some.assert_not_called()
+    sched.mark_test_pending.assert_not_called()
+    db.close()
+
+
+def test_reruns_reschedule_other_leaves_the_test_to_the_scheduler_without_controller():
+    failed = _make_reschedule_node()
+    other = _make_reschedule_node()
+    sched, db = _make_reschedule_sched(failed, other)
+    report = SimpleNamespace(
+        nodeid="test_flaky", node=failed, outcome="rerun", rerun_rescheduled=True
+    )
+
+    XDistHooks().pytest_runtest_logreport(report)
+
+    assert report.outcome == "rerun"
+    other.send_runtest_some.assert_not_called()
+    sched.mark_test_pending.assert_called_once_with("test_flaky")
+    db.close()
+
+
+def test_reruns_reschedule_fails_the_test_without_a_worker_left():
+    failed = _make_reschedule_node(shutting_down=True)
+    other = _make_reschedule_node(shutting_down=True)
+    sched, db = _make_reschedule_sched(failed, other)
+    db.try_increment_suite_reruns(None, 500)
+    report = SimpleNamespace(
+        nodeid="test_flaky",
+        node=failed,
+        outcome="rerun",
+        rerun_rescheduled=True,
+        rerun_reserved_cost=500,
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1)
-    result.stdout.fnmatch_lines("session teardown")
 
+    XDistHooks().pytest_runtest_logreport(report)
 
-def test_exception_match_only_rerun_in_dual_query(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
+    assert report.outcome == "failed"
+    assert report.rerun_stopped == "no worker left to rerun it"
+    assert db.get_suite_rerun_cost() == 0
+    other.send_runtest_some.assert_not_called()
+    sched.mark_test_pending.assert_not_called()
+    db.close()
+
+
+def test_reruns_reschedule_holds_a_delayed_rerun_on_the_controller():
+    failed = _make_reschedule_node()
+    other = _make_reschedule_node()
+    sched, db = _make_reschedule_sched(failed, other)
+    dsession = failed.config.pluginmanager.getplugin("dsession")
+    report = SimpleNamespace(
+        nodeid="test_flaky",
+        node=failed,
+        outcome="rerun",
+        rerun_rescheduled=True,
+        rerun_delay=0.05,
+    )
+    hooks = XDistHooks()
+    hooks.controller = _XDistController(dsession)
+    shutdown = mock.MagicMock()
+
+    hooks.pytest_runtest_logreport(report)
+    dsession.shuttingdown = True
+    hooks._shutdown_node(failed, shutdown)
+
+    assert report.outcome == "rerun"
+    other.send_runtest_some.assert_not_called()
+    # the node may run the held rerun
+    shutdown.assert_not_called()
+    event, kwargs = dsession.queue.get(timeout=5)
+    getattr(dsession, f"worker_{event}")(**kwargs)
+    other.send_runtest_some.assert_called_once_with([1])
+    # the held back shutdown follows the rerun
+    failed.shutdown.assert_called_once_with()
+    other.shutdown.assert_called_once_with()
+    db.close()
 
-        @pytest.fixture(scope="session", autouse=True)
-        def session_fixture():
-            print("session setup")
-            yield "session"
-            print("session teardown")
 
-        @pytest.fixture(scope="function", autouse=True)
-        def function_fixture():
-            print("function setup")
-            yield "function"
-            print("function teardown")
+@pytest.mark.skipif(not has_xdist, reason="requires xdist with crashitem")
+def test_xdist_controller_dispatches_the_due_event():
+    from xdist.dsession import DSession
+
+    dsession = DSession(
+        SimpleNamespace(
+            option=SimpleNamespace(debug=False, maxworkerrestart=None, numprocesses=1),
+            getvalue=lambda name: 0,
+            pluginmanager=SimpleNamespace(getplugin=lambda name: None),
+        )
+    )
+    dsession._active_nodes.add(_make_reschedule_node())
+    dsession.sched = SimpleNamespace(tests_finished=False)
+    controller = _XDistController.get(
+        SimpleNamespace(pluginmanager=SimpleNamespace(getplugin=lambda name: dsession))
+    )
+    assert controller is not None
+    callback = mock.Mock()
+
+    controller.on_due(callback)
+    controller.queue_due(0)
+    # fails if the loop of the session no longer dispatches the event
+    dsession.loop_once()
 
-        @pytest.mark.flaky(reruns=1, rerun_except=["Not"], only_rerun=["Exception"])
-        def test_1(session_fixture, function_fixture):
-            raise Exception("fail")
-    """
+    callback.assert_called_once_with()
+
+
+def test_xdist_controller_is_not_used_with_other_xdist_versions(monkeypatch):
+    dsession = SimpleNamespace(
+        loop_once=None, queue=queue.Queue(), sched=None, shuttingdown=False
     )
-    result = testdir.runpytest()
-    assert_outcomes(result, passed=0, failed=1, rerun=1)
-    result.stdout.fnmatch_lines("session teardown")
+    config = SimpleNamespace(
+        pluginmanager=SimpleNamespace(getplugin=lambda n: dsession)
+    )
+    monkeypatch.setattr("importlib.metadata.version", lambda name: "3.8.0")
+    assert _XDistController.get(config) is not None
+    monkeypatch.setattr("importlib.metadata.version", lambda name: "4.0.0")
+    assert _XDistController.get(config) is None
+    monkeypatch.setattr("importlib.metadata.version", lambda name: "3.8.0")
+    del dsession.loop_once
+    assert _XDistController.get(config) is None
 
 
-@pytest.mark.parametrize("mark_params", ["", "reruns=1"])
-def test_force_reruns(testdir, mark_params):
+needs_fork = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+
+@needs_fork
+def test_rerun_snapshot_sets_up_the_test_once(testdir):
     testdir.makepyfile(
         f"""
         import pytest
 
-        @pytest.mark.flaky({mark_params})
-        def test_fail():
-            assert False
-    """
-    )
+        @pytest.fixture
+        def expensive():
+            with open("setups.txt", "a") as f:
+                f.write("setup\\n")
+            yield
+            with open("setups.txt", "a") as f:
+                f.write("teardown\\n")
 
-    result = testdir.runpytest("--force-reruns", "3")
-    assert_outcomes(result, passed=0, failed=1, rerun=3)
+        def test_flaky(expensive):
+            {temporary_failure(2)}
+        """
+    )
+    result = testdir.runpytest("--reruns", "2", "--rerun-snapshot", "fork")
+    assert_outcomes(result, passed=1, rerun=2)
+    assert testdir.tmpdir.join("setups.txt").read().split() == ["setup", "teardown"]
 
 
-def test_reruns_mode_append_sums_marker_and_cli(testdir):
+@needs_fork
+def test_rerun_snapshot_reports_the_output_of_the_child(testdir):
     testdir.makepyfile(
         """
-        import pytest
-
-        @pytest.mark.flaky(reruns=2)
         def test_fail():
+            print("printed by the child")
             assert False
-    """
+        """
     )
-
-    result = testdir.runpytest("--reruns", "4", "--reruns-mode", "append")
-    assert_outcomes(result, passed=0, failed=1, rerun=6)
+    result = testdir.runpytest("--reruns", "1", "--rerun-snapshot", "fork")
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    result.stdout.fnmatch_lines(["*Captured stdout call*", "printed by the child"])
 
 
-def test_reruns_mode_default_is_strict(testdir):
+@needs_fork
+def test_rerun_snapshot_reruns_a_crashed_call(testdir):
     testdir.makepyfile(
         """
-        import pytest
+        import os
 
-        @pytest.mark.flaky(reruns=2)
-        def test_fail():
-            assert False
-    """
+        def test_crash():
+            os._exit(3)
+        """
     )
-
-    result = testdir.runpytest("--reruns", "4")
-    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    result = testdir.runpytest("--reruns", "1", "--rerun-snapshot", "fork")
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    result.stdout.fnmatch_lines(["*the process running the test exited with code 3*"])
 
 
-def test_reruns_mode_append_without_marker_uses_global(testdir):
+@needs_fork
+def test_rerun_snapshot_reports_the_warnings_of_the_child(testdir):
     testdir.makepyfile(
+        f"""
+        import warnings
+
+        def test_pass():
+            warnings.warn("raised by the child")
+
+        def test_flaky():
+            warnings.warn(DeprecationWarning("raised by every attempt"))
+            {temporary_failure()}
         """
-        def test_fail():
-            assert False
-    """
     )
-
-    result = testdir.runpytest("--reruns", "3", "--reruns-mode", "append")
-    assert_outcomes(result, passed=0, failed=1, rerun=3)
+    result = testdir.runpytest("--reruns", "1", "--rerun-snapshot", "fork")
+    assert_outcomes(result, passed=2, rerun=1)
+    assert result.parseoutcomes()["warnings"] == 3
+    result.stdout.fnmatch_lines([
+        "*test_pass*",
+        "*UserWarning: raised by the child",
+        "*test_flaky*",
+        "*DeprecationWarning: raised by every attempt",
+    ])
 
 
-def test_reruns_mode_invalid_choice_errors(testdir):
+@needs_fork
+def test_rerun_snapshot_sets_up_again_after_a_setup_error(testdir):
     testdir.makepyfile(
+        f"""
+        import pytest
+
+        @pytest.fixture
+        def flaky_setup():
+            {temporary_failure()}
+
+        def test_pass(flaky_setup):
+            pass
         """
-        def test_pass():
-            assert True
-    """
     )
+    result = testdir.runpytest("--reruns", "1", "--rerun-snapshot", "fork")
+    assert_outcomes(result, passed=1, rerun=1)
 
-    result = testdir.runpytest("--reruns-mode", "bogus")
-    assert result.ret != 0
+
+def test_rerun_snapshot_incompatible_with_reruns_defer(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest(
+        "--reruns", "1", "--rerun-snapshot", "fork", "--reruns-defer"
+    )
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*--rerun-snapshot incompatible with --reruns-defer*"])
 
 
-def test_max_suite_reruns_caps_total_reruns(testdir):
-    """Suite limit stops reruns once the total across all tests is reached."""
+@needs_fork
+def test_rerun_isolate_marker_reruns_a_crashed_test(testdir):
     testdir.makepyfile(
-        """
-        def test_fail_1():
-            assert False
+        f"""
+        import pytest
 
-        def test_fail_2():
-            assert False
+        @pytest.mark.flaky(reruns=1, isolate=True)
+        def test_crash():
+            {temporary_crash()}
 
-        def test_fail_3():
-            assert False
-    """
+        def test_pass():
+            pass
+        """
     )
-    # 3 tests each allowed up to 3 reruns, but suite cap is 4 total
-    result = testdir.runpytest("--reruns", "3", "--max-suite-reruns", "4")
-    assert_outcomes(result, passed=0, failed=3, rerun=4)
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=2, rerun=1)
 
 
-def test_max_suite_reruns_caps_force_reruns(testdir):
-    """Suite cap applies after ``--force-reruns`` selection."""
+@needs_fork
+def test_rerun_isolate_reports_the_warnings_of_the_child(testdir):
     testdir.makepyfile(
         """
-        def test_fail_1():
-            assert False
+        import warnings
 
-        def test_fail_2():
-            assert False
-    """
-    )
-    # Force reruns allows every failing test to rerun, but the suite cap should
-    # limit total reruns to one.
-    result = testdir.runpytest("--force-reruns", "5", "--max-suite-reruns", "1")
-    assert_outcomes(result, passed=0, failed=2, rerun=1)
+        import pytest
 
+        @pytest.fixture
+        def resource():
+            warnings.warn("raised in the setup")
+            yield
+            warnings.warn("raised in the teardown")
 
-def test_max_suite_reruns_does_not_limit_when_sufficient(testdir):
-    """Suite limit has no effect when total reruns stay below the cap."""
-    testdir.makepyfile(
+        def test_pass(resource):
+            warnings.warn("raised in the call")
         """
-        def test_fail():
-            assert False
-    """
     )
-    result = testdir.runpytest("--reruns", "2", "--max-suite-reruns", "10")
-    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    result = testdir.runpytest("--reruns", "1", "--rerun-isolate")
+    assert_outcomes(result, passed=1)
+    assert result.parseoutcomes()["warnings"] == 3
+    result.stdout.fnmatch_lines([
+        "*UserWarning: raised in the setup",
+        "*UserWarning: raised in the call",
+        "*UserWarning: raised in the teardown",
+    ])
+
+
+@needs_fork
+def test_rerun_isolate_fails_a_test_crashing_every_attempt(testdir):
+    testdir.makepyfile(
+        """
+        import os
 
+        import pytest
 
-def test_max_suite_reruns_zero_disables_all_reruns(testdir):
-    """Suite limit of 0 prevents any reruns from occurring."""
-    testdir.makepyfile(
+        def test_crash():
+            os._exit(3)
+
+        @pytest.mark.flaky(reruns=1, isolate=False)
+        def test_in_process():
+            assert os.getpid() == int(open("pid.txt").read())
         """
-        def test_fail():
-            assert False
-    """
     )
-    result = testdir.runpytest("--reruns", "3", "--max-suite-reruns", "0")
-    assert_outcomes(result, passed=0, failed=1, rerun=0)
+    testdir.makeconftest(
+        """
+        import os
+
+        def pytest_configure():
+            with open("pid.txt", "w") as f:
+                f.write(str(os.getpid()))
+        """
+    )
+    result = testdir.runpytest("--reruns", "1", "--rerun-isolate")
+    assert_outcomes(result, passed=1, failed=1, rerun=1)
+    result.stdout.fnmatch_lines(["*the process running the test exited with code 3*"])
 
 
-def test_max_suite_reruns_works_with_passing_tests(testdir):
-    """Suite limit only counts actual reruns, not passing test runs."""
+@needs_fork
+@pytest.mark.parametrize(
+    "mode",
+    [["--rerun-snapshot", "fork"], ["--rerun-isolate"]],
+    ids=["snapshot", "isolate"],
+)
+def test_rerun_history_records_every_attempt_of_a_forked_test(testdir, mode):
     testdir.makepyfile(
-        """
-        def test_pass():
-            assert True
+        f"""
+        def test_crash():
+            {temporary_crash()}
 
         def test_fail():
             assert False
-    """
+        """
+    )
+    path = str(testdir.tmpdir.join("history.sqlite"))
+    result = testdir.runpytest(
+        "--reruns", "1", "--rerun-history", "--rerun-history-path", path, *mode
     )
-    result = testdir.runpytest("--reruns", "3", "--max-suite-reruns", "2")
     assert_outcomes(result, passed=1, failed=1, rerun=2)
+    module = "test_rerun_history_records_every_attempt_of_a_forked_test.py"
+    assert [row[1:4] for row in _read_history(path)] == [
+        (f"{module}::test_crash", 1, "rerun"),
+        (f"{module}::test_crash", 2, "passed"),
+        (f"{module}::test_fail", 1, "rerun"),
+        (f"{module}::test_fail", 2, "failed"),
+    ]
 
 
-def test_max_suite_reruns_without_reruns_has_no_effect(testdir):
-    """--max-suite-reruns alone (without --reruns) does not break anything."""
+@needs_fork
+def test_rerun_isolate_leaves_the_module_fixtures_to_the_parent(testdir):
     testdir.makepyfile(
+        f"""
+        import pytest
+
+        @pytest.fixture(scope="module")
+        def expensive():
+            with open("setups.txt", "a") as f:
+                f.write("setup\\n")
+            yield
+            with open("setups.txt", "a") as f:
+                f.write("teardown\\n")
+
+        def test_first(expensive):
+            pass
+
+        @pytest.mark.flaky(reruns=1, isolate=True)
+        def test_isolated(expensive):
+            {temporary_failure()}
+
+        def test_last(expensive):
+            pass
         """
-        def test_fail():
-            assert False
-    """
     )
-    result = testdir.runpytest("--max-suite-reruns", "5")
-    assert_outcomes(result, passed=0, failed=1, rerun=0)
+    result = testdir.runpytest()
+    assert_outcomes(result, passed=3, rerun=1)
+    assert testdir.tmpdir.join("setups.txt").read().split() == ["setup", "teardown"]
 
 
-@pytest.mark.skipif(not has_subtests, reason="Only supported on pytest 9.0 and newer")
-def test_failing_subtests_are_rerun(testdir):
+@needs_fork
+def test_rerun_isolate_sets_up_the_shared_fixtures_once(testdir):
     testdir.makepyfile(
         f"""
+        import os
+
         import pytest
 
-        def test_subtests(subtests):
-            with subtests.test("Fails on first attempt"):
-                {indent(temporary_failure(), "    ")}
-    """
-    )
+        def log(message):
+            with open("setups.txt", "a") as f:
+                f.write(message + "\\n")
 
-    result = testdir.runpytest("--reruns", "1")
-    assert result.ret == 0
-    assert_outcomes(result, passed=1, rerun=1)
+        @pytest.fixture(scope="session")
+        def session_resource():
+            log("setup-session")
+            yield
+            log("teardown-session")
 
+        @pytest.fixture(scope="module")
+        def expensive(session_resource):
+            log("setup-module")
+            yield os.getpid()
+            log("teardown-module")
 
-@pytest.mark.skipif(not has_subtests, reason="Only supported on pytest 9.0 and newer")
-def test_too_many_failing_subtests_are_failures(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
+        def test_first(expensive):
+            assert expensive != os.getpid()
 
-        def test_subtests(subtests):
-            with subtests.test("Always fails"):
-                assert False
-    """
-    )
+        def test_flaky(expensive):
+            {temporary_failure()}
 
-    result = testdir.runpytest("--reruns", "1")
-    assert result.ret != 0
-    assert_outcomes(result, passed=0, failed=2, rerun=1)
+        def test_last(expensive):
+            pass
+        """
+    )
+    result = testdir.runpytest("--reruns", "1", "--rerun-isolate")
+    assert_outcomes(result, passed=3, rerun=1)
+    # the children of all attempts share the fixtures set up by the parent
+    assert testdir.tmpdir.join("setups.txt").read().split() == [
+        "setup-session",
+        "setup-module",
+        "teardown-module",
+        "teardown-session",
+    ]
 
 
-def test_max_suite_reruns_caps_flaky_marker_reruns(testdir):
+@needs_fork
+def test_rerun_fresh_process_escapes_polluted_state(testdir):
     testdir.makepyfile(
         """
-        import pytest
+        STATE = []
 
-        @pytest.mark.flaky(reruns=3)
-        def test_fail():
-            assert False
+        def test_pollute():
+            STATE.append(1)
+
+        def test_needs_clean_state():
+            assert not STATE
         """
     )
-    result = testdir.runpytest("--max-suite-reruns", "2")
-    assert_outcomes(result, passed=0, failed=1, rerun=2)
+    result = testdir.runpytest("--reruns", "1", "--rerun-fresh-process")
+    assert_outcomes(result, passed=2, rerun=1)
 
 
-def test_max_suite_reruns_rejects_negative_without_reruns(testdir):
-    testdir.makepyfile("def test_pass(): pass")
-    result = testdir.runpytest("--max-suite-reruns", "-1")
-    assert result.ret == pytest.ExitCode.USAGE_ERROR
-    result.stderr.fnmatch_lines("*--max-suite-reruns must be >= 0*")
+@needs_fork
+def test_rerun_fresh_process_fails_a_crashed_rerun(testdir):
+    testdir.makepyfile(
+        """
+        import os
 
-    collect_result = testdir.runpytest("--collect-only", "--max-suite-reruns", "-1")
-    assert collect_result.ret == pytest.ExitCode.USAGE_ERROR
-    collect_result.stderr.fnmatch_lines("*--max-suite-reruns must be >= 0*")
+        def test_fail_then_crash():
+            if os.path.exists("attempted"):
+                os._exit(3)
+            open("attempted", "w").close()
+            assert False
 
+        def test_pass():
+            pass
+        """
+    )
+    result = testdir.runpytest("--reruns", "1", "--rerun-fresh-process")
+    assert_outcomes(result, passed=1, failed=1, rerun=1)
+    result.stdout.fnmatch_lines(["*the process running the test exited with code 3*"])
 
-def test_max_suite_reruns_preserves_fixture_teardown_when_exhausted(testdir):
+
+@needs_fork
+def test_rerun_fresh_process_reports_the_warnings_of_the_child(testdir):
     testdir.makepyfile(
         """
-        import pytest
+        import os
+        import warnings
 
-        @pytest.fixture(scope="module", autouse=True)
-        def module_fixture():
-            yield
-            print("module teardown")
+        import pytest
 
+        @pytest.mark.filterwarnings("error:fatal")
         def test_fail():
+            warnings.warn("raised by every attempt")
+            if os.path.exists("attempted"):
+                # an error with the filters of the test
+                warnings.warn("fatal")
+            open("attempted", "w").close()
             assert False
         """
     )
-    result = testdir.runpytest("-s", "--reruns", "1", "--max-suite-reruns", "0")
-    result.stdout.fnmatch_lines("*module teardown*")
+    result = testdir.runpytest("--reruns", "1", "--rerun-fresh-process")
+    assert_outcomes(result, passed=0, failed=1, rerun=1)
+    assert result.parseoutcomes()["warnings"] == 2
+    result.stdout.fnmatch_lines(["*UserWarning: fatal", "*raised by every attempt"])
+
+
+def test_rerun_fresh_process_incompatible_with_rerun_snapshot(testdir):
+    testdir.makepyfile("def test_pass(): pass")
+    result = testdir.runpytest(
+        "--reruns", "1", "--rerun-snapshot", "fork", "--rerun-fresh-process"
+    )
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines([
+        "*--rerun-snapshot incompatible with --rerun-fresh-process*"
+    ])